@@ -3,124 +3,267 @@
 """
 Created on Mon Nov 19 14:30:36 2018
 
+The analysis is run by runNAPS(), which takes a list of command line style
+arguments and returns the results, so it can be called in-process (eg. by the
+web app). When run as a script, the arguments are taken from the command line.
+
 @author: aph516
 """
 
 #import pandas as pd
 from NAPS_importer import NAPS_importer
 from NAPS_assigner import NAPS_assigner
+from NAPS_profiling import Profiler
 import argparse
+import sys
 #from pathlib import Path
 import logging
 
 #### Command line arguments
-parser = argparse.ArgumentParser(description="NAPS (NMR Assignments from Predicted Shifts)")
-parser.add_argument("shift_file", 
-                    help="A table of observed chemical shifts.")
-parser.add_argument("pred_file",
-                    help="A table of predicted chemical shifts.")
-parser.add_argument("output_file",
-                    help="The file results will be written to.")
-
-parser.add_argument("--shift_type", 
-                    choices=["naps", "ccpn", "sparky", 
-                             "xeasy", "nmrpipe", "test"], 
-                    default="naps", 
-                    help="The format of the observed shift file.")
-parser.add_argument("--pred_type", 
-                    choices=["shiftx2", "sparta+"],
-                    default="shiftx2", 
-                    help="The format of the predicted shifts")
-
-parser.add_argument("-c", "--config_file", 
-                    default="/Users/aph516/GitHub/NAPS/python/config.txt",
-                    help="A file containing parameters for the analysis.")
-parser.add_argument("-l", "--log_file", default=None,
-                    help="A file logging information will be written to.")
-#parser.add_argument("--delta_correlation", action="store_true", 
-#                    help="If set, account for correlations between prediction errors of different atom types")
-parser.add_argument("-a", "--alt_assignments", default=-1, type=int,
-                    help="The number of alternative assignments to generate, "+
-                    "in addition to the highest ranked.")
-parser.add_argument("--plot_file", 
-                    default="/Users/aph516/GitHub/NAPS/plots/plot",
-                    help="A filename for any output plots.")
-
-if True:
-    args = parser.parse_args()
-else:   # For testing
-    args = parser.parse_args(("../data/P3a_L273R/naps_shifts.txt",
-                              "../output/test.txt",
-                              "--shift_type","naps",
-                              "--pred_file","../data/P3a_L273R/shiftx2.cs",
-                              "-c","../config/config.txt",
-                              "-l","../output/test.log"))    
-
-# Set up logging
-if isinstance(args.log_file, str):
-    print(args.log_file)
-    logging.basicConfig(filename=args.log_file, filemode='w', level=logging.DEBUG,
-                        format="%(levelname)s %(asctime)s %(module)s %(funcName)s %(message)s")
-else:
-    logging.basicConfig(level=logging.ERROR)
-
-#%%
-#### Set up the NAPS_assigner object
-a = NAPS_assigner()
-
-# Import config file
-a.read_config_file(args.config_file)
-logging.info("Read in configuration from %s.", args.config_file)
-
-# Account for any command line arguments that overide config file
-if args.alt_assignments>=0:
-    a.pars["alt_assignments"] = args.alt_assignments
-#if args.delta_correlation:
-#    a.pars["prob_method"] = "delta_correlation"
-
-# Import observed and predicted shifts
-importer = NAPS_importer()
-
-if args.shift_type=="test":
-    importer.import_testset_shifts(args.shift_file)
-else:
-    importer.import_obs_shifts(args.shift_file, args.shift_type, SS_num=False)
-a.obs = importer.obs
-logging.info("Read in %d spin systems from %s.", 
-             len(a.obs["SS_name"]), args.shift_file)
-
-
-a.import_pred_shifts(args.pred_file, args.pred_type)
-logging.info("Read in %d predicted residues from %s.", 
-             len(a.preds["Res_name"]), args.pred_file)
-
-#### Do the analysis
-a.add_dummy_rows()
-a.calc_log_prob_matrix2(sf=1, verbose=False)
-logging.info("Calculated log probability matrix (%dx%d).", 
-             a.log_prob_matrix.shape[0], a.log_prob_matrix.shape[1])
-matching = a.find_best_assignments()
-a.make_assign_df(matching, set_assign_df=True)
-logging.info("Calculated best assignment.")
-assign_df = a.check_assignment_consistency(threshold=0.1)
-logging.info("Checked assignment consistency.")
-
-if a.pars["alt_assignments"]>0:
-    a.find_alt_assignments(N=a.pars["alt_assignments"], verbose=False, 
-                            by_ss=True)
-    logging.info("Calculated the %d next best assignments for each spin system", 
-                 a.pars["alt_assignments"])
-    a.alt_assign_df.to_csv(args.output_file, sep="\t", float_format="%.3f", 
+def build_parser():
+    """Make the argument parser used by the command line and by runNAPS()"""
+    parser = argparse.ArgumentParser(description="NAPS (NMR Assignments from Predicted Shifts)")
+    parser.add_argument("shift_file",
+                        help="A table of observed chemical shifts.")
+    parser.add_argument("pred_file",
+                        help="A table of predicted chemical shifts.")
+    parser.add_argument("output_file", nargs="?", default=None,
+                        help="The file results will be written to. If not "+
+                        "given, results are only returned by runNAPS().")
+
+    parser.add_argument("--shift_type",
+                        choices=["naps", "ccpn", "sparky",
+                                 "xeasy", "nmrpipe", "nmrstar", "test",
+                                 "test_nmrstar"],
+                        default="naps",
+                        help="The format of the observed shift file. The 'test' "+
+                        "options are for assigned testset data, either as a "+
+                        "simplified BMRB table or a raw NMR-STAR file.")
+    parser.add_argument("--pred_type",
+                        choices=["shiftx2", "sparta+"],
+                        default="shiftx2",
+                        help="The format of the predicted shifts")
+
+    parser.add_argument("--ensemble", nargs="+", default=None,
+                        help="Predicted shift files for the other models of an "+
+                        "ensemble (eg. an NMR ensemble or MD snapshots). All "+
+                        "models are scored together, as set by ensemble_method "+
+                        "in the config file.")
+
+    parser.add_argument("--pred_structure", default=None,
+                        help="PDB file of the structure the shifts were "+
+                        "predicted from. Its HELIX and SHEET records give the "+
+                        "secondary structure used with atom_sd_table.")
+
+    parser.add_argument("-c", "--config_file",
+                        default="/Users/aph516/GitHub/NAPS/python/config.txt",
+                        help="A file containing parameters for the analysis.")
+    parser.add_argument("-l", "--log_file", default=None,
+                        help="A file logging information will be written to.")
+    #parser.add_argument("--delta_correlation", action="store_true",
+    #                    help="If set, account for correlations between prediction errors of different atom types")
+    parser.add_argument("-a", "--alt_assignments", default=-1, type=int,
+                        help="The number of alternative assignments to generate, "+
+                        "in addition to the highest ranked.")
+    parser.add_argument("--plot_file",
+                        default="/Users/aph516/GitHub/NAPS/plots/plot",
+                        help="A filename for any output plots.")
+    parser.add_argument("--profile", default=None,
+                        help="A file a JSON report of the time taken by each "+
+                        "stage will be written to.")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="If set, also record the peak memory allocated in "+
+                        "each stage (slower).")
+    parser.add_argument("--profile_dir", default=None,
+                        help="A directory cProfile dumps for each stage will be "+
+                        "written to.")
+    return(parser)
+
+def runNAPS(args, pars=None, preds=None, callback=None):
+    """Run the NAPS analysis.
+
+    args: either a list of command line style arguments (eg.
+        ["shifts.txt", "preds.cs", "out.txt", "--shift_type", "ccpn"]), or an
+        argparse.Namespace from build_parser(). sys.argv is never used. In a
+        Namespace, shift_file, pred_file and plot_file may also be file-like
+        objects, so nothing needs to be read from or written to disk.
+    pars: optional dict of parameters that override those in the config file
+    preds: optional DataFrame of predicted shifts, as previously returned by 
+        NAPS_assigner.import_pred_shifts() with the same config. If given, 
+        pred_file isn't read.
+    callback: optional function, called as callback(event, data) to report 
+        progress. Events are "stage" (data is the stage name) as each stage 
+        starts, "assignment" (the best assignment DataFrame) as soon as it's 
+        available, "alt_assignments" (the alternative assignment DataFrame) 
+        and "plot" (the plot_file).
+
+    Returns a dict with the assignment DataFrame ("assign_df"), the
+    alternative assignments ("alt_assign_df", or None if they weren't
+    calculated), the table written to the output file ("results") and the
+    NAPS_assigner object ("assigner").
+    """
+    if not isinstance(args, argparse.Namespace):
+        args = build_parser().parse_args(list(args))
+    if args.log_file is None:
+        return(_runNAPS(args, pars, preds, callback))
+
+    # Write all log messages to log_file while the analysis runs
+    handler = logging.FileHandler(args.log_file, mode="w")
+    handler.setFormatter(logging.Formatter(
+            "%(levelname)s %(asctime)s %(module)s %(funcName)s %(message)s"))
+    logger = logging.getLogger()
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        return(_runNAPS(args, pars, preds, callback))
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        handler.close()
+
+def _runNAPS(args, pars, preds, callback):
+    """Run the NAPS analysis, with args already parsed (see runNAPS())"""
+    # Report progress to the caller, if they asked for it
+    def report(event, data):
+        if callback is not None:
+            callback(event, data)
+
+    # Set up profiling
+    prof = Profiler(enabled=(args.profile is not None or
+                             args.profile_dir is not None),
+                    memory=args.profile_memory, cprofile_dir=args.profile_dir,
+                    callback=lambda name: report("stage", name))
+
+    #### Set up the NAPS_assigner object
+    a = NAPS_assigner()
+
+    # Import config file
+    a.read_config_file(args.config_file)
+    logging.info("Read in configuration from %s.", args.config_file)
+
+    # Account for any arguments that overide config file
+    if pars is not None:
+        a.pars.update(pars)
+    if args.alt_assignments>=0:
+        a.pars["alt_assignments"] = args.alt_assignments
+    #if args.delta_correlation:
+    #    a.pars["prob_method"] = "delta_correlation"
+
+    # Import observed and predicted shifts
+    importer = NAPS_importer()
+
+    with prof.stage("import_obs_shifts"):
+        if args.shift_type=="test":
+            importer.import_testset_shifts(args.shift_file)
+        elif args.shift_type=="test_nmrstar":
+            importer.import_testset_shifts(args.shift_file, filetype="nmrstar")
+        else:
+            importer.import_obs_shifts(args.shift_file, args.shift_type, SS_num=False)
+        a.obs = importer.obs
+    logging.info("Read in %d spin systems from %s.",
+                 len(a.obs["SS_name"]), args.shift_file)
+
+    if preds is None:
+        pred_files = args.pred_file
+        if args.ensemble:
+            pred_files = [args.pred_file] + list(args.ensemble)
+        with prof.stage("import_pred_shifts"):
+            a.import_pred_shifts(pred_files, args.pred_type)
+        logging.info("Read in %d predicted residues from %s.",
+                     len(a.preds["Res_name"]), pred_files)
+    else:
+        a.preds = preds
+    if args.pred_structure is not None:
+        a.add_pred_sec_struc(args.pred_structure)
+        logging.info("Read in secondary structure from %s.", 
+                     args.pred_structure)
+
+    #### Do the analysis
+    with prof.stage("add_dummy_rows"):
+        a.add_dummy_rows()
+    with prof.stage("calc_log_prob_matrix"):
+        a.calc_log_prob_matrix2(sf=1, verbose=False)
+    logging.info("Calculated log probability matrix (%dx%d).",
+                 a.log_prob_matrix.shape[0], a.log_prob_matrix.shape[1])
+    with prof.stage("find_best_assignments"):
+        if a.pars["use_fragments"]:
+            matching = a.find_fragment_assignments()
+        else:
+            matching = a.find_best_assignments()
+    logging.info("Calculated best assignment.")
+    if a.pars["seq_link_weight"]>0:
+        with prof.stage("optimise_pairwise"):
+            matching = a.optimise_pairwise(matching, 
+                                           seed=a.pars["seq_link_seed"])
+        logging.info("Optimised assignment with sequential link scores.")
+    if a.pars["refine_consistency"]:
+        with prof.stage("refine_consistency"):
+            # Start from the fragment or pairwise assignment, if there is one
+            if a.pars["use_fragments"] or a.pars["seq_link_weight"]>0:
+                matching = a.refine_consistency(matching, threshold=0.1)
+            else:
+                matching = a.refine_consistency(threshold=0.1)
+        logging.info("Refined assignment consistency.")
+    with prof.stage("make_assign_df"):
+        a.make_assign_df(matching, set_assign_df=True)
+    with prof.stage("check_assignment_consistency"):
+        a.check_assignment_consistency(threshold=0.1)
+    logging.info("Checked assignment consistency.")
+    report("assignment", a.assign_df)
+
+    alt_assign_df = None
+    if a.pars["alt_assignments"]>0:
+        with prof.stage("find_alt_assignments"):
+            a.find_alt_assignments(N=a.pars["alt_assignments"], verbose=False,
+                                   by_ss=True)
+        logging.info("Calculated the %d next best assignments for each spin system",
+                     a.pars["alt_assignments"])
+        alt_assign_df = a.alt_assign_df
+        report("alt_assignments", alt_assign_df)
+        results = alt_assign_df
+    else:
+        results = a.assign_df
+
+    if args.output_file is not None:
+        with prof.stage("write_results"):
+            results.to_csv(args.output_file, sep="\t", float_format="%.3f",
                            index=False)
-else:
-    a.assign_df.to_csv(args.output_file, sep="\t", float_format="%.3f", 
-                       index=False)
-    
-logging.info("Wrote results to %s", args.output_file)
-
-#### Make some plots
-if a.pars["plot_strips"]:
-    plt = a.plot_strips()
-    plt.save(args.plot_file, height=210, width=max(297,297/80*a.assign_df["SS_name"].count()), 
-             units="mm", limitsize=False)
-    logging.info("Wrote strip plot to %s", args.plot_file)
\ No newline at end of file
+        logging.info("Wrote results to %s", args.output_file)
+
+    #### Make some plots
+    if a.pars["plot_strips"]:
+        with prof.stage("plot_strips"):
+            # A plot_file that isn't a path (eg. a BytesIO buffer) gets a png
+            fmt = {} if isinstance(args.plot_file, str) else {"format":"png"}
+            if (a.pars["plot_method"]=="matplotlib" and 
+                a.pars["plot_tile_size"] > 0):
+                # plot_file is a multi-page pdf or a directory of tiles
+                a.save_strip_tiles(args.plot_file, a.pars["plot_tile_size"],
+                                   a.pars["plot_workers"])
+            elif a.pars["plot_method"]=="matplotlib":
+                fig = a.plot_strips_mpl()
+                fig.savefig(args.plot_file, **fmt)
+            else:
+                plt = a.plot_strips()
+                plt.save(args.plot_file, height=210, width=max(297,297/80*a.assign_df["SS_name"].count()),
+                         units="mm", limitsize=False, **fmt)
+        logging.info("Wrote strip plot to %s", args.plot_file)
+        report("plot", args.plot_file)
+
+    #### Write the profiling report
+    if args.profile is not None:
+        prof.write_json(args.profile)
+        logging.info("Wrote profiling report to %s", args.profile)
+
+    return({"assign_df":a.assign_df, "alt_assign_df":alt_assign_df,
+            "results":results, "assigner":a})
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+
+    # Log errors to stderr, unless runNAPS() is logging to a file
+    if args.log_file is None:
+        logging.basicConfig(level=logging.ERROR)
+
+    runNAPS(args)
@@ -6,36 +6,443 @@ Created on Mon Nov 19 10:36:07 2018
 @author: aph516
 """
 
+import io
+import os
+import json
 import numpy as np
 import pandas as pd
-from plotnine import *
-from scipy.stats import norm, multivariate_normal
+# plotnine and scipy.stats are slow to import, so they are imported in the 
+# methods that use them
 from scipy.optimize import linear_sum_assignment
-from math import isnan, log10, sqrt
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+import heapq
+import random
+from math import isnan, log10, sqrt, exp
 from copy import deepcopy
 #from Bio.SeqUtils import seq1
 from distutils.util import strtobool
 import logging
+from NAPS_importer import (AA_all, aa_str_to_mask, shifts_long_to_wide, 
+                           read_pdb_sec_struc, read_text)
+from NAPS_lap import LAP_solver
+from NAPS_fragments import build_fragments, place_fragments
+
+def solve_lap_blocks(score, row_blocks, col_blocks):
+    """Find the maximum score matching, solving each block independently.
+    
+    Rows and columns with the same block label (eg. the same chain) are first 
+    matched with each other as a separate, smaller assignment problem. Any 
+    rows and columns left over, including those with no block label (eg. 
+    dummies), are then matched in one final assignment problem.
+    
+    score: 2D array of scores to be maximised
+    row_blocks, col_blocks: block label for each row/column. NaN or None 
+        means the row/column is not part of any block.
+    
+    Returns (row_ind, col_ind), as for linear_sum_assignment.
+    """
+    score = np.asarray(score, dtype=float)
+    n_rows, n_cols = score.shape
+    codes, uniques = pd.factorize(pd.concat([pd.Series(row_blocks), 
+                                             pd.Series(col_blocks)], 
+                                            ignore_index=True))
+    row_codes, col_codes = codes[:n_rows], codes[n_rows:]
+    
+    # Group the row and column indices by block
+    def group_by_block(block_codes):
+        order = np.argsort(block_codes, kind="stable")
+        bounds = np.searchsorted(block_codes[order], np.arange(len(uniques)+1))
+        return([order[bounds[b]:bounds[b+1]] for b in range(len(uniques))])
+    
+    blocks = [(rows, cols) for rows, cols in zip(group_by_block(row_codes), 
+                                                  group_by_block(col_codes))
+              if len(rows)>0 and len(cols)>0]
+    
+    def solve_block(block):
+        rows, cols = block
+        r, c = linear_sum_assignment(-1*score[np.ix_(rows, cols)])
+        return(rows[r], cols[c])
+    
+    results = [solve_block(block) for block in blocks]
+    
+    row_match = np.full(n_rows, -1)
+    for rows, cols in results:
+        row_match[rows] = cols
+    
+    # Match everything that's left over
+    rows = np.flatnonzero(row_match<0)
+    cols = np.setdiff1d(np.arange(n_cols), row_match[row_match>=0])
+    if len(rows)>0 and len(cols)>0:
+        r, c = linear_sum_assignment(-1*score[np.ix_(rows, cols)])
+        row_match[rows[r]] = cols[c]
+    
+    row_ind = np.flatnonzero(row_match>=0)
+    return(row_ind, row_match[row_ind])
+
+def find_candidate_components(score, cutoff, row_valid=None, col_valid=None):
+    """Split the bipartite graph of plausible (row, column) pairs into 
+    connected components.
+    
+    Pairs with a score below cutoff are pruned (except for the best pair for 
+    each row and column), and the remaining pairs are treated as edges of a 
+    graph. Rows and columns in different components can't be matched to each 
+    other without using a pruned pair, so each component can be assigned 
+    separately (see solve_lap_blocks). Any rows or columns a component 
+    can't absorb are matched afterwards, along with the dummies.
+    
+    This is a heuristic, not an exact decomposition: the best matching may 
+    need some of the pruned pairs, and then the result is worse than solving 
+    the whole problem (eg. on the A003 testset protein, a cutoff of -20 gives 
+    154 correct residues rather than 157 without the fallback in 
+    find_best_assignments()). Low cutoffs (eg. -80) prune less and are 
+    usually exact.
+    
+    score: 2D array of scores (eg. log probabilities)
+    cutoff: pairs with a score below this are pruned
+    row_valid, col_valid: optional boolean arrays. Invalid rows/columns (eg. 
+        dummies) are left out of the graph.
+    
+    Returns (row_labels, col_labels): the component of each row and column, 
+    or NaN for rows/columns with no remaining edges.
+    """
+    score = np.array(score, dtype=float)
+    n_rows, n_cols = score.shape
+    if row_valid is not None:
+        score[~np.asarray(row_valid, dtype=bool),:] = -np.inf
+    if col_valid is not None:
+        score[:,~np.asarray(col_valid, dtype=bool)] = -np.inf
+    
+    edges = score>=cutoff
+    # Always keep the best pair for each row and column, so that nothing is 
+    # left without a candidate
+    edges[np.arange(n_rows), score.argmax(axis=1)] = True
+    edges[score.argmax(axis=0), np.arange(n_cols)] = True
+    edges &= np.isfinite(score)
+    
+    # Rows are nodes 0..n_rows-1, columns are nodes n_rows..n_rows+n_cols-1
+    r, c = np.nonzero(edges)
+    graph = coo_matrix((np.ones(len(r)), (r, c+n_rows)), 
+                       shape=(n_rows+n_cols, n_rows+n_cols))
+    n_comp, labels = connected_components(graph, directed=False)
+    
+    labels = labels.astype(float)
+    labels[:n_rows][~edges.any(axis=1)] = np.NaN
+    labels[n_rows:][~edges.any(axis=0)] = np.NaN
+    logging.debug("Found %d candidate components (cutoff %f).", 
+                  len(np.unique(labels[~np.isnan(labels)])), cutoff)
+    return(labels[:n_rows], labels[n_rows:])
+
+def find_residue_links(res_N, chain=None):
+    """Find the positions of the preceding and following residue for each 
+    residue.
+    
+    res_N: residue numbers. NaN for residues that shouldn't be linked (eg. 
+        dummies).
+    chain: optional chain identifiers. Residues are only linked within a chain.
+    
+    Returns (res_prev, res_next), integer arrays with -1 where there is no 
+    such residue.
+    """
+    res_N = np.asarray(res_N, dtype=float)
+    n = len(res_N)
+    res_prev = np.full(n, -1)
+    res_next = np.full(n, -1)
+    valid = ~np.isnan(res_N)
+    if not valid.any():
+        return(res_prev, res_next)
+    
+    # Combine chain and residue number into a single integer key
+    seq = res_N[valid].astype(np.int64)
+    seq = seq - seq.min() + 1
+    if chain is None:
+        chain_codes = np.zeros(len(seq), dtype=np.int64)
+    else:
+        chain_codes, _ = pd.factorize(np.asarray(chain)[valid])
+    key = chain_codes*(seq.max()+2) + seq
+    
+    pos = pd.Series(np.flatnonzero(valid), index=key)
+    pos = pos[~pos.index.duplicated()]
+    res_prev[valid] = pos.reindex(key-1).fillna(-1).values
+    res_next[valid] = pos.reindex(key+1).fillna(-1).values
+    return(res_prev, res_next)
+
+def consistency_kernel(res_ss, obs_i, obs_m1, res_prev, res_next, 
+                       threshold=0.1, res_valid=None, subset=None):
+    """Compare the shifts of sequentially adjacent residues, given a matching.
+    
+    This is the array equivalent of check_assignment_consistency, and is fast 
+    enough to call repeatedly for many candidate matchings.
+    
+    res_ss: integer array giving the spin system (row of obs_i and obs_m1) 
+        matched to each residue, or -1 if none.
+    obs_i, obs_m1: arrays of the i and i-1 shifts of each spin system, with 
+        one column per atom type (eg. C, CA, CB and Cm1, CAm1, CBm1).
+    res_prev, res_next: output of find_residue_links
+    threshold: Minimum carbon shift difference for sequential residues to
+        count as mismatched
+    res_valid: optional boolean array. Results for invalid residues (eg. 
+        dummies) are set to NaN.
+    subset: optional array of residue positions. If given, results are only 
+        calculated for these residues (eg. those affected by a change to the 
+        matching).
+    
+    Returns a dict of arrays, with keys Max_mismatch_prev, Max_mismatch_next, 
+    Num_good_links_prev and Num_good_links_next.
+    """
+    # Add a row of NaN to the shift arrays, so index -1 means missing
+    nan_row = np.full((1, obs_i.shape[1]), np.NaN)
+    obs_i = np.vstack([obs_i, nan_row])
+    obs_m1 = np.vstack([obs_m1, nan_row])
+    
+    res_ss = np.asarray(res_ss)
+    if subset is not None:
+        res_prev = res_prev[subset]
+        res_next = res_next[subset]
+        if res_valid is not None:
+            res_valid = res_valid[subset]
+        ss = res_ss[subset]
+    else:
+        ss = res_ss
+    ss_prev = np.where(res_prev>=0, res_ss[res_prev], -1)
+    ss_next = np.where(res_next>=0, res_ss[res_next], -1)
+    d_prev = obs_m1[ss] - obs_i[ss_prev]
+    d_next = obs_i[ss] - obs_m1[ss_next]
+    
+    links = {"Max_mismatch_prev": np.fmax.reduce(d_prev, axis=1),
+             "Max_mismatch_next": np.fmax.reduce(d_next, axis=1),
+             "Num_good_links_prev": (d_prev<threshold).sum(axis=1).astype(float),
+             "Num_good_links_next": (d_next<threshold).sum(axis=1).astype(float)}
+    if res_valid is not None:
+        for k in links:
+            links[k][~res_valid] = np.NaN
+    return(links)
+
+def calc_seq_link_matrix(obs_i, obs_m1, sd=0.1, tol=0.2):
+    """Score how well each spin system could follow each other spin system.
+    
+    The score for spin system b following spin system a compares the i-1 
+    shifts of b (eg. Cm1, CAm1, CBm1) with the i shifts of a (C, CA, CB). 
+    Each atom type contributes a Gaussian log likelihood ratio, relative to a 
+    difference of tol, and clipped at zero. So atoms that match to within tol 
+    are rewarded, and larger differences or missing shifts score zero.
+    
+    Most pairs of spin systems score zero, so rather than comparing all N^2 
+    pairs, the i shifts of each atom type are sorted and the pairs within tol 
+    are found by binary search.
+    
+    obs_i, obs_m1: arrays of the i and i-1 shifts of each spin system, with 
+        one column per atom type.
+    sd: standard deviation of the difference between matching shifts
+    tol: shift difference that scores zero
+    
+    Returns an (N x N) sparse matrix, where element [a,b] is the score for b 
+    following a.
+    """
+    n = obs_i.shape[0]
+    pairs = []
+    for k in range(obs_i.shape[1]):
+        x = obs_i[:,k]
+        y = obs_m1[:,k]
+        a_valid = np.flatnonzero(~np.isnan(x))
+        order = a_valid[np.argsort(x[a_valid], kind="stable")]
+        x_sorted = x[order]
+        b_valid = np.flatnonzero(~np.isnan(y))
+        lo = np.searchsorted(x_sorted, y[b_valid]-tol, side="left")
+        hi = np.searchsorted(x_sorted, y[b_valid]+tol, side="right")
+        counts = hi-lo
+        # Expand each [lo, hi) range into the positions it contains
+        start = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        a = order[start + np.arange(counts.sum())]
+        b = np.repeat(b_valid, counts)
+        pairs.append(a*n + b)
+    pairs = np.unique(np.concatenate(pairs)) if pairs else np.array([], dtype=int)
+    a, b = pairs // n, pairs % n
+    
+    d = obs_m1[b,:] - obs_i[a,:]
+    score = (tol**2 - d**2)/(2*sd**2)
+    score = np.where(np.isnan(score), 0, np.maximum(score, 0)).sum(axis=1)
+    keep = score>0
+    return(csr_matrix((score[keep], (a[keep], b[keep])), shape=(n, n)))
+
+def strip_plot_figure(assign_df, atom_list=["C","Cm1","CA","CAm1","CB","CBm1"],
+                      res_range=None):
+    """ Draw a strip plot of assign_df as a matplotlib Figure
+    
+    This is used by NAPS_assigner.plot_strips_mpl(), and is a module level 
+    function so that tiles of a large assignment can be drawn in separate 
+    worker processes.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.collections import LineCollection
+    
+    if res_range is not None:
+        assign_df = assign_df.loc[(assign_df["Res_N"]>=res_range[0]) & 
+                                  (assign_df["Res_N"]<=res_range[1]),:]
+    
+    # Order the x axis in the same way as plot_strips()
+    x_name = (assign_df["Res_name"].str.pad(6) + "_(" + 
+              assign_df["SS_name"].astype(str) + ")")
+    assign_df = assign_df.assign(x_name=x_name).sort_values("x_name")
+    n = len(assign_df.index)
+    x = np.arange(n)
+    dummy_res = assign_df["Dummy_res"].astype(bool).values
+    
+    # Find the position of the following residue, for sequential links
+    res_key = assign_df["Res_N"].astype(str)
+    if "Chain" in assign_df.columns:
+        res_key = assign_df["Chain"].astype(str) + ":" + res_key
+    next_key = assign_df["Res_N"].add(1).astype(str)
+    if "Chain" in assign_df.columns:
+        next_key = assign_df["Chain"].astype(str) + ":" + next_key
+    position = pd.Series(x, index=res_key.values)
+    position = position[~position.index.duplicated()]
+    next_x = position.reindex(next_key.values).values
+    has_next = ~np.isnan(next_x) & ~dummy_res
+    next_x = np.where(has_next, next_x, 0).astype(int)
+    has_next &= ~dummy_res[next_x]
+    
+    atoms = [a for a in ["C","CA","CB"] if 
+             (a in atom_list and a in assign_df.columns) or 
+             (a+"m1" in atom_list and a+"m1" in assign_df.columns)]
+    
+    width, height = max(297, 297/80*n)/25.4, 210/25.4     # inches
+    fig = Figure(figsize=(width, height))
+    # Fixed margins are much faster than tight_layout() with many labels
+    fig.subplots_adjust(left=1.1/width, right=1-0.2/width, 
+                        bottom=1.2/height, top=1-0.2/height, hspace=0.05)
+    axes = fig.subplots(len(atoms), 1, squeeze=False)[:,0]
+    # Colours match scale_colour_brewer(palette="Set1") in plot_strips()
+    colours = {"-1":"#E41A1C", "0":"#377EB8"}
+    nan = np.full(n, np.NaN)
+    for ax, atom in zip(axes, atoms):
+        y_i = (assign_df[atom].values.astype(float) 
+               if atom in atom_list and atom in assign_df.columns else nan)
+        y_m1 = (assign_df[atom+"m1"].values.astype(float) 
+                if atom+"m1" in atom_list and atom+"m1" in assign_df.columns 
+                else nan)
+        
+        # Dashed lines between the i and i-1 shifts of each spin system
+        both = ~np.isnan(y_i) & ~np.isnan(y_m1)
+        segs = np.stack([np.column_stack([x[both], y_i[both]]), 
+                         np.column_stack([x[both], y_m1[both]])], axis=1)
+        ax.add_collection(LineCollection(segs, colors="black", 
+                                         linestyles="dashed", linewidths=0.5))
+        
+        # Solid lines from the i shift of each residue to the i-1 shift of 
+        # the following residue
+        link = has_next & ~np.isnan(y_i) & ~np.isnan(y_m1[next_x])
+        segs = np.stack([np.column_stack([x[link], y_i[link]]), 
+                         np.column_stack([next_x[link], y_m1[next_x[link]]])], 
+                        axis=1)
+        ax.add_collection(LineCollection(segs, colors="black", 
+                                         linewidths=0.5))
+        
+        for i, y in [("-1", y_m1), ("0", y_i)]:
+            for dummy, marker in [(False, "o"), (True, "x")]:
+                mask = (dummy_res==dummy) & ~np.isnan(y)
+                ax.scatter(x[mask], y[mask], c=colours[i], marker=marker, 
+                           s=12, zorder=3, 
+                           label="i="+i if not dummy else None)
+        
+        ax.invert_yaxis()
+        ax.set_ylabel(atom)
+        ax.set_xlim(-1, n)
+        ax.set_xticks([])
+        ax.grid(True, axis="y", linewidth=0.3)
+    
+    # Only the bottom facet has x axis labels
+    axes[0].legend(loc="upper right")
+    axes[-1].set_xticks(x)
+    axes[-1].set_xticklabels(assign_df["x_name"], rotation=90, fontsize=6)
+    axes[-1].set_xlabel("Residue name")
+    fig.supylabel("Chemical shift (ppm)", x=0.12/width)
+    
+    return(fig)
+
+def split_strip_tiles(assign_df, tile_size):
+    """ Split assign_df into tiles of tile_size rows, in strip plot order
+    
+    Sequential links between the last residue of one tile and the first 
+    residue of the next are not drawn.
+    
+    Returns a list of DataFrames.
+    """
+    x_name = (assign_df["Res_name"].str.pad(6) + "_(" + 
+              assign_df["SS_name"].astype(str) + ")")
+    assign_df = assign_df.assign(x_name=x_name).sort_values("x_name")
+    n = len(assign_df.index)
+    return([assign_df.iloc[i:i+tile_size,:].drop(columns="x_name") 
+            for i in range(0, max(n,1), tile_size)])
+
+def strip_tile_index(tile_dfs):
+    """ Describe each tile from split_strip_tiles
+    
+    Returns a list with a dict for each tile giving its number, the number of 
+    residues and the first and last residue names.
+    """
+    index = []
+    for i, tile_df in enumerate(tile_dfs):
+        names = tile_df["Res_name"].astype(str).str.strip()
+        index.append({"tile": i, "n_res": len(tile_df.index),
+                      "first": names.iloc[0] if len(names) else None,
+                      "last": names.iloc[-1] if len(names) else None})
+    return(index)
+
+def render_strip_tile(tile_df, atom_list, fmt=None):
+    """ Draw one tile of a strip plot
+    
+    If fmt is None the Figure is returned, otherwise the image data (bytes) in 
+    that format.
+    """
+    fig = strip_plot_figure(tile_df, atom_list)
+    if fmt is None:
+        return(fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt)
+    return(buf.getvalue())
+
 
 class NAPS_assigner:
     # Functions
     def __init__(self):
         self.obs = None
         self.preds = None
+        self.pred_ensemble = None
+        self.atom_sd_table = None
+        self.atom_sd_lookup = None
         self.log_prob_matrix = None
         self.assign_df = None
         self.alt_assign_df = None
         self.best_match_indexes = None
+        self.consistency_arrays = None
+        self.link_matrix = None
+        self.link_matrix_source = None
         self.pars = {"pred_offset": 0,
                 "prob_method": "pdf",
                 "pred_correction": False,
+                "lin_model_file": "../config/lin_model_shiftx2.csv",
                 "delta_correlation": False,
                 "alt_assignments": 1,
                 "atom_set": {"H","N","HA","C","CA","CB","Cm1","CAm1","CBm1"},
                 "atom_sd": {'H':0.1711, 'N':1.1169, 'HA':0.1231,
                             'C':0.5330, 'CA':0.4412, 'CB':0.5163,
                             'Cm1':0.5530, 'CAm1':0.4412, 'CBm1':0.5163},
-                "plot_strips": False}
+                "atom_sd_table": None,
+                "ensemble_method": "mean",
+                "plot_strips": False,
+                "plot_method": "plotnine",
+                "plot_tile_size": 0,
+                "plot_workers": 1,
+                "component_cutoff": None,
+                "refine_consistency": False,
+                "seq_link_weight": 0,
+                "seq_link_sd": 0.1,
+                "seq_link_tol": 0.2,
+                "seq_link_seed": 0,
+                "use_fragments": False,
+                "fragment_min_length": 3,
+                "fragment_min_margin": 20.0}
             
     def read_config_file(self, filename):
         config = pd.read_table(filename, sep="\s+", comment="#", header=None,
@@ -44,21 +451,98 @@ class NAPS_assigner:
         self.pars["pred_offset"] = int(config["pred_offset"])
         self.pars["prob_method"] = config["prob_method"]
         self.pars["pred_correction"] = bool(strtobool(config["pred_correction"]))
+        if "lin_model_file" in config:
+            # Relative paths are relative to the config file
+            self.pars["lin_model_file"] = os.path.join(
+                    os.path.dirname(str(filename)), config["lin_model_file"])
         self.pars["delta_correlation"] = bool(strtobool(config["delta_correlation"]))
         self.pars["alt_assignments"] = int(config["alt_assignments"])
         self.pars["atom_set"] = {s.strip() for s in config["atom_set"].split(",")}
         tmp = [s.strip() for s in config["atom_sd"].split(",")]
         self.pars["atom_sd"] = dict([(x.split(":")[0], float(x.split(":")[1])) for x in tmp])
+        if ("atom_sd_table" in config and 
+            str(config["atom_sd_table"]).lower()!="none"):
+            # Relative paths are relative to the config file
+            self.pars["atom_sd_table"] = os.path.join(
+                    os.path.dirname(str(filename)), config["atom_sd_table"])
+            self.read_atom_sd_table(self.pars["atom_sd_table"])
+        if "ensemble_method" in config:
+            self.pars["ensemble_method"] = config["ensemble_method"]
         self.pars["plot_strips"] = bool(strtobool(config["plot_strips"]))
+        if "plot_method" in config:
+            self.pars["plot_method"] = config["plot_method"]
+        for key in ["plot_tile_size", "plot_workers"]:
+            if key in config:
+                self.pars[key] = int(config[key])
+        if "component_cutoff" in config:
+            if str(config["component_cutoff"]).lower()=="none":
+                self.pars["component_cutoff"] = None
+            else:
+                self.pars["component_cutoff"] = float(config["component_cutoff"])
+        if "refine_consistency" in config:
+            self.pars["refine_consistency"] = bool(strtobool(
+                    config["refine_consistency"]))
+        for key in ["seq_link_weight", "seq_link_sd", "seq_link_tol",
+                    "fragment_min_margin"]:
+            if key in config:
+                self.pars[key] = float(config[key])
+        if "seq_link_seed" in config:
+            self.pars["seq_link_seed"] = int(config["seq_link_seed"])
+        if "use_fragments" in config:
+            self.pars["use_fragments"] = bool(strtobool(config["use_fragments"]))
+        if "fragment_min_length" in config:
+            self.pars["fragment_min_length"] = int(config["fragment_min_length"])
         return(self.pars)
     
+    def read_atom_sd_table(self, filename):
+        """ Read a table of prediction error standard deviations for each atom 
+        type and residue type, as made by NAPS_fit.py
+        
+        The table has columns Atom_type, Res_type, Sec_struc and SD. Rows with 
+        an empty Sec_struc apply to any secondary structure. Atom types and 
+        residues that aren't in the table use pars["atom_sd"].
+        """
+        table = pd.read_csv(filename, keep_default_na=False, 
+                            na_values={"SD":[""], "N":[""]})
+        if "Sec_struc" not in table.columns:
+            table["Sec_struc"] = ""
+        self.atom_sd_table = table
+        
+        # For each atom type, Series of sds indexed by residue type, and by 
+        # residue type and secondary structure (eg. "A:H"), so the lookup 
+        # for each residue is a single reindex when scoring
+        self.atom_sd_lookup = {}
+        for atom, tmp in table.groupby("Atom_type"):
+            by_type = tmp.loc[tmp["Sec_struc"]==""]
+            by_ss = tmp.loc[tmp["Sec_struc"]!=""]
+            self.atom_sd_lookup[atom] = (
+                    pd.Series(by_type["SD"].values, index=by_type["Res_type"]),
+                    pd.Series(by_ss["SD"].values, 
+                              index=by_ss["Res_type"]+":"+by_ss["Sec_struc"]))
+        return(self.atom_sd_table)
+    
     def import_pred_shifts(self, input_file, filetype, offset=None):
         """ Import predicted chemical shifts from a ShiftX2 results file.
         
+        input_file: path to the predictions, or a file-like object with the 
+            same contents. This can also be a list, with predictions for each 
+            model of an ensemble (eg. an NMR ensemble or MD snapshots). See 
+            combine_pred_ensemble().
         filetype: either "shiftx2" or "sparta+"
         offset: an optional integer to add to the ShiftX2 residue number.
+        
+        If the predictions contain more than one chain, residues are keyed by 
+        (chain, number), the chain is prefixed to Res_name, and the i-1 shifts 
+        are only taken from within the same chain.
         """
         
+        if isinstance(input_file, (list, tuple)):
+            models = [self.import_pred_shifts(f, filetype, offset) 
+                      for f in input_file]
+            if any(m is None for m in models):
+                return(None)
+            return(self.combine_pred_ensemble(models))
+        
         # If no offset value is defined, use the default one
         if offset==None:
             offset = self.pars["pred_offset"]
@@ -66,24 +550,29 @@ class NAPS_assigner:
         if filetype == "shiftx2":
             preds_long = pd.read_csv(input_file)
             if any(preds_long.columns == "CHAIN"):
-                if len(preds_long["CHAIN"].unique())>1:
-                    print("Chain identifier dropped - if multiple chains are "+
-                          "present in the predictions, they will be merged.")
-                preds_long = preds_long.drop("CHAIN", axis=1)     
-            preds_long = preds_long.reindex(columns=["NUM","RES","ATOMNAME",
-                                                     "SHIFT"])  
-            preds_long.columns = ["Res_N","Res_type","Atom_type","Shift"]
+                preds_long = preds_long.reindex(columns=["NUM","RES","ATOMNAME",
+                                                         "SHIFT","CHAIN"])
+                preds_long.columns = ["Res_N","Res_type","Atom_type","Shift",
+                                      "Chain"]
+                preds_long["Chain"] = preds_long["Chain"].fillna("").astype(str)
+                # Chain information is only needed if there's more than one
+                if len(preds_long["Chain"].unique())<=1:
+                    preds_long = preds_long.drop("Chain", axis=1)
+            else:
+                preds_long = preds_long.reindex(columns=["NUM","RES","ATOMNAME",
+                                                         "SHIFT"])  
+                preds_long.columns = ["Res_N","Res_type","Atom_type","Shift"]
         elif filetype == "sparta+":
             # Work out where the column names and data are
-            with open(input_file, 'r') as f:
-                for num, line in enumerate(f, 1):
-                    if line.find("VARS")>-1:
-                        colnames_line = num
-                        colnames = line.split()[1:]
-                        break
+            text = read_text(input_file)
+            for num, line in enumerate(text.splitlines(), 1):
+                if line.find("VARS")>-1:
+                    colnames_line = num
+                    colnames = line.split()[1:]
+                    break
                         
-            preds_long = pd.read_table(input_file, sep="\s+", names=colnames,
-                                       skiprows=colnames_line+1)
+            preds_long = pd.read_table(io.StringIO(text), sep="\s+", 
+                                       names=colnames, skiprows=colnames_line+1)
             preds_long = preds_long[["RESID","RESNAME","ATOMNAME","SHIFT"]]
             preds_long.columns = ["Res_N","Res_type","Atom_type","Shift"]
             
@@ -97,37 +586,141 @@ class NAPS_assigner:
         preds_long["Res_N"] = preds_long["Res_N"] + offset
         preds_long.insert(1, "Res_name", (preds_long["Res_N"].astype(str) + 
                   preds_long["Res_type"]))
+        if "Chain" in preds_long.columns:
+            chain_col = "Chain"
+            preds_long["Res_name"] = preds_long["Chain"] + preds_long["Res_name"]
+        else:
+            chain_col = None
         preds_long["Res_name"] = [s.rjust(5) for s in preds_long["Res_name"]]
             
-        # Convert from long to wide format
-        preds = preds_long.pivot(index="Res_N", columns="Atom_type", 
-                                 values="Shift")
-        
-        # Add the other data back in
-        tmp = preds_long[["Res_N","Res_type","Res_name"]]
-        tmp = tmp.drop_duplicates(subset="Res_name")
-        tmp.index = tmp["Res_N"]
-        preds = pd.concat([tmp, preds], axis=1)
-        
-        # Make columns for the i-1 predicted shifts of C, CA and CB
-        preds_m1 = preds[list({"C","CA","CB","Res_type"}.
-                              intersection(preds.columns))].copy()
-        preds_m1.index = preds_m1.index+1
-        preds_m1.columns = preds_m1.columns + "m1"
-        preds = pd.merge(preds, preds_m1, how="left", 
-                         left_index=True, right_index=True)
+        # Convert from long to wide format, and make columns for the i-1 
+        # predicted shifts of C, CA and CB
+        preds = shifts_long_to_wide(preds_long, "Res_name", 
+                                    ["H","N","HA","C","CA","CB"], 
+                                    seq_col="Res_N", meta_cols=["Res_type"],
+                                    m1_cols=["C","CA","CB","Res_type"],
+                                    chain_col=chain_col)
         
         # Restrict to only certain atom types
         atom_set = {"H","N","C","CA","CB","Cm1","CAm1","CBm1","HA"}
-        preds = preds[["Res_name","Res_N","Res_type","Res_typem1"]+
+        preds = preds[["Res_name"]+([chain_col] if chain_col else [])+
+                      ["Res_N","Res_type","Res_typem1"]+
                       list(atom_set.intersection(preds.columns))]
         
         preds.index = preds["Res_name"]
         preds.index.name = None
         
         self.preds = preds
+        self.pred_ensemble = None
+        return(self.preds)
+    
+    def add_pred_sec_struc(self, pdb_file, chain=None):
+        """ Add the secondary structure of each predicted residue (and of the 
+        preceding residue) from the HELIX and SHEET records of a PDB file, as 
+        columns Sec_struc and Sec_strucm1 of self.preds. These are used to 
+        look up secondary structure specific values in the atom_sd_table.
+        
+        chain: only use this chain of the PDB file. If None and the predictions 
+            have a Chain column, each residue is looked up in its own chain. 
+            Otherwise the first chain is used.
+        """
+        res_N = self.preds["Res_N"] - self.pars["pred_offset"]
+        if chain is None and "Chain" in self.preds.columns:
+            text = read_text(pdb_file)
+            ss = pd.Series(np.NaN, index=self.preds.index, dtype=object)
+            ssm1 = pd.Series(np.NaN, index=self.preds.index, dtype=object)
+            for c, tmp in res_N.groupby(self.preds["Chain"]):
+                sec_struc = read_pdb_sec_struc(io.StringIO(text), str(c))
+                ss[tmp.index] = sec_struc.reindex(tmp.values).values
+                ssm1[tmp.index] = sec_struc.reindex((tmp-1).values).values
+            self.preds = self.preds.assign(Sec_struc=ss.values, 
+                                           Sec_strucm1=ssm1.values)
+            return(self.preds)
+        
+        sec_struc = read_pdb_sec_struc(pdb_file, chain)
+        self.preds = self.preds.assign(
+                Sec_struc=sec_struc.reindex(res_N.values).values,
+                Sec_strucm1=sec_struc.reindex((res_N-1).values).values)
+        return(self.preds)
+    
+    def combine_pred_ensemble(self, models):
+        """ Combine predictions for each model of an ensemble
+        
+        models: list of preds DataFrames, as made by import_pred_shifts()
+        
+        The shifts are stacked into a (models x residues x atoms) array in 
+        self.pred_ensemble, with the residues of the first model. self.preds 
+        is set to the mean over the models, so it can be used in the same way 
+        as for a single prediction. How the spread of the ensemble is used 
+        when scoring depends on pars["ensemble_method"] (see 
+        calc_log_prob_matrix2()).
+        """
+        preds = models[0].copy()
+        atoms = [a for a in preds.columns if a in 
+                 {"H","N","HA","C","CA","CB","Cm1","CAm1","CBm1"}]
+        shifts = np.stack([m.reindex(index=preds.index, columns=atoms).values.
+                           astype(float) for m in models])
+        
+        # Mean without warnings for shifts that are missing from every model
+        n = (~np.isnan(shifts)).sum(axis=0)
+        mean = np.where(n>0, np.nansum(shifts, axis=0)/np.maximum(n,1), np.NaN)
+        preds[atoms] = mean
+        
+        self.preds = preds
+        self.pred_ensemble = {"shifts":shifts, "Res_name":preds.index.copy(),
+                              "atoms":atoms}
         return(self.preds)
     
+    def ensemble_shifts(self, atom):
+        """ Predicted shifts of atom in each model of the ensemble, as an 
+        array with a row for each row of self.preds and a column for each 
+        model. Residues that aren't in the ensemble (eg. dummies) are NaN.
+        """
+        ens = self.pred_ensemble
+        pos = ens["Res_name"].get_indexer(self.preds.index)
+        result = np.full((len(pos), ens["shifts"].shape[0]), np.NaN)
+        if atom in ens["atoms"]:
+            shifts = ens["shifts"][:, :, ens["atoms"].index(atom)]
+            result[pos>=0,:] = shifts[:, pos[pos>=0]].T
+        return(result)
+    
+    def pred_atom_sd(self, atom, atom_sd=None):
+        """ Standard deviation of the prediction error of atom, for each row of 
+        self.preds
+        
+        This is atom_sd[atom], unless there is an atom_sd_table, in which case 
+        the value for the residue type (and secondary structure, if known) is 
+        used. Shifts of the i-1 residue (eg. Cm1) use the type and secondary 
+        structure of the i-1 residue. With an ensemble and 
+        pars["ensemble_method"]=="mean", the variance of the predictions over 
+        the models is also added for each residue.
+        """
+        if atom_sd is None:
+            atom_sd = self.pars["atom_sd"]
+        sd = np.full(len(self.preds.index), float(atom_sd[atom]))
+        
+        suffix = "m1" if atom.endswith("m1") else ""
+        if (self.atom_sd_table is not None and 
+            atom[:len(atom)-len(suffix)] in self.atom_sd_lookup):
+            by_type, by_ss = self.atom_sd_lookup[atom[:len(atom)-len(suffix)]]
+            res_type = self.preds["Res_type"+suffix].astype(str)
+            table_sd = by_type.reindex(res_type.values).values
+            if "Sec_struc"+suffix in self.preds.columns:
+                key = res_type + ":" + self.preds["Sec_struc"+suffix].astype(str)
+                ss_sd = by_ss.reindex(key.values).values
+                table_sd = np.where(np.isnan(ss_sd), table_sd, ss_sd)
+            sd = np.where(np.isnan(table_sd), sd, table_sd)
+        
+        if (self.pred_ensemble is not None and 
+            self.pars["ensemble_method"]=="mean"):
+            shifts = self.ensemble_shifts(atom)
+            n = (~np.isnan(shifts)).sum(axis=1)
+            mean = np.nansum(shifts, axis=1)/np.maximum(n,1)
+            ss = np.nansum((shifts - mean[:,np.newaxis])**2, axis=1)
+            var = np.where(n>1, ss/np.maximum(n-1,1), 0)
+            sd = np.sqrt(sd**2 + var)
+        return(sd)
+    
     
     def add_dummy_rows(self):
         """Add dummy rows to obs and preds to bring them to the same length.
@@ -195,6 +788,7 @@ class NAPS_assigner:
         shift_correlation: if True, the correlation between observed shift and
             prediction error is accounted for.
         """
+        from scipy.stats import norm
         
         # Use default atom_sd values if not defined
         if atom_sd==None:
@@ -237,6 +831,7 @@ class NAPS_assigner:
                 d_cov = (pd.read_csv("../data/d_cov.csv", index_col=0).
                          loc[delta.columns,delta.columns])
                 
+                from scipy.stats import multivariate_normal
                 mvn = multivariate_normal(d_mean, d_cov)
                 
                 overall_prob = mvn.logpdf(delta)
@@ -277,8 +872,9 @@ class NAPS_assigner:
                     # Otherwise, probability defaults to 0.01
                     prob["SS_classm1"] = 0.01
                     if type(pred1["Res_typem1"])==str:    # dummies have NaN
-                        prob.loc[obs["SS_classm1"].str.find(
-                                pred1["Res_typem1"])>=0, "SS_classm1"] = 1
+                        ss_mask = obs["SS_classm1"].fillna(AA_all).astype(int)
+                        prob.loc[(ss_mask & aa_str_to_mask(pred1["Res_typem1"]))>0, 
+                                 "SS_classm1"] = 1
             
                 # Calculate overall probability of each row
                 overall_prob = prob.sum(skipna=False, axis=1)
@@ -321,7 +917,14 @@ class NAPS_assigner:
             types are accounted for in the probability 
         shift_correlation: if True, the correlation between observed shift and
             prediction error is accounted for.
+        
+        If the predictions are from an ensemble (see combine_pred_ensemble()), 
+        pars["ensemble_method"] sets how it is used. With "mean", the mean 
+        prediction is scored, with the variance over the models added to 
+        atom_sd for each residue. With "mixture", each model is scored 
+        separately and the probabilities are averaged over the models.
         """
+        from scipy.stats import norm
         
         # Use default atom_sd values if not defined
         if atom_sd==None:
@@ -330,96 +933,94 @@ class NAPS_assigner:
 #                     'C':0.5330, 'CA':0.4412, 'CB':0.5163,
 #                     'Cm1':0.5530, 'CAm1':0.4412, 'CBm1':0.5163}
         
+        mixture = (self.pred_ensemble is not None and 
+                   self.pars["ensemble_method"]=="mixture")
+        
         if self.pars["pred_correction"]:
-            # This hardcoded path is bad! Need to import at an earlier stage.
-            lm_pars = pd.read_csv("../config/lin_model_shiftx2.csv", index_col=0)
+            # lin_model_file can be set in the config file (eg. to a model 
+            # fitted for SPARTA+ by NAPS_fit.py)
+            lm_pars = pd.read_csv(self.pars["lin_model_file"], index_col=0)
             self.preds_corr = {}
         
         obs = self.obs
         preds = self.preds
         atoms = self.pars["atom_set"].intersection(obs.columns)
     
-        log_prob_matrix = pd.DataFrame(0, index=obs.index, columns=preds.index)
+        log_prob = np.zeros((len(obs.index), len(preds.index)))
+        if mixture:
+            # Log probabilities for each model, in a (models x obs x preds) 
+            # array, so all models are scored in one vectorised pass
+            log_prob = np.zeros((self.pred_ensemble["shifts"].shape[0], 
+                                 len(obs.index), len(preds.index)))
         
         for atom in atoms:
-            # The most efficient way I've found to do the calculation is to 
-            # take the obs and preds shift columns for an atom, repeat each 
-            # into a matrix, then subtract these matrixes from each other. 
-            # That way, all calculations take advantage of vectorisation. 
-            # Much faster than using loops.
-            obs_atom = pd.DataFrame(obs[atom].repeat(len(obs.index)).values.
-                                reshape([len(obs.index),-1]),
-                                index=preds.index, columns=obs.index)
-            preds_atom = pd.DataFrame(preds[atom].repeat(len(preds.index)).values.
-                                reshape([len(preds.index),-1]).transpose(),
-                                index=preds.index, columns=obs.index)
-            
+            # Broadcasting a column of observed shifts against a row of 
+            # predicted shifts gives the differences between every pair as 
+            # an (obs x preds) array, so all calculations are vectorised. 
+            obs_atom = obs[atom].values.astype(float)[:,np.newaxis]
+            if mixture:
+                preds_atom = self.ensemble_shifts(atom).T[:,np.newaxis,:]
+            else:
+                preds_atom = preds[atom].values.astype(float)[np.newaxis,:]
             
             # If predicting corrections, apply a linear transformation of delta
             if self.pars["pred_correction"]:
-                preds_corr_atom = preds_atom
-                for res in preds["Res_type"].unique():
-                    if (atom+"_"+res) in lm_pars.index:
-                         
-                        grad = lm_pars.loc[(lm_pars["Atom_type"]==atom) & 
-                                           (lm_pars["Res_type"]==res),"Grad"].tolist()[0]
-                        offset = lm_pars.loc[(lm_pars["Atom_type"]==atom) & 
-                                           (lm_pars["Res_type"]==res),"Offset"].tolist()[0]
-                        preds_corr_atom.loc[preds["Res_type"]==res,:] = (preds_atom.loc[preds["Res_type"]==res, :]
-                                                            - grad * obs_atom.loc[preds["Res_type"]==res, :]
-                                                            - offset) 
-                delta_atom = preds_corr_atom - obs_atom
-                self.preds_corr[atom] = preds_corr_atom
-            else:
-                delta_atom = preds_atom - obs_atom
+                key = (atom + "_" + preds["Res_type"].astype(str)).values
+                grad = lm_pars["Grad"].reindex(key).fillna(0).values
+                offset = lm_pars["Offset"].reindex(key).fillna(0).values
+                preds_atom = preds_atom - grad*obs_atom - offset
+                if not mixture:
+                    self.preds_corr[atom] = pd.DataFrame(preds_atom, 
+                                        index=obs.index, columns=preds.index)
+            delta_atom = preds_atom - obs_atom
             
             # Make a note of NA positions in delta, and set them to zero 
             # (this avoids warnings when using norm.cdf later)
             na_mask = np.isnan(delta_atom)
             delta_atom[na_mask] = 0
             
+            # Standard deviation for each predicted residue, broadcast over 
+            # the observations
+            sd = self.pred_atom_sd(atom, atom_sd)
+            
             if self.pars["prob_method"] == "cdf":
                 # Use the cdf to calculate the probability of a 
                 # delta *at least* as great as the actual one
-                prob_atom = pd.DataFrame(-2*norm.logcdf(abs(delta_atom), scale=atom_sd[atom]),
-                                     index=obs.index, columns=preds.index)
+                prob_atom = -2*norm.logcdf(abs(delta_atom), scale=sd)
             elif self.pars["prob_method"] == "pdf":
-                prob_atom = pd.DataFrame(norm.logpdf(delta_atom, scale=atom_sd[atom]),
-                                     index=obs.index, columns=preds.index)
+                prob_atom = norm.logpdf(delta_atom, scale=sd)
             else:
                 print("Method for calculating probability not recognised. Defaulting to pdf.")
-                prob_atom = pd.DataFrame(norm.logpdf(delta_atom, scale=atom_sd[atom]),
-                                     index=obs.index, columns=preds.index)
-            
+                prob_atom = norm.logpdf(delta_atom, scale=sd)
             
             prob_atom[na_mask] = log10(default_prob)
             
-            log_prob_matrix = log_prob_matrix + prob_atom
+            log_prob = log_prob + prob_atom
+        
+        if mixture:
+            # Average the probabilities over the models
+            from scipy.special import logsumexp
+            log_prob = logsumexp(log_prob, axis=0) - np.log(log_prob.shape[0])
+        log_prob_matrix = pd.DataFrame(log_prob, index=obs.index, 
+                                       columns=preds.index)
         
         if use_hadamac:
             # For each type of residue type information that's available, make a 
             # matrix showing the probability modifications due to type mismatch, 
-            # then add it to log_prob_matrix
+            # then add it to log_prob_matrix. The SS_class columns are amino 
+            # acid masks, so the allowed pairs are given by a bitwise AND of 
+            # the observed mask with the mask of the predicted residue type.
             # Maybe make SS_class mismatch a parameter in config file?
-            for ss_class in {"SS_class","SS_classm1"}.intersection(obs.columns):
-                print(ss_class)
-                SS_class_matrix = pd.DataFrame(0, index=log_prob_matrix.index, 
-                                           columns=log_prob_matrix.columns)
-                for res in preds["Res_type"].unique():
-                # For each amino acid type in turn:
-                    # Work out which observations could be that aa type
-                    allowed = obs[ss_class].str.contains(res).fillna(True)
-                    # Select the predictions which are that aa type
-                    pred_list = preds.loc[preds["Res_typem1"]==res,"Res_name"]
-                    # For the selected predictions, penalise any observations 
-                    # where the current aa type is not allowed
-                    for p in pred_list:
-                        SS_class_matrix.loc[:,p] = (~allowed)*log10(0.01)
-            
-                log_prob_matrix = log_prob_matrix + SS_class_matrix
-                
+            for ss_class, res_col in [("SS_class","Res_type"), 
+                                      ("SS_classm1","Res_typem1")]:
+                if ss_class not in obs.columns or res_col not in preds.columns:
+                    continue
+                obs_mask = obs[ss_class].fillna(AA_all).values.astype(np.int64)
+                # Missing residue types (eg. dummies) allow any amino acid
+                pred_mask = aa_str_to_mask(preds[res_col])
+                allowed = (obs_mask[:,np.newaxis] & pred_mask[np.newaxis,:]) != 0
+                log_prob_matrix = log_prob_matrix + (~allowed)*log10(0.01)
             
-        
         log_prob_matrix[log_prob_matrix.isna()] = 2*np.nanmin(
                                                         log_prob_matrix.values)
         log_prob_matrix.loc[obs["Dummy_SS"], :] = 0
@@ -487,6 +1088,9 @@ class NAPS_assigner:
         inc: a DataFrame of (SS,Res) pairs which must be part of the assignment. 
             First column has the SS_names, second has the Res_names .
         exc: a DataFrame of (SS,Res) pairs which may not be part of the assignment.
+        
+        Spin systems have no chain, so multiple chains are always assigned 
+        jointly.
         """
         obs = self.obs
         preds = self.preds
@@ -527,8 +1131,36 @@ class NAPS_assigner:
                 else:
                     log_prob_matrix_reduced.loc[row["SS_name"], row["Res_name"]] = penalty
         
-        row_ind, col_ind = linear_sum_assignment(-1*log_prob_matrix_reduced)
-        # -1 because the algorithm minimises sum, but we want to maximise it.
+        # Optionally split the problem into independent blocks, by connected 
+        # components of the plausible (SS,Res) pairs
+        row_blocks, col_blocks = None, None
+        if self.pars["component_cutoff"] is not None:
+            comp_rows, comp_cols = find_candidate_components(
+                    log_prob_matrix_reduced.values, 
+                    self.pars["component_cutoff"],
+                    row_valid=~obs.loc[log_prob_matrix_reduced.index, 
+                                       "Dummy_SS"].values.astype(bool),
+                    col_valid=~preds.loc[log_prob_matrix_reduced.columns, 
+                                         "Dummy_res"].values.astype(bool))
+            # A component with more spin systems than residues can't assign 
+            # them all, so the best matching must use pruned pairs. In that 
+            # case, solve without splitting into components.
+            n_rows = pd.Series(comp_rows).value_counts()
+            n_cols = pd.Series(comp_cols).value_counts().reindex(n_rows.index, 
+                                                                 fill_value=0)
+            if (n_rows > n_cols).any():
+                logging.info("%d components have more spin systems than "+
+                             "residues. Solving without components.", 
+                             (n_rows > n_cols).sum())
+            else:
+                row_blocks, col_blocks = comp_rows, comp_cols
+        
+        if row_blocks is not None:
+            row_ind, col_ind = solve_lap_blocks(log_prob_matrix_reduced.values,
+                                                row_blocks, col_blocks)
+        else:
+            row_ind, col_ind = linear_sum_assignment(-1*log_prob_matrix_reduced)
+            # -1 because the algorithm minimises sum, but we want to maximise it.
         
         # Construct results dataframe
         matching_reduced = pd.DataFrame({"SS_name":log_prob_matrix_reduced.index[row_ind],
@@ -552,12 +1184,14 @@ class NAPS_assigner:
         valid_atoms = list(self.pars["atom_set"])
         extra_cols = set(matching.columns).difference({"SS_name","Res_name"})
         
+        chain_cols = ["Chain"] if "Chain" in preds.columns else []
+        
         assign_df = pd.merge(matching, 
-                             preds.loc[:,["Res_N","Res_type", "Res_name", 
-                                    "Dummy_res"]], 
+                             preds.loc[:,chain_cols+["Res_N","Res_type", 
+                                    "Res_name", "Dummy_res"]], 
                              on="Res_name", how="left")
-        assign_df = assign_df[["Res_name","Res_N","Res_type","SS_name", 
-                               "Dummy_res"]+list(extra_cols)]
+        assign_df = assign_df[["Res_name"]+chain_cols+["Res_N","Res_type",
+                               "SS_name", "Dummy_res"]+list(extra_cols)]
         assign_df = pd.merge(assign_df, 
                              obs.loc[:, obs.columns.isin(
                                      ["SS_name","Dummy_SS"]+valid_atoms)], 
@@ -572,7 +1206,7 @@ class NAPS_assigner:
                                             assign_df["Res_name"])
         # Careful above not to get rows/columns confused
         
-        assign_df = assign_df.sort_values(by="Res_N")
+        assign_df = assign_df.sort_values(by=chain_cols+["Res_N"])
         
         if set_assign_df:
             self.assign_df = assign_df
@@ -612,43 +1246,455 @@ class NAPS_assigner:
             assign_df["Num_good_links_next"] = np.NaN
             return(assign_df)
         else:
-            # First, get the i and i-1 shifts for the preceeding and 
-            # succeeding residues
-            tmp = assign_df.copy()
-            tmp = tmp.loc[tmp["Dummy_res"]==False,]
-            tmp.index = tmp["Res_N"]
-            tmp = tmp[list(seq_atoms)+list(seq_atoms_m1)]
-            tmp_next = tmp.copy()
-            tmp_next.index -= 1
-            tmp_prev = tmp.copy()
-            tmp_prev.index += 1
-            tmp = tmp.join(tmp_next, rsuffix="_next")
-            tmp = tmp.join(tmp_prev, rsuffix="_prev")
-            # Calculate mismatch for each atom type
-            for atom in seq_atoms:
-                tmp["d"+atom+"_prev"] = tmp[atom+"m1"] - tmp[atom+"_prev"]
-                tmp["d"+atom+"_next"] = tmp[atom] - tmp[atom+"m1_next"]
-            # Calculate maximum mismatch
-            tmp["Max_mismatch_prev"] = tmp["d"+seq_atoms+"_prev"].max(axis=1, 
-                                                                   skipna=True)
-            tmp["Max_mismatch_next"] = tmp["d"+seq_atoms+"_next"].max(axis=1,
-                                                                   skipna=True)
-            
-            # Calculate number of consistent matches
-            tmp["Num_good_links_prev"] = (tmp["d"+seq_atoms+"_prev"]<threshold).sum(axis=1)
-            tmp["Num_good_links_next"] = (tmp["d"+seq_atoms+"_next"]<threshold).sum(axis=1)
-            
-            # Join relevant columns back onto assign_df
-            tmp["Res_N"] = tmp.index
-            assign_df = assign_df.join(tmp.loc[:,["Max_mismatch_prev", 
-                                                  "Max_mismatch_next", 
-                                                  "Num_good_links_prev", 
-                                                  "Num_good_links_next"]], 
-                                       on="Res_N")
+            # Each row of assign_df is one residue, together with the shifts 
+            # of its spin system. Residues are only linked within a chain.
+            real = ~assign_df["Dummy_res"].astype(bool).values
+            chain = assign_df["Chain"] if "Chain" in assign_df.columns else None
+            res_prev, res_next = find_residue_links(
+                    assign_df["Res_N"].where(real), chain)
+            links = consistency_kernel(np.arange(len(assign_df)), 
+                                       assign_df[seq_atoms].values.astype(float), 
+                                       assign_df[seq_atoms_m1].values.astype(float), 
+                                       res_prev, res_next, threshold, 
+                                       res_valid=real)
+            assign_df = assign_df.assign(**links)
             if set_assign_df:
                 self.assign_df = assign_df
             return(assign_df)
         
+    def prepare_consistency_arrays(self):
+        """ Cache the arrays needed to check the consistency of a matching 
+        with consistency_kernel.
+        
+        Spin systems and residues are in the same order as the rows and 
+        columns of log_prob_matrix. The cache is rebuilt automatically if 
+        log_prob_matrix changes.
+        """
+        obs = self.obs.loc[self.log_prob_matrix.index,:]
+        preds = self.preds.loc[self.log_prob_matrix.columns,:]
+        
+        seq_atoms = [atom for atom in ["C","CA","CB"] 
+                     if atom in obs.columns and atom+"m1" in obs.columns]
+        seq_atoms_m1 = [atom+"m1" for atom in seq_atoms]
+        
+        real = ~preds["Dummy_res"].astype(bool).values
+        chain = preds["Chain"] if "Chain" in preds.columns else None
+        res_prev, res_next = find_residue_links(preds["Res_N"].where(real), 
+                                                chain)
+        
+        self.consistency_arrays = {
+                "log_prob_matrix": self.log_prob_matrix,
+                "seq_atoms": seq_atoms,
+                "obs_i": obs[seq_atoms].values.astype(float),
+                "obs_m1": obs[seq_atoms_m1].values.astype(float),
+                "res_prev": res_prev,
+                "res_next": res_next,
+                "res_valid": real}
+        return(self.consistency_arrays)
+    
+    def matching_to_array(self, matching):
+        """ Convert a matching DataFrame (with SS_name and Res_name columns) 
+        into an integer array giving the spin system (row of log_prob_matrix) 
+        matched to each residue (column of log_prob_matrix), or -1 if none.
+        """
+        res_ss = np.full(self.log_prob_matrix.shape[1], -1)
+        cols = self.log_prob_matrix.columns.get_indexer(matching["Res_name"])
+        rows = self.log_prob_matrix.index.get_indexer(matching["SS_name"])
+        res_ss[cols[cols>=0]] = rows[cols>=0]
+        return(res_ss)
+    
+    def matching_consistency(self, res_ss, threshold=0.1):
+        """ Fast consistency check for a matching.
+        
+        res_ss: integer array giving the spin system (row of log_prob_matrix) 
+            matched to each residue (column of log_prob_matrix). See 
+            matching_to_array.
+        
+        Returns the output of consistency_kernel, with one value per column of 
+        log_prob_matrix.
+        """
+        arrays = self.consistency_arrays
+        if arrays is None or arrays["log_prob_matrix"] is not self.log_prob_matrix:
+            arrays = self.prepare_consistency_arrays()
+        
+        if len(arrays["seq_atoms"])==0:
+            # You can't do a comparison
+            nan = np.full(len(res_ss), np.NaN)
+            return({"Max_mismatch_prev":nan, "Max_mismatch_next":nan.copy(), 
+                    "Num_good_links_prev":nan.copy(), 
+                    "Num_good_links_next":nan.copy()})
+        
+        return(consistency_kernel(res_ss, arrays["obs_i"], arrays["obs_m1"], 
+                                  arrays["res_prev"], arrays["res_next"], 
+                                  threshold, res_valid=arrays["res_valid"]))
+        
+    def refine_consistency(self, matching=None, threshold=0.1, max_rounds=None, 
+                           verbose=False):
+        """ Iteratively increase the number of residues whose assignment is 
+        consistent with both sequential neighbours.
+        
+        Starting from the best matching (or from matching, if given), residues 
+        with consistent links to both neighbours are fixed. Each remaining 
+        (SS,Res) pair is a candidate move: forbid that pair and re-solve the 
+        rest of the assignment. The move giving the largest increase in the 
+        number of consistent residues (with ties broken by the log probability 
+        sum) is accepted, and this is repeated until no move increases 
+        consistency.
+        
+        Rather than re-solving the whole assignment for every candidate, the 
+        solution is warm-started from the previous dual variables, so each 
+        move needs a single augmenting path (see LAP_solver). Consistency is 
+        only re-checked for residues whose spin system changed, and their 
+        neighbours. Candidates are kept in a priority queue, and only 
+        re-evaluated when they reach the front of the queue after another 
+        move has been accepted.
+        
+        matching: optional starting matching (eg. from 
+            find_fragment_assignments or optimise_pairwise). Its consistent 
+            residues, and the residues they link to, are kept, and the rest of 
+            the assignment is re-solved around them before refining.
+        threshold: Minimum carbon shift difference for sequential residues to
+            count as mismatched
+        max_rounds: optional limit on the number of accepted moves
+        
+        Returns a matching DataFrame (SS_name and Res_name), as for 
+        find_best_assignments.
+        """
+        log_prob_matrix = self.log_prob_matrix
+        score = log_prob_matrix.values
+        arrays = self.prepare_consistency_arrays()
+        n_atoms = len(arrays["seq_atoms"])
+        dummy_SS = self.obs.loc[log_prob_matrix.index, 
+                                "Dummy_SS"].values.astype(bool)
+        dummy_res = ~arrays["res_valid"]
+        res_prev, res_next = arrays["res_prev"], arrays["res_next"]
+        
+        def make_matching(res_ss):
+            return(pd.DataFrame({"SS_name":log_prob_matrix.index[res_ss],
+                                 "Res_name":log_prob_matrix.columns}))
+        
+        def is_consistent(res_ss, subset=None):
+            links = consistency_kernel(res_ss, arrays["obs_i"], arrays["obs_m1"],
+                                       res_prev, res_next, threshold, 
+                                       res_valid=arrays["res_valid"], 
+                                       subset=subset)
+            return((links["Num_good_links_prev"]==n_atoms) & 
+                   (links["Num_good_links_next"]==n_atoms))
+        
+        start = []
+        if matching is not None and n_atoms>0:
+            # Keep the consistent residues of the starting matching, and their 
+            # neighbours (so their links stay consistent)
+            start_ss = self.matching_to_array(matching)
+            keep = is_consistent(start_ss)
+            keep[res_prev[keep & (res_prev>=0)]] = True
+            keep[res_next[keep & (res_next>=0)]] = True
+            keep &= start_ss>=0
+            start = list(zip(start_ss[keep], np.flatnonzero(keep)))
+        
+        solver = LAP_solver(-1*score, fixed=start)
+        # -1 because the solver minimises cost, but we want to maximise score
+        res_ss = solver.col_to_row.copy()
+        
+        if n_atoms==0:
+            print("refine_consistency: no sequential atoms, so consistency "+
+                  "can't be checked.")
+            return(make_matching(res_ss))
+        
+        def excluded_pair(j):
+            # Need to account for dummy residues or spin systems, as in 
+            # find_best_assignments
+            i = res_ss[j]
+            if dummy_res[j]:
+                return([i], np.flatnonzero(dummy_res))
+            elif dummy_SS[i]:
+                return(np.flatnonzero(dummy_SS), [j])
+            else:
+                return([i], [j])
+        
+        def evaluate(j):
+            # Change in number of consistent residues and score if the 
+            # current pair for residue j was forbidden
+            new_res_ss = solver.trial_forbid(*excluded_pair(j))
+            changed = np.flatnonzero(new_res_ss!=res_ss)
+            affected = np.concatenate([changed, res_prev[changed], 
+                                       res_next[changed]])
+            affected = np.unique(affected[affected>=0])
+            d_consistent = (is_consistent(new_res_ss, affected).sum() - 
+                            consistent[affected].sum())
+            d_score = (score[new_res_ss[changed], changed].sum() - 
+                       score[res_ss[changed], changed].sum())
+            return(d_consistent, d_score)
+        
+        consistent = is_consistent(res_ss)
+        fixed = np.zeros(len(res_ss), dtype=bool)
+        for i, j in start:
+            fixed[j] = True
+        
+        def fix_consistent():
+            for j in np.flatnonzero(consistent & ~fixed):
+                solver.fix(res_ss[j], j)
+                fixed[j] = True
+        
+        fix_consistent()
+        logging.info("refine_consistency: %d residues initially consistent.", 
+                     consistent.sum())
+        
+        # Queue entries are (-d_consistent, -d_score, round evaluated, residue).
+        # Unevaluated candidates have round -1, so are evaluated first.
+        n_round = 0
+        queue = [(-np.inf, -np.inf, -1, j) for j in np.flatnonzero(~fixed)]
+        heapq.heapify(queue)
+        queued = set(np.flatnonzero(~fixed))
+        while queue:
+            neg_d_consistent, neg_d_score, evaluated, j = heapq.heappop(queue)
+            queued.discard(j)
+            if fixed[j]:
+                continue
+            if evaluated != n_round:
+                d_consistent, d_score = evaluate(j)
+                heapq.heappush(queue, (-d_consistent, -d_score, n_round, j))
+                queued.add(j)
+                continue
+            if -neg_d_consistent <= 0:
+                # The best move doesn't increase consistency
+                break
+            
+            # Accept the move
+            solver.forbid(*excluded_pair(j))
+            new_res_ss = solver.col_to_row.copy()
+            changed = np.flatnonzero(new_res_ss!=res_ss)
+            res_ss = new_res_ss
+            consistent = is_consistent(res_ss)
+            fix_consistent()
+            n_round += 1
+            if verbose:
+                print("Round %d: %s\tTotal consistent: %d, Sum_probability: %f" % 
+                      (n_round, log_prob_matrix.columns[j], consistent.sum(), 
+                       score[res_ss, np.arange(len(res_ss))].sum()))
+            
+            for k in changed:
+                if not fixed[k] and k not in queued:
+                    heapq.heappush(queue, (-np.inf, -np.inf, -1, k))
+                    queued.add(k)
+            if max_rounds is not None and n_round>=max_rounds:
+                break
+        
+        logging.info("refine_consistency: %d residues consistent after %d "+
+                     "rounds.", consistent.sum(), n_round)
+        return(make_matching(res_ss))
+    
+    def calc_link_matrix(self):
+        """ Calculate the sparse matrix of sequential link scores between spin 
+        systems (see calc_seq_link_matrix), in the row order of 
+        log_prob_matrix.
+        
+        The result is cached as self.link_matrix, and only recalculated if 
+        log_prob_matrix or the seq_link parameters change.
+        """
+        # log_prob_matrix is compared by identity, as comparing DataFrames 
+        # with == is elementwise
+        source = (self.log_prob_matrix, self.pars["seq_link_sd"], 
+                  self.pars["seq_link_tol"])
+        if (self.link_matrix is not None and 
+            source[0] is self.link_matrix_source[0] and 
+            source[1:] == self.link_matrix_source[1:]):
+            return(self.link_matrix)
+        
+        arrays = self.prepare_consistency_arrays()
+        self.link_matrix = calc_seq_link_matrix(arrays["obs_i"], 
+                                                arrays["obs_m1"], 
+                                                self.pars["seq_link_sd"], 
+                                                self.pars["seq_link_tol"])
+        self.link_matrix_source = source
+        logging.info("Calculated sequential link matrix (%d links).", 
+                     self.link_matrix.nnz)
+        return(self.link_matrix)
+    
+    def find_fragment_assignments(self, min_link_score=3.0, verbose=False):
+        """ Find the best assignment, after first placing linked fragments of 
+        spin systems onto the sequence.
+        
+        Spin systems are greedily assembled into fragments using the 
+        sequential link matrix (see build_fragments). Each fragment of at 
+        least pars["fragment_min_length"] spin systems is scored against every 
+        window of consecutive residues, and fragments that fit one window 
+        better than any other by at least pars["fragment_min_margin"] are 
+        placed (see place_fragments). The placed (SS,Res) pairs are then fixed 
+        while find_best_assignments assigns everything else.
+        
+        min_link_score: minimum sequential link score for two spin systems 
+            to be joined in a fragment
+        
+        Returns a matching DataFrame (SS_name and Res_name), as for 
+        find_best_assignments.
+        """
+        log_prob_matrix = self.log_prob_matrix
+        link_matrix = self.calc_link_matrix()
+        arrays = self.consistency_arrays
+        dummy_SS = self.obs.loc[log_prob_matrix.index, 
+                                "Dummy_SS"].values.astype(bool)
+        
+        fragments = build_fragments(link_matrix, min_link_score, 
+                                    min_length=self.pars["fragment_min_length"], 
+                                    valid=~dummy_SS)
+        placed = place_fragments(fragments, log_prob_matrix.values, 
+                                 arrays["res_next"], arrays["res_valid"], 
+                                 min_margin=self.pars["fragment_min_margin"])
+        
+        if verbose:
+            print("find_fragment_assignments: placed %d of %d fragments." % 
+                  (len(placed), len(fragments)))
+        logging.info("Placed %d of %d linked fragments.", 
+                     len(placed), len(fragments))
+        
+        if len(placed)==0:
+            return(self.find_best_assignments())
+        ss = np.concatenate([frag for frag, residues in placed])
+        res = np.concatenate([residues for frag, residues in placed])
+        inc = pd.DataFrame({"SS_name":log_prob_matrix.index[ss],
+                            "Res_name":log_prob_matrix.columns[res]})
+        return(self.find_best_assignments(inc=inc))
+    
+    def optimise_pairwise(self, matching=None, n_steps=None, T_start=10.0, 
+                          T_end=0.01, max_segment=5, n_candidates=10, 
+                          seed=None, verbose=False):
+        """ Optimise the assignment including pairwise sequential terms, by 
+        simulated annealing.
+        
+        The score of an assignment is the log probability sum, plus 
+        pars["seq_link_weight"] times the sequential link score (from 
+        calc_link_matrix) for each pair of sequential residues. This rewards 
+        assignments where the i-1 shifts of each spin system match the shifts 
+        of the spin system assigned to the preceding residue.
+        
+        The search starts from matching (or the best assignment from 
+        find_best_assignments), and uses two kinds of move: swapping the spin 
+        systems of two residues (2-opt), or swapping two sequential segments 
+        of residues, which keeps the links within each segment. Moves are 
+        proposed by picking a residue, and one of its n_candidates most 
+        likely spin systems, and swapping with the residue that spin system is 
+        currently assigned to. Only the residues and links touched by a move 
+        are rescored. Moves are accepted with the Metropolis criterion, as the 
+        temperature is lowered geometrically from T_start to T_end.
+        
+        n_steps: number of moves to try. Defaults to 200 per residue.
+        max_segment: maximum length of segment moves
+        n_candidates: number of candidate spin systems for each residue
+        seed: random seed
+        
+        Returns a matching DataFrame (SS_name and Res_name) of the best 
+        assignment found, as for find_best_assignments.
+        """
+        log_prob_matrix = self.log_prob_matrix
+        arrays = self.prepare_consistency_arrays()
+        n = log_prob_matrix.shape[1]
+        weight = self.pars["seq_link_weight"]
+        
+        if matching is None:
+            matching = self.find_best_assignments()
+        res_ss = self.matching_to_array(matching)
+        if (res_ss<0).any() or log_prob_matrix.shape[0]!=n:
+            print("optimise_pairwise: matching must include every residue "+
+                  "and spin system.")
+            return(None)
+        
+        link_matrix = self.calc_link_matrix()
+        
+        # Most likely spin systems for each residue
+        n_candidates = min(n_candidates, n)
+        candidates = np.argsort(-log_prob_matrix.values, axis=0, 
+                                kind="stable")[:n_candidates,:].T.tolist()
+        
+        # Python lists are faster than numpy arrays for scalar lookups
+        unary = log_prob_matrix.values.tolist()
+        # Sparse link scores as a list of dicts, so link[a].get(b, 0) is the 
+        # weighted score for b following a
+        link = [dict(zip(link_matrix.indices[link_matrix.indptr[a]:
+                                             link_matrix.indptr[a+1]].tolist(),
+                         (weight*link_matrix.data[link_matrix.indptr[a]:
+                                                  link_matrix.indptr[a+1]]).tolist()))
+                for a in range(n)]
+        prv = arrays["res_prev"].tolist()
+        nxt = arrays["res_next"].tolist()
+        ss = res_ss.tolist()
+        ss_res = [0]*n     # The residue each spin system is assigned to
+        for j in range(n):
+            ss_res[ss[j]] = j
+        
+        def local_score(residues):
+            # Score of the given residues, and of every link touching them
+            total = 0.
+            links = set()
+            for j in residues:
+                total += unary[ss[j]][j]
+                if nxt[j]>=0:
+                    links.add(j)
+                if prv[j]>=0:
+                    links.add(prv[j])
+            for j in links:
+                total += link[ss[j]].get(ss[nxt[j]], 0.)
+            return(total)
+        
+        def segment(j, length):
+            seg = [j]
+            while len(seg)<length and nxt[seg[-1]]>=0:
+                seg.append(nxt[seg[-1]])
+            return(seg)
+        
+        current = (sum(unary[ss[j]][j] for j in range(n)) + 
+                   sum(link[ss[j]].get(ss[nxt[j]], 0.) for j in range(n) 
+                       if nxt[j]>=0))
+        best, best_ss = current, list(ss)
+        
+        if n_steps is None:
+            n_steps = 200*n
+        rng = random.Random(seed)
+        cooling = (T_end/T_start)**(1/max(n_steps-1, 1))
+        T = T_start
+        n_accepted = 0
+        for step in range(n_steps):
+            j = rng.randrange(n)
+            k = ss_res[rng.choice(candidates[j])]
+            if j==k:
+                continue
+            if max_segment>1 and rng.random()<0.5:
+                # Segment move: swap the spin systems of two sequential runs
+                length = rng.randint(2, max_segment)
+                seg_j = segment(j, length)
+                seg_k = segment(k, len(seg_j))
+                seg_j = seg_j[:len(seg_k)]
+                if set(seg_j).intersection(seg_k):
+                    continue
+            else:
+                seg_j, seg_k = [j], [k]
+            residues = seg_j + seg_k
+            
+            before = local_score(residues)
+            for a, b in zip(seg_j, seg_k):
+                ss[a], ss[b] = ss[b], ss[a]
+            delta = local_score(residues) - before
+            
+            if delta>=0 or rng.random()<exp(delta/T):
+                for a in residues:
+                    ss_res[ss[a]] = a
+                current += delta
+                n_accepted += 1
+                if current>best:
+                    best, best_ss = current, list(ss)
+            else:
+                for a, b in zip(seg_j, seg_k):
+                    ss[a], ss[b] = ss[b], ss[a]
+            T *= cooling
+        
+        if verbose:
+            print("optimise_pairwise: accepted %d of %d moves. Best score %f." % 
+                  (n_accepted, n_steps, best))
+        logging.info("optimise_pairwise: best score %f after %d moves.", 
+                     best, n_steps)
+        return(pd.DataFrame({"SS_name":log_prob_matrix.index[best_ss],
+                             "Res_name":log_prob_matrix.columns}))
+    
     def find_alt_assignments(self, N=1, by_ss=True, verbose=False):
         """ Find the next-best assignment(s) for each residue or spin system
         
@@ -697,7 +1743,7 @@ class NAPS_assigner:
             excluded = best_matching.loc[[i], :]
             
             for j in range(N):
-                alt_matching = self.find_best_assignment2(exc=excluded)
+                alt_matching = self.find_best_assignments(exc=excluded)
                                 
                 alt_matching["Rank"] = j+2
                 alt_sum_prob = sum(self.log_prob_matrix.lookup(
@@ -750,10 +1796,12 @@ class NAPS_assigner:
         atom_list = list(set(atom_list).intersection(assign_df.columns))
         
         # First, convert assign_df from wide to long
-        plot_df = assign_df.loc[:,["Res_N", "Res_type", "Res_name", "SS_name", 
-                                   "Dummy_res", "Dummy_SS"]+atom_list]
-        plot_df = plot_df.melt(id_vars=["Res_N", "Res_type", "Res_name", 
-                                        "SS_name", "Dummy_res", "Dummy_SS"],
+        id_cols = ["Res_N", "Res_type", "Res_name", "SS_name", "Dummy_res", 
+                   "Dummy_SS"]
+        if "Chain" in assign_df.columns:
+            id_cols = ["Chain"] + id_cols
+        plot_df = assign_df.loc[:,id_cols+atom_list]
+        plot_df = plot_df.melt(id_vars=id_cols,
                                    value_vars=atom_list, var_name="Atom_type",
                                    value_name="Shift")
         
@@ -765,12 +1813,20 @@ class NAPS_assigner:
                                                     # Simplify atom type
         
         plot_df["seq_group"] = plot_df["Res_N"] + plot_df["i"].astype("int")
+        if "Chain" in assign_df.columns:
+            # Don't link residues from different chains
+            plot_df["seq_group"] = (plot_df["Chain"].astype(str) + ":" + 
+                                    plot_df["seq_group"].astype(str))
         
         # Pad Res_name column with spaces so that sorting works correctly
         plot_df["Res_name"] = plot_df["Res_name"].str.pad(6)
         plot_df["x_name"] = plot_df["Res_name"] + "_(" + plot_df["SS_name"] + ")"
         
         # Make the plot
+        from plotnine import (ggplot, aes, geom_point, geom_line, facet_grid,
+                              scale_y_reverse, scale_shape_manual, 
+                              scale_colour_brewer, xlab, ylab, theme_bw, 
+                              theme, element_text)
         plt = ggplot(aes(x="x_name"), data=plot_df) 
         plt = plt + geom_point(aes(y="Shift", colour="i", shape="Dummy_res"))
         plt = plt + scale_y_reverse() + scale_shape_manual(values=["o","x"])
@@ -785,6 +1841,87 @@ class NAPS_assigner:
         
         return(plt)
     
+    def plot_strips_mpl(self, atom_list=["C","Cm1","CA","CAm1","CB","CBm1"],
+                        res_range=None):
+        """ Make a strip plot of the assignment, using matplotlib directly
+        
+        This shows the same information as plot_strips(), but each facet is 
+        drawn with one scatter per point style and one LineCollection per line 
+        style, so it is much faster for large proteins. The figure can be 
+        saved as png, svg, pdf etc. with fig.savefig().
+        
+        atom_list: only plot data for these atom types
+        res_range: optional (first, last) residue numbers. If given, only 
+            residues in this range are plotted.
+        
+        Returns a matplotlib Figure.
+        """
+        return(strip_plot_figure(self.assign_df, atom_list, res_range))
+    
+    def plot_strip_tiles(self, tile_size=60, fmt="png", n_workers=1,
+                         atom_list=["C","Cm1","CA","CAm1","CB","CBm1"]):
+        """ Draw the strip plot as a series of tiles of tile_size residues
+        
+        For long sequences a single strip plot is very wide and slow to draw 
+        and view. Image tiles are drawn in n_workers worker processes.
+        
+        fmt: image format of the tiles (png, svg etc.). If None, matplotlib 
+            Figures are returned instead. These are always drawn in this 
+            process, as most of the work is rendering them, which happens 
+            wherever they are saved.
+        
+        Returns (index, tiles), where tiles is a list of images and index is 
+        a list with a dict for each tile giving its number, the number of 
+        residues and the first and last residue names.
+        """
+        tile_dfs = split_strip_tiles(self.assign_df, tile_size)
+        index = strip_tile_index(tile_dfs)
+        
+        args = (tile_dfs, [atom_list]*len(tile_dfs), [fmt]*len(tile_dfs))
+        if fmt is not None and n_workers > 1 and len(tile_dfs) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(min(n_workers, len(tile_dfs))) as executor:
+                tiles = list(executor.map(render_strip_tile, *args))
+        else:
+            tiles = list(map(render_strip_tile, *args))
+        
+        return(index, tiles)
+    
+    def save_strip_tiles(self, output, tile_size=60, n_workers=1,
+                         atom_list=["C","Cm1","CA","CAm1","CB","CBm1"]):
+        """ Save a tiled strip plot
+        
+        output: if this is a path ending in .pdf, or a file-like object, a 
+            multi-page pdf is written with one tile per page. Otherwise it is 
+            a directory, and each tile is saved there as a png 
+            (tile_000.png etc.), together with an index.json file describing 
+            the tiles.
+        n_workers: worker processes used to draw png tiles. Pdf pages can 
+            only be written from Figures in this process, so they are drawn 
+            one at a time and n_workers is ignored.
+        
+        Returns the tile index (see plot_strip_tiles()).
+        """
+        if not isinstance(output, str) or output.lower().endswith(".pdf"):
+            from matplotlib.backends.backend_pdf import PdfPages
+            tile_dfs = split_strip_tiles(self.assign_df, tile_size)
+            index = strip_tile_index(tile_dfs)
+            with PdfPages(output) as pdf:
+                for tile_df in tile_dfs:
+                    pdf.savefig(render_strip_tile(tile_df, atom_list))
+        else:
+            index, tiles = self.plot_strip_tiles(tile_size, "png", n_workers, 
+                                                 atom_list)
+            os.makedirs(output, exist_ok=True)
+            for tile in index:
+                tile["file"] = "tile_%03d.png" % tile["tile"]
+                with open(os.path.join(output, tile["file"]), "wb") as f:
+                    f.write(tiles[tile["tile"]])
+            with open(os.path.join(output, "index.json"), "w") as f:
+                json.dump({"tile_size": tile_size, "tiles": index}, f, indent=1)
+        
+        return(index)
+    
     def plot_seq_mismatch(self):
         """ Make a plot of the maximum sequential mismatch between i-1, i and 
         i+1 residues
@@ -802,6 +1939,8 @@ class NAPS_assigner:
                                      assign_df["SS_name"] + ")")
             
             # Make the plot
+            from plotnine import (ggplot, aes, geom_col, xlab, ylab, 
+                                  theme_bw, theme, element_text)
             plt = ggplot(aes(x="x_name"), data=assign_df) 
             plt = plt + geom_col(aes(y="abs(Max_mismatch_prev)"))
             plt = plt + xlab("Residue name")
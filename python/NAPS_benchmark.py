@@ -0,0 +1,400 @@
+#!/anaconda3/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Scalability benchmark for NAPS, using synthetic proteins of increasing size.
+
+Predicted shifts are drawn from approximate random coil values plus some
+structural variation. Observed shifts are the predictions plus a prediction
+error. By default, the errors of each residue (including which shifts are
+missing) are resampled from real SHIFTX2 prediction errors for residues of the
+same type in the testset, so the errors have realistic outliers and
+correlations. Alternatively, they can be drawn from the noise model used by
+NAPS, either independent errors with the atom_sd values from the config file,
+or correlated errors from d_cov.csv. The i-1 shifts of each spin system are
+the observed shifts of the preceding residue, plus a small measurement error.
+
+Each NAPS_assigner stage is timed, including the optional sequential methods
+(find_fragment_assignments, optimise_pairwise and refine_consistency), and the
+fraction of spin systems assigned to the correct residue by each method is
+recorded, so that scaling and accuracy regressions show up. A small protein is
+run first and not recorded, so that one-off costs (such as lazy imports) don't
+inflate the first timings. The time taken to import the NAPS modules in a
+fresh interpreter can also be measured, with --import_time.
+
+eg. "python NAPS_benchmark.py -c ../config/config.txt --sizes 100 500 1000"
+
+@author: aph516
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from NAPS_assigner import NAPS_assigner
+from NAPS_fit import atoms as fit_atoms, iter_testset, res_types
+from NAPS_profiling import Profiler
+
+# Approximate random coil shifts (C, CA, CB, H, HA, N) for each residue type
+random_coil = pd.DataFrame.from_dict({
+        "A":[177.8, 52.5, 19.1, 8.24, 4.32, 123.8],
+        "C":[174.6, 58.2, 28.0, 8.32, 4.55, 118.8],
+        "D":[176.3, 54.2, 41.1, 8.34, 4.64, 120.4],
+        "E":[176.6, 56.6, 29.9, 8.42, 4.35, 120.2],
+        "F":[175.8, 57.7, 39.6, 8.30, 4.62, 120.3],
+        "G":[174.9, 45.1, np.NaN, 8.33, 3.96, 108.8],
+        "H":[174.1, 55.0, 29.0, 8.42, 4.73, 118.2],
+        "I":[176.4, 61.1, 38.8, 8.00, 4.17, 119.9],
+        "K":[176.6, 56.2, 33.1, 8.29, 4.32, 120.4],
+        "L":[177.6, 55.1, 42.4, 8.16, 4.34, 121.8],
+        "M":[176.3, 55.4, 32.9, 8.28, 4.48, 119.6],
+        "N":[175.2, 53.1, 38.9, 8.40, 4.74, 118.7],
+        "P":[177.3, 63.3, 32.1, np.NaN, 4.42, np.NaN],
+        "Q":[176.0, 55.7, 29.4, 8.32, 4.34, 119.8],
+        "R":[176.3, 56.0, 30.9, 8.23, 4.34, 120.5],
+        "S":[174.6, 58.3, 63.8, 8.31, 4.47, 115.7],
+        "T":[174.7, 61.8, 69.8, 8.15, 4.35, 113.6],
+        "V":[176.3, 62.2, 32.9, 8.03, 4.12, 119.2],
+        "W":[176.1, 57.5, 29.6, 8.25, 4.66, 121.3],
+        "Y":[175.9, 57.9, 38.8, 8.12, 4.55, 120.3]},
+        orient="index", columns=["C","CA","CB","H","HA","N"])
+
+# Spread of predicted shifts around the random coil values
+structural_sd = pd.Series({"C":1.2, "CA":1.5, "CB":1.5, "H":0.5, "HA":0.3,
+                           "N":3.0})
+
+def read_testset_errors(naps_path, pred_dir="shiftx2_results",
+                        pred_type="shiftx2"):
+    """Read the prediction errors (observed minus predicted shift) of every
+    residue in the testset.
+
+    Returns a DataFrame with a Res_type column and one column per atom type,
+    with NaN where the shift wasn't observed. Residues with no observed
+    shifts are left out.
+    """
+    atoms = list(random_coil.columns)
+    cols = [fit_atoms.index(atom) for atom in atoms]
+    errors = []
+    for name, obs, preds, res, ss in iter_testset(naps_path, pred_dir,
+                                                 pred_type):
+        df = pd.DataFrame(obs[:,cols]-preds[:,cols], columns=atoms)
+        df["Res_type"] = [res_types[r] if r>=0 else "" for r in res[:,0]]
+        errors.append(df)
+    errors = pd.concat(errors, ignore_index=True)
+    errors = errors.loc[errors[atoms].notna().any(axis=1) &
+                        (errors["Res_type"]!=""),:]
+    return(errors.reset_index(drop=True))
+
+def make_synthetic_protein(n_res, atom_sd, d_cov=None, missing=0.05,
+                           obs_fraction=1.0, extra_fraction=0.0,
+                           measurement_sd=0.05, seed=None, errors=None):
+    """Make a synthetic set of predicted and observed shifts.
+
+    n_res: number of residues
+    atom_sd: dict of prediction error standard deviations for each atom type
+    d_cov: optional DataFrame with the covariance of prediction errors. If
+        given, errors are correlated between atom types.
+    errors: optional DataFrame of real prediction errors, from
+        read_testset_errors. If given, the errors of each residue are
+        resampled from residues of the same type, and atom_sd and d_cov are
+        ignored. Shifts missing from the sampled residue are also missing.
+    missing: fraction of observed shifts to remove at random (in addition to
+        those missing from errors)
+    obs_fraction: fraction of (non-proline) residues with a spin system
+    extra_fraction: number of extra spin systems with no matching residue,
+        as a fraction of n_res
+    measurement_sd: difference between the i-1 shifts of a spin system and
+        the observed shifts of the preceding residue
+    seed: random seed
+
+    Returns (preds_long, obs), where preds_long is in ShiftX2 csv format and
+    obs is in the format produced by NAPS_importer.
+    """
+    rng = np.random.default_rng(seed)
+    atoms = list(random_coil.columns)
+
+    seq = rng.choice(random_coil.index, n_res)
+    preds = (random_coil.loc[seq, atoms].values +
+             rng.normal(size=(n_res, len(atoms)))*structural_sd[atoms].values)
+    res_N = np.arange(1, n_res+1)
+
+    preds_long = pd.DataFrame({"NUM":np.repeat(res_N, len(atoms)),
+                               "RES":np.repeat(seq, len(atoms)),
+                               "ATOMNAME":np.tile(atoms, n_res),
+                               "SHIFT":preds.ravel()})
+    preds_long = preds_long.dropna(subset=["SHIFT"])
+
+    # Observed shifts are the predictions plus the prediction error
+    if errors is not None:
+        error = np.full((n_res, len(atoms)), np.NaN)
+        groups = errors.groupby("Res_type").indices
+        for aa in np.unique(seq):
+            rows = np.flatnonzero(seq==aa)
+            error[rows,:] = errors[atoms].values[
+                    rng.choice(groups[aa], len(rows)),:]
+    elif d_cov is not None:
+        error = rng.multivariate_normal(np.zeros(len(atoms)),
+                                        d_cov.loc[atoms, atoms].values,
+                                        size=n_res)
+    else:
+        error = rng.normal(size=(n_res, len(atoms))) * np.array(
+                [atom_sd[a] for a in atoms])
+    obs = preds + error
+
+    # The i-1 shifts come from the preceding residue
+    carbons = ["C","CA","CB"]
+    m1 = np.full((n_res, 3), np.NaN)
+    m1[1:,:] = (obs[:-1, :3] +
+                rng.normal(size=(n_res-1, 3))*measurement_sd)
+    obs = np.hstack([obs, m1])
+    obs_cols = atoms + [a+"m1" for a in carbons]
+    obs[rng.random(obs.shape)<missing] = np.NaN
+
+    names = np.array([(str(n)+aa).rjust(5) for n, aa in zip(res_N, seq)])
+    obs = pd.DataFrame(obs, columns=obs_cols)
+    obs.insert(0, "SS_name", names)
+
+    # Prolines aren't observed, and some other residues may be missing
+    keep = (seq!="P") & (rng.random(n_res)<obs_fraction)
+    obs = obs.loc[keep,:]
+
+    # Add extra spin systems (eg. from side chains or impurities)
+    n_extra = int(round(extra_fraction*n_res))
+    if n_extra>0:
+        extra = obs.sample(n_extra, replace=True,
+                           random_state=rng.integers(2**31)).copy()
+        extra[obs_cols] += rng.normal(size=(n_extra, len(obs_cols)))*2
+        extra["SS_name"] = ["X"+str(i) for i in range(n_extra)]
+        obs = pd.concat([obs, extra])
+
+    obs.index = obs["SS_name"]
+    obs.index.name = None
+    return(preds_long, obs)
+
+def benchmark_assigner(preds_long, obs, config_file=None, alt_assignments=0,
+                       workdir=None, plot=False, seq_methods=False,
+                       seq_link_weight=2):
+    """Time each NAPS_assigner stage for one synthetic protein.
+
+    If plot is True, the strip plot is also drawn with plot_strips_mpl() and
+    saved as a png. If seq_methods is True, find_fragment_assignments,
+    optimise_pairwise (with seq_link_weight) and refine_consistency are also
+    timed. Each starts from the best assignment, as in runNAPS.
+
+    Returns (timings, accuracy), where timings is a dict of stage name to
+    seconds, and accuracy is a dict of the fraction of real (non-extra) spin
+    systems assigned to the correct residue by each method.
+    """
+    def calc_accuracy(assign_df):
+        # Extra spin systems have no correct residue, so they're left out
+        assign_df = assign_df.loc[~assign_df["Dummy_SS"].astype(bool),:]
+        assign_df = assign_df.loc[~assign_df["SS_name"].str.startswith("X"),:]
+        return((assign_df["SS_name"].str.strip() ==
+                assign_df["Res_name"].str.strip()).mean())
+
+    prof = Profiler()
+    a = NAPS_assigner()
+    if config_file is not None:
+        a.read_config_file(config_file)
+    a.obs = obs
+
+    # Predictions are read from file, as in a real run
+    pred_file = os.path.join(workdir, "preds.csv")
+    preds_long.to_csv(pred_file, index=False)
+    with prof.stage("import_pred_shifts"):
+        a.import_pred_shifts(pred_file, "shiftx2")
+    with prof.stage("add_dummy_rows"):
+        a.add_dummy_rows()
+    with prof.stage("calc_log_prob_matrix"):
+        a.calc_log_prob_matrix2(sf=1, verbose=False)
+    with prof.stage("find_best_assignments"):
+        matching = a.find_best_assignments()
+    with prof.stage("make_assign_df"):
+        a.make_assign_df(matching, set_assign_df=True)
+    with prof.stage("check_assignment_consistency"):
+        a.check_assignment_consistency(threshold=0.1)
+    if alt_assignments>0:
+        with prof.stage("find_alt_assignments"):
+            a.find_alt_assignments(N=alt_assignments, by_ss=True)
+    if plot:
+        with prof.stage("plot_strips"):
+            fig = a.plot_strips_mpl()
+            fig.savefig(os.path.join(workdir, "plot.png"))
+    accuracy = {"best":calc_accuracy(a.assign_df)}
+
+    if seq_methods:
+        a.pars["seq_link_weight"] = seq_link_weight
+        with prof.stage("calc_link_matrix"):
+            a.calc_link_matrix()
+        with prof.stage("find_fragment_assignments"):
+            seq_matching = a.find_fragment_assignments()
+        accuracy["fragments"] = calc_accuracy(a.make_assign_df(seq_matching))
+        with prof.stage("optimise_pairwise"):
+            seq_matching = a.optimise_pairwise(matching, seed=0)
+        accuracy["pairwise"] = calc_accuracy(a.make_assign_df(seq_matching))
+        with prof.stage("refine_consistency"):
+            seq_matching = a.refine_consistency(threshold=0.1)
+        accuracy["refine"] = calc_accuracy(a.make_assign_df(seq_matching))
+
+    timings = {s["stage"]:s["time"] for s in prof.stages}
+    return(timings, accuracy)
+
+def run_benchmark(sizes, config_file=None, noise="testset", d_cov_file=None,
+                  missing=None, obs_fraction=1.0, extra_fraction=0.0,
+                  alt_max_size=0, seq_max_size=0, seq_link_weight=2,
+                  repeats=1, seed=0, plot=False, naps_path=None):
+    """Run the benchmark for a range of protein sizes.
+
+    noise: "testset" to resample real prediction errors from the testset in
+        naps_path (by default, the directory above this one), "atom_sd" or
+        "d_cov" (see make_synthetic_protein)
+    missing: fraction of observed shifts to remove at random. Defaults to 0
+        for testset noise (which has the testset's missing shifts), and 0.05
+        otherwise.
+    alt_max_size, seq_max_size: largest proteins for which
+        find_alt_assignments and the sequential methods are timed
+
+    Returns a DataFrame with one row per run, with the time taken by each
+    stage and the accuracy of each method.
+    """
+    a = NAPS_assigner()
+    if config_file is not None:
+        a.read_config_file(config_file)
+    atom_sd = a.pars["atom_sd"]
+    d_cov = None
+    errors = None
+    if noise=="d_cov":
+        d_cov = pd.read_csv(d_cov_file, index_col=0)
+    elif noise=="testset":
+        if naps_path is None:
+            naps_path = Path(__file__).resolve().parent.parent
+        errors = read_testset_errors(naps_path)
+    if missing is None:
+        missing = 0 if noise=="testset" else 0.05
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # Warm up with every stage, so one-off costs aren't recorded
+        preds_long, obs = make_synthetic_protein(
+                50, atom_sd, d_cov, missing, seed=seed, errors=errors)
+        benchmark_assigner(preds_long, obs, config_file, 1, workdir, plot,
+                           True, seq_link_weight)
+
+        for n_res in sizes:
+            for r in range(repeats):
+                preds_long, obs = make_synthetic_protein(
+                        n_res, atom_sd, d_cov, missing, obs_fraction,
+                        extra_fraction, seed=seed+r, errors=errors)
+                alt = 1 if n_res<=alt_max_size else 0
+                timings, accuracy = benchmark_assigner(
+                        preds_long, obs, config_file, alt, workdir, plot,
+                        n_res<=seq_max_size, seq_link_weight)
+                row = {"n_res":n_res, "repeat":r, "n_obs":len(obs)}
+                row.update({"accuracy" if m=="best" else "accuracy_"+m:x
+                            for m, x in accuracy.items()})
+                row.update(timings)
+                row["total"] = sum(timings.values())
+                results.append(row)
+                logging.info("Benchmarked %d residues: %.2f s, accuracy %.3f",
+                             n_res, row["total"], accuracy["best"])
+                print("%6d residues  %8.2f s  accuracy %.3f" %
+                      (n_res, row["total"], accuracy["best"]))
+    return(pd.DataFrame(results))
+
+def time_imports(modules=("NAPS_importer", "NAPS_assigner", "NAPS"),
+                 repeats=5):
+    """Time how long each module takes to import in a fresh interpreter.
+
+    The interpreter startup time (importing nothing) is measured in the same
+    way, and subtracted. The fastest of repeats runs is used.
+
+    Returns a DataFrame with the import time in seconds for each module.
+    """
+    path = str(Path(__file__).resolve().parent)
+    code = ("import sys, time; sys.path.insert(0, %r); t=time.perf_counter(); "
+            "%s; print(time.perf_counter()-t)")
+
+    def run(statement):
+        times = []
+        for r in range(repeats):
+            out = subprocess.run([sys.executable, "-c", code % (path, statement)],
+                                 capture_output=True, text=True, check=True)
+            times.append(float(out.stdout.split()[-1]))
+        return(min(times))
+
+    baseline = run("pass")
+    results = []
+    for m in modules:
+        results.append({"module":m, "import_time":run("import "+m)-baseline})
+    return(pd.DataFrame(results))
+
+if __name__ == "__main__":
+    naps_path = Path(__file__).resolve().parent.parent
+    default_config = naps_path / "config"
+
+    parser = argparse.ArgumentParser(
+            description="Scalability benchmark for NAPS, using synthetic proteins.")
+    parser.add_argument("-c", "--config_file",
+                        default=str(default_config / "config.txt"),
+                        help="A file containing parameters for the analysis.")
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[100, 200, 500, 1000, 2000, 5000],
+                        help="Numbers of residues to benchmark.")
+    parser.add_argument("--noise", choices=["testset", "atom_sd", "d_cov"],
+                        default="testset",
+                        help="Resample real prediction errors from the "+
+                        "testset, or use independent errors with atom_sd "+
+                        "from the config file, or correlated errors from d_cov.")
+    parser.add_argument("--d_cov_file", default=str(default_config / "d_cov.csv"),
+                        help="Covariance of prediction errors, for --noise d_cov.")
+    parser.add_argument("--missing", type=float, default=None,
+                        help="Fraction of observed shifts to remove at random "+
+                        "(default 0 for testset noise, otherwise 0.05).")
+    parser.add_argument("--obs_fraction", type=float, default=1.0,
+                        help="Fraction of residues with an observed spin system.")
+    parser.add_argument("--extra_fraction", type=float, default=0.0,
+                        help="Number of extra spin systems with no matching "+
+                        "residue, as a fraction of the number of residues.")
+    parser.add_argument("--alt_max_size", type=int, default=200,
+                        help="Also time find_alt_assignments for proteins up "+
+                        "to this size.")
+    parser.add_argument("--seq_max_size", type=int, default=1000,
+                        help="Also time find_fragment_assignments, "+
+                        "optimise_pairwise and refine_consistency for "+
+                        "proteins up to this size.")
+    parser.add_argument("--seq_link_weight", type=float, default=2,
+                        help="seq_link_weight used by optimise_pairwise.")
+    parser.add_argument("--plot", action="store_true",
+                        help="Also time drawing and saving the strip plot.")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--import_time", action="store_true",
+                        help="Measure module import times instead.")
+    parser.add_argument("-o", "--output_file", default=None,
+                        help="A file the results table will be written to.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.import_time:
+        results = time_imports(repeats=max(args.repeats, 5))
+        print(results.to_string(index=False, float_format="%.3f"))
+        if args.output_file is not None:
+            results.to_csv(args.output_file, sep="\t", float_format="%.4f",
+                           index=False)
+        sys.exit()
+
+    results = run_benchmark(args.sizes, args.config_file, args.noise,
+                            args.d_cov_file, args.missing, args.obs_fraction,
+                            args.extra_fraction, args.alt_max_size,
+                            args.seq_max_size, args.seq_link_weight,
+                            args.repeats, args.seed, args.plot, naps_path)
+    pd.set_option("display.width", 200)
+    print(results.to_string(index=False, float_format="%.3f"))
+    if args.output_file is not None:
+        results.to_csv(args.output_file, sep="\t", float_format="%.4f",
+                       index=False)
@@ -0,0 +1,424 @@
+#!/anaconda3/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Fit the prediction error parameters used by NAPS from the testset.
+
+For each test protein, the observed shifts (from the simplified BMRB tables)
+are paired with the predicted shifts of the same residue, and the secondary
+structure of each residue is read from the HELIX and SHEET records of its PDB
+file. The testset is read once, and each protein is added to an ErrorStats
+object, which only keeps sums (counts, sums and cross-products of the
+observed shifts and prediction errors for each pair of atoms and residue
+types). Every parameter file is calculated from these sums:
+
+    atom_sd.txt         RMS error of each atom type, with and without
+                        outliers (for diagnostics only: the atom_sd values
+                        in config.txt are tuned, and much smaller)
+    atom_sd_table.csv   sds for each atom, residue type and secondary
+                        structure (for the atom_sd_table config option)
+    lin_model_<pred_type>.csv   linear correction of the predictions for
+                        each atom and residue type (for pred_correction)
+    d_mean.csv, d_cov.csv       mean and covariance of the prediction errors
+    dd_mean.csv, dd_cov.csv     the same, after the linear correction
+
+so a refit (eg. for SPARTA+ instead of SHIFTX2) takes a few seconds.
+
+eg. "python NAPS_fit.py .. -c ../config/config.txt -o ../config"
+    "python NAPS_fit.py .. --pred_dir sparta+_predictions --pred_type sparta+ -o sparta+"
+
+@author: aph516
+"""
+
+import argparse
+import logging
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from NAPS_importer import NAPS_importer, read_pdb_sec_struc
+from NAPS_assigner import NAPS_assigner
+
+atoms = ["H","N","HA","C","CA","CB","Cm1","CAm1","CBm1"]
+res_types = list("ACDEFGHIKLMNPQRSTVWY")
+sec_strucs = ["H","E","C"]
+
+def read_testset(naps_path):
+    """ Table of the test set proteins, with their observed shift, predicted
+    shift and structure files relative to the NAPS directory """
+    testset_df = pd.read_table(Path(naps_path)/"data/testset/testset.txt",
+                               header=None,
+                               names=["ID","PDB","BMRB","Resolution","Length"])
+    testset_df.index = testset_df["ID"]
+    return(testset_df)
+
+def codes(values, categories):
+    """ Integer code of each value in categories, or -1 if it isn't one """
+    lookup = dict(zip(categories, range(len(categories))))
+    return(np.array([lookup.get(v, -1) for v in values], dtype=int))
+
+def iter_testset(naps_path, pred_dir="shiftx2_results", pred_type="shiftx2",
+                 ids=None):
+    """ Read the test set one protein at a time
+
+    pred_dir: directory in data/testset with the predictions
+    pred_type: format of the predictions (shiftx2 or sparta+)
+    ids: optional list of test set IDs to use
+
+    Yields the protein name and four (residues x atoms) arrays, with columns
+    in the order of atoms: the observed shifts, the predicted shifts, and
+    codes for the residue type and secondary structure (of the i-1 residue
+    for the m1 atoms). Missing shifts are NaN, and unknown residue types -1.
+    """
+    path = Path(naps_path)/"data/testset"
+    testset_df = read_testset(naps_path)
+    if ids is not None:
+        testset_df = testset_df.loc[testset_df["ID"].isin(ids)]
+
+    for i in testset_df.index:
+        name = testset_df.loc[i,"ID"]+"_"+testset_df.loc[i,"PDB"]
+        importer = NAPS_importer()
+        obs = importer.import_testset_shifts(
+                path/"simplified_BMRB"/(str(testset_df.loc[i,"BMRB"])+".txt"),
+                remove_Pro=False)
+        a = NAPS_assigner()
+        preds = a.import_pred_shifts(path/pred_dir/(name+".cs"), pred_type)
+        sec_struc = read_pdb_sec_struc(
+                path/"PDB-testset-addHydrogens"/(name+".pdbH"))
+
+        # Observed and predicted residues have the same names if they match
+        shared = preds.index.intersection(obs.index)
+        obs = obs.loc[shared].reindex(columns=atoms)
+        preds = preds.loc[shared]
+
+        # Cysteines may be labelled B (oxidised) or C
+        res = preds["Res_type"].replace("B","C").values
+        resm1 = preds["Res_typem1"].replace("B","C").values
+
+        # Leave out the m1 atoms if the i-1 residue doesn't match (eg. if the
+        # sample was a mutant of the structure)
+        obs_res = importer.obs.drop_duplicates("Res_N").set_index("Res_N")
+        obs_resm1 = (obs_res["Res_type"].replace("B","C").
+                     reindex(preds["Res_N"].values-1).values)
+        resm1 = np.where(obs_resm1==resm1, resm1, "")
+        ss = sec_struc.reindex(preds["Res_N"].values).fillna("C").values
+        ssm1 = sec_struc.reindex(preds["Res_N"].values-1).fillna("C").values
+        m1 = np.array([atom.endswith("m1") for atom in atoms])
+
+        yield(name,
+              obs.values.astype(float),
+              preds.reindex(columns=atoms).values.astype(float),
+              np.where(m1, codes(resm1, res_types)[:,None],
+                       codes(res, res_types)[:,None]),
+              np.where(m1, codes(ssm1, sec_strucs)[:,None],
+                       codes(ss, sec_strucs)[:,None]))
+        logging.info("Read %s", name)
+
+class ErrorStats:
+    """ Sums of the observed shifts (x) and prediction errors (y = pred - obs)
+    of a set of residues, from which all of the NAPS error parameters can be
+    calculated
+
+    For every pair of atoms i and j and residue types ri and rj, the sums
+    are over the residues where both shifts are known:
+        n, sx (sum of x_i), sy (sum of y_i), sxx (sum of x_i*x_j),
+        sxy (sum of x_i*y_j) and syy (sum of y_i*y_j).
+    The diagonal (i=j) gives the statistics of each atom and residue type.
+
+    The squared errors are also summed for each atom, residue type, secondary
+    structure and size of error (in bins of bin_width ppm, with the last bin
+    holding everything above max_abs_error). This allows the median error,
+    and the sds after leaving out large errors, to be found in the same pass.
+    """
+    def __init__(self, bin_width=0.05, max_abs_error=20):
+        A, R, S = len(atoms), len(res_types), len(sec_strucs)
+        self.bin_width = bin_width
+        self.n_bins = int(round(max_abs_error/bin_width)) + 1
+        self.pair = {s: np.zeros(A*A*R*R) for s in
+                     ["n","sx","sy","sxx","sxy","syy"]}
+        self.binned_n = np.zeros(A*R*S*self.n_bins)
+        self.binned_syy = np.zeros(A*R*S*self.n_bins)
+        self.n_proteins = 0
+
+    def add(self, obs, pred, res, ss):
+        """ Add the residues of one protein (arrays from iter_testset()) """
+        A, R, S = len(atoms), len(res_types), len(sec_strucs)
+        x = obs
+        y = pred - obs
+        known = ~np.isnan(y) & (res >= 0)
+        x = np.where(known, x, 0)
+        y = np.where(known, y, 0)
+        res = np.where(known, res, 0)
+        ss = np.where(ss >= 0, ss, sec_strucs.index("C"))
+
+        # Flat index of each (residue, atom i, atom j) into the pair arrays
+        atom_i = np.arange(A)[:,None]
+        atom_j = np.arange(A)[None,:]
+        idx = (((atom_i*A + atom_j)[None,:,:]*R + res[:,:,None])*R +
+               res[:,None,:])
+        mask = known[:,:,None] & known[:,None,:]
+        idx = idx[mask]
+        terms = {"n": np.ones(mask.shape),
+                 "sx": np.broadcast_to(x[:,:,None], mask.shape),
+                 "sy": np.broadcast_to(y[:,:,None], mask.shape),
+                 "sxx": x[:,:,None]*x[:,None,:],
+                 "sxy": x[:,:,None]*y[:,None,:],
+                 "syy": y[:,:,None]*y[:,None,:]}
+        for s in self.pair:
+            self.pair[s] += np.bincount(idx, terms[s][mask],
+                                        minlength=len(self.pair[s]))
+
+        bins = np.minimum((np.abs(y)/self.bin_width).astype(int),
+                          self.n_bins-1)
+        idx = (((np.arange(A)[None,:]*R + res)*S + ss)*
+               self.n_bins + bins)[known]
+        self.binned_n += np.bincount(idx, minlength=len(self.binned_n))
+        self.binned_syy += np.bincount(idx, (y**2)[known],
+                                       minlength=len(self.binned_syy))
+        self.n_proteins += 1
+
+    def pair_sums(self):
+        """ The pair sums as (atom i x atom j x res i x res j) arrays """
+        A, R = len(atoms), len(res_types)
+        return({s: v.reshape((A,A,R,R)) for s, v in self.pair.items()})
+
+    def binned_sums(self):
+        """ The binned sums as (atom x res x sec_struc x bin) arrays """
+        shape = (len(atoms), len(res_types), len(sec_strucs), self.n_bins)
+        return(self.binned_n.reshape(shape), self.binned_syy.reshape(shape))
+
+    def lin_model(self, min_n=3):
+        """ Linear model of the prediction error against the observed shift
+        for each atom and residue type (y = Grad*x + Offset), as fitted by
+        least squares. Groups with fewer than min_n residues are left out.
+
+        Returns a DataFrame in the format of lin_model_shiftx2.csv
+        """
+        p = self.pair_sums()
+        diag = np.arange(len(atoms))
+        diag_r = np.arange(len(res_types))
+        n, sx, sy, sxx, sxy = [p[s][diag,diag][:,diag_r,diag_r] for s in
+                               ["n","sx","sy","sxx","sxy"]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grad = (n*sxy - sx*sy) / (n*sxx - sx**2)
+            offset = (sy - grad*sx) / n
+        ok = (n >= min_n) & np.isfinite(grad)
+
+        atom_idx, res_idx = np.nonzero(ok)
+        lm = pd.DataFrame({"Atom_type": np.array(atoms)[atom_idx],
+                           "Res_type": np.array(res_types)[res_idx],
+                           "Grad": grad[ok],
+                           "Offset": offset[ok]})
+        lm.index = lm["Atom_type"]+"_"+lm["Res_type"]
+        return(lm)
+
+    def error_moments(self, lm=None):
+        """ Counts, sums and sums of cross-products of the prediction errors
+        of each pair of atoms, over all residue types
+
+        If lm (from lin_model()) is given, the errors are those of the
+        corrected predictions, y - Grad*x - Offset (with no correction for
+        groups missing from lm). These are expanded in terms of the pair sums,
+        so no second pass over the data is needed.
+        """
+        p = self.pair_sums()
+        t = lambda v: v.transpose(1,0,3,2)  # Swap the roles of i and j
+        n, sy, syy = p["n"], p["sy"], p["syy"]
+        if lm is not None:
+            idx = pd.MultiIndex.from_product([atoms, res_types])
+            key = lm.set_index(["Atom_type","Res_type"])
+            shape = (len(atoms), 1, len(res_types), 1)
+            a = key["Grad"].reindex(idx).fillna(0).values.reshape(shape)
+            b = key["Offset"].reindex(idx).fillna(0).values.reshape(shape)
+            sx, sxx, sxy = p["sx"], p["sxx"], p["sxy"]
+            syy = (syy - t(a)*t(sxy) - t(b)*sy - a*sxy + a*t(a)*sxx +
+                   a*t(b)*sx - b*t(sy) + b*t(a)*t(sx) + b*t(b)*n)
+            sy = sy - a*sx - b*n
+        return(n.sum(axis=(2,3)), sy.sum(axis=(2,3)), syy.sum(axis=(2,3)))
+
+    def d_mean(self, lm=None):
+        """ Mean prediction error of each atom type """
+        n, sy, _ = self.error_moments(lm)
+        return(pd.Series(np.diag(sy)/np.diag(n), index=atoms).sort_index())
+
+    def d_cov(self, lm=None):
+        """ Covariance of the prediction errors of each pair of atom types,
+        using the residues where both are known (as DataFrame.cov() does)
+        """
+        n, sy, syy = self.error_moments(lm)
+        cov = (syy - sy*sy.T/n) / (n - 1)
+        cov = pd.DataFrame(cov, index=atoms, columns=atoms)
+        cov.index.name = "Atom_type"
+        return(cov.sort_index().sort_index(axis=1))
+
+    def n_bins_kept(self, a, max_error):
+        """ Number of error bins of atom a to keep, so that errors larger than
+        max_error robust sds are left out. The robust sd is found from the
+        median absolute error, interpolated within its bin.
+        """
+        binned_n, _ = self.binned_sums()
+        hist = binned_n[a].sum(axis=(0,1))
+        cum = np.cumsum(hist)
+        b = np.searchsorted(cum, cum[-1]/2)
+        median = self.bin_width*(b + (cum[-1]/2 - (cum[b]-hist[b]))/hist[b])
+        return(min(int(round(max_error*1.4826*median/self.bin_width)),
+                   self.n_bins-1))
+
+    def atom_sd(self, max_error=None):
+        """ Root mean square prediction error of each atom type
+
+        max_error: if given, errors larger than this many (robust) sds of the
+            atom type are left out, as in atom_sd_table(). Otherwise the sds
+            include every error, so are inflated by outliers.
+        """
+        if max_error is None:
+            n, _, syy = self.error_moments()
+            return(pd.Series(np.sqrt(np.diag(syy)/np.diag(n)), index=atoms))
+        binned_n, binned_syy = self.binned_sums()
+        sd = {}
+        for a, atom in enumerate(atoms):
+            if binned_n[a].sum()==0:
+                continue
+            keep = self.n_bins_kept(a, max_error)
+            sd[atom] = np.sqrt(binned_syy[a][...,:keep].sum() /
+                               binned_n[a][...,:keep].sum())
+        return(pd.Series(sd).reindex(atoms))
+
+    def atom_sd_table(self, sec_struc=True, prior_n=1000, max_error=5,
+                      atom_sd=None):
+        """ Prediction error sd for each atom type and residue type, and
+        optionally for each secondary structure too
+
+        prior_n: the sd of each group is shrunk towards the sd of the atom
+            type, as though the group had an extra prior_n errors of that size
+        max_error: errors larger than this many (robust) sds of the atom type
+            are left out
+        atom_sd: optional dict of sds for each atom type (eg. pars["atom_sd"]).
+            If given, the table is scaled so that the overall sd of each atom
+            type matches these, and only the differences between residue types
+            and secondary structures are taken from the errors.
+
+        The sds are the root mean square error, as NAPS assumes the errors
+        have a mean of zero. Only the i atoms are used (the m1 atoms look up
+        the sd of the i-1 residue). Returns a DataFrame with columns
+        Atom_type, Res_type, Sec_struc, N and SD, in the format read by
+        NAPS_assigner.read_atom_sd_table(). Rows that apply to any secondary
+        structure have an empty Sec_struc.
+        """
+        binned_n, binned_syy = self.binned_sums()
+        tables = []
+        for a, atom in enumerate(atoms):
+            if atom.endswith("m1"):
+                continue
+            if binned_n[a].sum()==0:
+                continue
+            keep = self.n_bins_kept(a, max_error)
+            n = binned_n[a][:,:,:keep].sum(axis=2)
+            syy = binned_syy[a][:,:,:keep].sum(axis=2)
+            atom_var = syy.sum()/n.sum()
+            scale = 1
+            if atom_sd is not None and atom in atom_sd:
+                scale = atom_sd[atom]/np.sqrt(atom_var)
+
+            groups = [(n.sum(axis=1), syy.sum(axis=1),
+                       np.full(len(res_types), ""))]
+            if sec_struc:
+                groups += [(n[:,s], syy[:,s], np.full(len(res_types), ss))
+                           for s, ss in enumerate(sec_strucs)]
+            for count, total, ss in groups:
+                tables.append(pd.DataFrame({
+                        "Atom_type": atom,
+                        "Res_type": res_types,
+                        "Sec_struc": ss,
+                        "N": count.astype(int),
+                        "SD": scale*np.sqrt((total + prior_n*atom_var) /
+                                            (count + prior_n))}).
+                        loc[count > 0])
+
+        table = pd.concat(tables, ignore_index=True)
+        return(table.sort_values(["Atom_type","Res_type","Sec_struc"]).
+               reset_index(drop=True))
+
+def fit_testset(naps_path, pred_dir="shiftx2_results", pred_type="shiftx2",
+                ids=None):
+    """ Read the test set once, and return an ErrorStats object with the sums
+    for all of its proteins """
+    stats = ErrorStats()
+    for name, obs, pred, res, ss in iter_testset(naps_path, pred_dir,
+                                                 pred_type, ids):
+        stats.add(obs, pred, res, ss)
+    return(stats)
+
+def write_parameter_files(stats, out_dir, pred_type="shiftx2", sec_struc=True,
+                          prior_n=1000, max_error=5, atom_sd=None):
+    """ Write all of the parameter files listed at the top of this module to
+    out_dir. The other arguments are passed to ErrorStats.atom_sd_table().
+
+    Returns a list of the files written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    out = Path(out_dir)
+    lm = stats.lin_model()
+
+    sd = pd.DataFrame({"RMS_all": stats.atom_sd(),
+                       "RMS": stats.atom_sd(max_error)})
+    sd.index.name = "Atom_type"
+    with open(out/"atom_sd.txt", "w") as f:
+        f.write("# RMS prediction error of each atom type, using all errors "
+                "and leaving out\n# errors above %g robust sds. For "
+                "diagnostics only, not the atom_sd config option.\n" %
+                max_error)
+        sd.to_csv(f, sep="\t", float_format="%.4f")
+    stats.atom_sd_table(sec_struc, prior_n, max_error, atom_sd).to_csv(
+            out/"atom_sd_table.csv", index=False, float_format="%.4f")
+    lm.to_csv(out/("lin_model_"+pred_type+".csv"))
+    stats.d_mean().to_csv(out/"d_mean.csv", header=False)
+    stats.d_cov().to_csv(out/"d_cov.csv")
+    stats.d_mean(lm).to_csv(out/"dd_mean.csv", header=False)
+    stats.d_cov(lm).to_csv(out/"dd_cov.csv")
+    return([out/f for f in ["atom_sd.txt", "atom_sd_table.csv",
+                            "lin_model_"+pred_type+".csv", "d_mean.csv",
+                            "d_cov.csv", "dd_mean.csv", "dd_cov.csv"]])
+
+#%%
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Fit prediction error parameters for NAPS from the "+
+            "test set.")
+    parser.add_argument("NAPS_path", help="Path to the top-level NAPS directory.")
+    parser.add_argument("-o", "--out_dir", required=True,
+                        help="Directory the parameter files will be written to.")
+    parser.add_argument("--pred_dir", default="shiftx2_results",
+                        help="Directory in data/testset with the predictions.")
+    parser.add_argument("--pred_type", choices=["shiftx2", "sparta+"],
+                        default="shiftx2")
+    parser.add_argument("--ids", nargs="+", default=None,
+                        help="Only use these test set IDs.")
+    parser.add_argument("--no_sec_struc", action="store_true",
+                        help="Only fit sds for each atom and residue type.")
+    parser.add_argument("-c", "--config_file", default=None,
+                        help="If given, the atom sd table is scaled so the "+
+                        "overall sd of each atom type matches atom_sd in "+
+                        "this config file.")
+    parser.add_argument("--prior_n", type=float, default=1000,
+                        help="Strength of the shrinkage of each sd towards "+
+                        "the sd of its atom type.")
+    parser.add_argument("--max_error", type=float, default=5)
+    parser.add_argument("-l", "--log_file", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log_file, level=logging.INFO,
+                        format="%(levelname)s %(message)s")
+
+    stats = fit_testset(args.NAPS_path, args.pred_dir, args.pred_type,
+                        args.ids)
+    atom_sd = None
+    if args.config_file is not None:
+        a = NAPS_assigner()
+        a.read_config_file(args.config_file)
+        atom_sd = a.pars["atom_sd"]
+    files = write_parameter_files(stats, args.out_dir, args.pred_type,
+                                  not args.no_sec_struc, args.prior_n,
+                                  args.max_error, atom_sd)
+    logging.info("Fitted %d proteins. Wrote %s", stats.n_proteins,
+                 ", ".join(str(f) for f in files))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for assembling spin systems into sequentially linked fragments, and
+mapping those fragments onto the sequence.
+
+Spin systems are linked using the sparse sequential link matrix (see
+NAPS_assigner.calc_link_matrix), which scores how well the i-1 shifts of one
+spin system match the i shifts of another. Each fragment is then scored
+against every window of consecutive residues in the predictions at once, so
+confident fragments can be placed before the rest of the assignment is done.
+
+@author: aph516
+"""
+
+import numpy as np
+import pandas as pd
+
+def build_fragments(link_matrix, min_link_score=2.0, min_length=2,
+                    valid=None):
+    """Greedily assemble spin systems into linear fragments.
+
+    Links are considered in order of decreasing score. A link a->b is
+    accepted if a doesn't already have a successor, b doesn't already have a
+    predecessor, and a and b aren't already in the same fragment.
+
+    link_matrix: sparse (N x N) matrix, where element [a,b] is the score for
+        spin system b following a
+    min_link_score: links scoring below this are ignored
+    min_length: only return fragments with at least this many spin systems
+    valid: optional boolean array. Invalid spin systems (eg. dummies) aren't
+        linked.
+
+    Returns a list of fragments, each a list of spin system indices in
+    sequence order.
+    """
+    link_matrix = link_matrix.tocoo()
+    n = link_matrix.shape[0]
+    a, b, score = link_matrix.row, link_matrix.col, link_matrix.data
+    keep = (score>=min_link_score) & (a!=b)
+    if valid is not None:
+        keep &= valid[a] & valid[b]
+    order = np.argsort(-score[keep], kind="stable")
+    a, b = a[keep][order].tolist(), b[keep][order].tolist()
+
+    succ = [-1]*n
+    pred = [-1]*n
+    root = list(range(n))   # Union-find, to avoid making cycles
+
+    def find(x):
+        while root[x] != x:
+            root[x] = root[root[x]]
+            x = root[x]
+        return(x)
+
+    for i, j in zip(a, b):
+        if succ[i]>=0 or pred[j]>=0:
+            continue
+        ri, rj = find(i), find(j)
+        if ri==rj:
+            continue
+        succ[i] = j
+        pred[j] = i
+        root[rj] = ri
+
+    fragments = []
+    for i in range(n):
+        if pred[i]<0 and succ[i]>=0:
+            frag = [i]
+            while succ[frag[-1]]>=0:
+                frag.append(succ[frag[-1]])
+            if len(frag)>=min_length:
+                fragments.append(frag)
+    return(fragments)
+
+def residue_windows(res_next, length):
+    """For each residue, find the following length-1 residues.
+
+    res_next: position of the following residue (-1 if none), as from
+        find_residue_links
+    length: window length
+
+    Returns an integer array of shape (length, n_residues). Row k gives the
+    residue k positions after each starting residue, or -1 if the window runs
+    off the end of a chain.
+    """
+    n = len(res_next)
+    windows = np.full((length, n), -1)
+    windows[0,:] = np.arange(n)
+    for k in range(1, length):
+        prev_row = windows[k-1,:]
+        windows[k,:] = np.where(prev_row>=0, res_next[prev_row], -1)
+    return(windows)
+
+def score_fragment_windows(fragment, log_prob, windows):
+    """Score a fragment against every window of consecutive residues.
+
+    fragment: list of spin system indices (rows of log_prob)
+    log_prob: (N_SS x N_res) array of log probabilities
+    windows: output of residue_windows, with at least len(fragment) rows
+
+    Returns an array with the total log probability of the fragment starting
+    at each residue, or -inf where the window doesn't fit.
+    """
+    n = log_prob.shape[1]
+    total = np.zeros(n)
+    for k, ss in enumerate(fragment):
+        res = windows[k,:]
+        total += np.where(res>=0, log_prob[ss, np.maximum(res, 0)], -np.inf)
+    return(total)
+
+def place_fragments(fragments, log_prob, res_next, res_valid=None,
+                    min_margin=10.0):
+    """Place fragments onto non-overlapping windows of the sequence.
+
+    Each fragment is scored against every window, and fragments are placed
+    greedily, most confident first. Confidence is the margin between the best
+    and second best window score. Fragments whose best remaining window
+    overlaps an already placed fragment are re-scored without the occupied
+    residues, and fragments without a margin of at least min_margin are left
+    unplaced. If a fragment fits only one window, the margin is instead over
+    leaving it unplaced, scored as the sum of the best log probability of
+    each of its spin systems on the free residues outside that window.
+
+    fragments: output of build_fragments
+    log_prob: (N_SS x N_res) array of log probabilities
+    res_next: position of the following residue (-1 if none)
+    res_valid: optional boolean array. Windows may not contain invalid
+        residues (eg. dummies).
+
+    Returns a list of (fragment, residues) pairs for the placed fragments.
+    """
+    if len(fragments)==0:
+        return([])
+    n_res = log_prob.shape[1]
+    windows = residue_windows(res_next, max(len(f) for f in fragments))
+    occupied = np.zeros(n_res, dtype=bool)
+    if res_valid is not None:
+        occupied |= ~np.asarray(res_valid, dtype=bool)
+
+    def best_two(frag):
+        scores = score_fragment_windows(frag, log_prob, windows)
+        w = windows[:len(frag),:]
+        blocked = ((w<0) | occupied[np.maximum(w, 0)]).any(axis=0)
+        scores[blocked] = -np.inf
+        n_fit = np.isfinite(scores).sum()
+        if n_fit>1:
+            top = np.argpartition(-scores, 1)[:2]
+            top = top[np.argsort(-scores[top])]
+            return(scores[top[0]], scores[top[1]], top[0])
+        best = int(np.argmax(scores))
+        if n_fit==0:
+            return(-np.inf, -np.inf, best)
+        # Only one window fits, so compare it with leaving the fragment
+        # unplaced
+        free = ~occupied
+        free[w[:,best]] = False
+        if not free.any():
+            return(scores[best], -np.inf, best)
+        unplaced = log_prob[np.ix_(frag, np.flatnonzero(free))].max(axis=1)
+        return(scores[best], unplaced.sum(), best)
+
+    remaining = list(range(len(fragments)))
+    placed = []
+    while remaining:
+        results = [best_two(fragments[f]) for f in remaining]
+        best = np.array([r[0] for r in results])
+        second = np.array([r[1] for r in results])
+        margins = np.full(len(results), -np.inf)
+        finite = np.isfinite(best) & np.isfinite(second)
+        margins[finite] = best[finite] - second[finite]
+        i = int(np.argmax(margins))
+        if not margins[i]>=min_margin:
+            break
+        frag = fragments[remaining[i]]
+        residues = windows[:len(frag), results[i][2]]
+        occupied[residues] = True
+        placed.append((frag, residues))
+        del remaining[i]
+    return(placed)
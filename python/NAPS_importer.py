@@ -7,11 +7,215 @@ Created on Wed Oct 17 19:08:55 2018
 
 import numpy as np
 import pandas as pd
+import io
 import itertools
 from pathlib import Path
-from Bio.SeqUtils import seq1
 from math import sqrt
-#import nmrstarlib
+from NAPS_nmrstar import NMRStar_file
+
+def seq1(seq):
+    """Convert three-letter amino acid codes to one-letter codes.
+    
+    Biopython is slow to import, so it's only imported when it's needed."""
+    from Bio.SeqUtils import seq1 as bio_seq1
+    return(bio_seq1(seq))
+
+def read_text(source):
+    """Return the contents of a file, as a string.
+    
+    source: either a path, or a file-like object (eg. an uploaded file) opened 
+        in text or binary mode
+    """
+    if hasattr(source, "read"):
+        text = source.read()
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        return(text)
+    with open(source, 'r') as f:
+        return(f.read())
+
+#### Amino acid sets
+# A set of amino acid types is stored as a 20-bit integer mask, with bit i set 
+# if AA_str[i] is in the set. This lets residue type restrictions be combined 
+# and compared with vectorised bitwise operations rather than string matching.
+AA_str = "ACDEFGHIKLMNPQRSTVWY"
+AA_all = (1 << len(AA_str)) - 1     # Mask allowing any amino acid
+
+# Lookup table from character code to bit
+_aa_bits = np.zeros(128, dtype=np.int64)
+for _i, _c in enumerate(AA_str):
+    _aa_bits[ord(_c)] = 1 << _i
+
+def _aa_codes(aa):
+    """Convert an array of strings to a 2D array of character codes, padded 
+    with zeros. Missing values become empty strings."""
+    aa = pd.Series(aa)
+    na_mask = aa.isna().values
+    arr = aa.where(~na_mask, "").astype(str).values.astype("U")
+    if arr.dtype.itemsize==0:   # All strings empty
+        return(np.zeros([len(arr), 1], dtype=np.uint32), na_mask)
+    codes = arr.view(np.uint32).reshape([len(arr), -1])
+    return(np.minimum(codes, 127), na_mask)
+
+def aa_str_to_mask(aa, na_value=AA_all):
+    """Convert strings of one-letter amino acid codes into masks.
+    
+    aa: a string, or an array/Series of strings (eg. "AVI")
+    na_value: mask used for missing values. Defaults to allowing any amino acid
+    Unrecognised characters are ignored.
+    """
+    if isinstance(aa, str):
+        return(int(aa_str_to_mask([aa], na_value)[0]))
+    codes, na_mask = _aa_codes(aa)
+    mask = np.bitwise_or.reduce(_aa_bits[codes], axis=1)
+    mask[na_mask] = na_value
+    return(mask)
+
+def aa_mask_to_str(mask):
+    """Convert masks back into strings of one-letter amino acid codes"""
+    if np.isscalar(mask):
+        return(aa_mask_to_str([mask])[0])
+    mask = np.asarray(pd.Series(mask).fillna(AA_all), dtype=np.int64)
+    result = np.full(len(mask), "", dtype="U20")
+    for i, c in enumerate(AA_str):
+        result = np.char.add(result, np.where(mask & (1 << i), c, ""))
+    return(result)
+
+def aa_mask_exclude(mask):
+    """Return the mask of all amino acids *not* in mask"""
+    return(AA_all & ~np.asarray(mask, dtype=np.int64))
+
+def aa_groups_to_mask(aa, groups):
+    """Map amino acids to the union of the groups they belong to.
+    
+    For example, with the HADAMAC groups ["VIA","G","S","T","DN","FHYWC",
+    "REKPQML"], "V" maps to the mask for "VIA", and "VG" maps to "VIAG".
+    aa: a string, or an array/Series of strings
+    groups: a list of strings, each containing the amino acids in a group
+    """
+    lut = np.zeros(128, dtype=np.int64)
+    for g in groups:
+        g_mask = aa_str_to_mask(g)
+        for c in g:
+            lut[ord(c)] |= g_mask
+    if isinstance(aa, str):
+        return(int(aa_groups_to_mask([aa], groups)[0]))
+    codes, na_mask = _aa_codes(aa)
+    mask = np.bitwise_or.reduce(lut[codes], axis=1)
+    mask[na_mask] = AA_all
+    return(mask)
+
+def shifts_long_to_wide(long_df, key_col, atoms, seq_col=None, meta_cols=[], 
+                        m1_cols=["C","CA","CB"], chain_col=None):
+    """Convert a long table of shifts (one row per atom) into a wide table 
+    (one row per residue or spin system), and add i-1 columns.
+    
+    The shifts are placed into a preallocated (residues x atoms) array using 
+    integer residue positions, so the i-1 columns are a shifted view of the 
+    same array rather than a merge of a shifted copy.
+    
+    long_df: DataFrame with columns key_col, "Atom_type" and "Shift", plus 
+        seq_col and meta_cols if these are given
+    key_col: column that uniquely identifies each residue or spin system. 
+        Becomes the index of the result.
+    atoms: atom types to keep. Atoms with no shifts are dropped.
+    seq_col: integer residue number column. If None, rows are sorted by key_col 
+        and no i-1 columns are made.
+    meta_cols: other per-residue columns to keep (eg. Res_type). The first 
+        value for each residue is used.
+    m1_cols: atom or meta columns to make i-1 copies of (with suffix "m1").
+    chain_col: optional chain identifier column. Residue numbers are then 
+        only required to be unique within a chain, and i-1 shifts are never 
+        taken from a different chain.
+    """
+    if seq_col is None:
+        pos, _ = pd.factorize(long_df[key_col], sort=True)
+    else:
+        seq = long_df[seq_col].values.astype(np.int64)
+        if len(seq)==0:
+            pos = seq
+        elif chain_col is None:
+            pos = seq - seq.min()
+        else:
+            # Give each chain its own block of positions, with a gap between 
+            # blocks so the shifted view never crosses a chain boundary
+            chain_codes, _ = pd.factorize(long_df[chain_col], sort=True)
+            grp = pd.Series(seq).groupby(chain_codes)
+            seq_min = grp.min().values
+            span = grp.max().values - seq_min + 2
+            offset = np.concatenate([[0], np.cumsum(span)[:-1]])
+            pos = seq - seq_min[chain_codes] + offset[chain_codes]
+    n_pos = pos.max()+1 if len(pos)>0 else 0
+    
+    # Row 0 of each grid is left empty, so residue position p is in row p+1 
+    # and its i-1 residue is in row p.
+    occupied, first = np.unique(pos, return_index=True)
+    if seq_col is not None and long_df[key_col].nunique() != len(occupied):
+        print("shifts_long_to_wide: %s is not unique for each %s. " % 
+              (seq_col, key_col) + "The i-1 shifts will be unreliable.")
+    
+    present = set(long_df["Atom_type"].unique())
+    atoms = [a for a in atoms if a in present]
+    atom_codes = pd.Categorical(long_df["Atom_type"], categories=atoms).codes
+    keep = atom_codes >= 0
+    grid = np.full([n_pos+1, len(atoms)], np.NaN)
+    grid[pos[keep]+1, atom_codes[keep]] = long_df["Shift"].values[keep]
+    
+    wide = {key_col: long_df[key_col].values[first]}
+    id_cols = [c for c in [chain_col, seq_col] if c is not None]
+    for c in id_cols + list(meta_cols):
+        if c != key_col:
+            wide[c] = long_df[c].values[first]
+    for j, a in enumerate(atoms):
+        wide[a] = grid[occupied+1, j]
+    
+    if seq_col is not None:
+        for c in m1_cols:
+            if c+"m1" in wide:
+                continue    # i-1 shifts were supplied directly
+            elif c in atoms:
+                wide[c+"m1"] = grid[occupied, atoms.index(c)]
+            elif c in wide:
+                meta_grid = np.full(n_pos+1, np.NaN, dtype=object)
+                meta_grid[occupied+1] = wide[c]
+                wide[c+"m1"] = pd.Series(meta_grid[occupied]).infer_objects().values
+    
+    wide = pd.DataFrame(wide, index=wide[key_col])
+    wide.index.name = None
+    return(wide)
+
+def read_pdb_sec_struc(source, chain=None):
+    """ Read the secondary structure of each residue from the HELIX and SHEET
+    records of a PDB file.
+
+    source: a path, or a file-like object
+    chain: only use this chain. If None, the first chain with ATOM records is
+        used.
+
+    Returns a Series indexed by residue number, with "H" for helix, "E" for
+    strand and "C" for everything else.
+    """
+    lines = read_text(source).splitlines()
+
+    res_N = []
+    for line in lines:
+        if line.startswith("ATOM") and line[12:16].strip()=="CA":
+            if chain is None:
+                chain = line[21]
+            if line[21]==chain:
+                res_N.append(int(line[22:26]))
+    sec_struc = pd.Series("C", index=pd.unique(np.array(res_N, dtype=int)))
+
+    # Residue ranges are in fixed columns, which differ between record types
+    for line in lines:
+        if line.startswith("HELIX") and line[19]==chain:
+            start, end, ss = int(line[21:25]), int(line[33:37]), "H"
+        elif line.startswith("SHEET") and line[21]==chain:
+            start, end, ss = int(line[22:26]), int(line[33:37]), "E"
+        else:
+            continue
+        sec_struc[(sec_struc.index>=start) & (sec_struc.index<=end)] = ss
+    return(sec_struc)
 
 class NAPS_importer:
     # Attributes
@@ -308,12 +512,14 @@ class NAPS_importer:
     def import_obs_shifts(self, filename, filetype, SS_num=False):
         """ Import a chemical shift list
         
-        filename: Path to text file containing chemical shifts.
-        filetype: Allowed values are "naps", "ccpn", "sparky", "xeasy" or 
-            "nmrpipe"
+        filename: Path to text file containing chemical shifts, or a file-like 
+            object with the same contents.
+        filetype: Allowed values are "naps", "ccpn", "sparky", "xeasy", 
+            "nmrpipe" or "nmrstar"
             The "ccpn" option is for importing a Resonance table exported from 
             Analysis v2.x. The "naps" option is for importing an unassigned 
-            shift table previously exported from NAPS
+            shift table previously exported from NAPS. The "nmrstar" option 
+            reads the assigned shifts from a BMRB NMR-STAR file.
         SS_num: If true, will extract the longest number from the SS_name and 
         treat it as the residue number. Without this, it is not possible to get
         the i-1 shifts for each spin system.
@@ -342,42 +548,38 @@ class NAPS_importer:
             obs.loc[obs["Atom_type"]=="HN", "Atom_type"] = "H"
         elif filetype=="nmrpipe":
             # Work out where the column names and data are
-            with open(filename, 'r') as f:
-                for num, line in enumerate(f, 1):
-                    if line.find("VARS")>-1:
-                        colnames_line = num
+            text = read_text(filename)
+            for num, line in enumerate(text.splitlines(), 1):
+                if line.find("VARS")>-1:
+                    colnames_line = num
             
-            obs = pd.read_table(filename, sep="\s+", skiprows=colnames_line+1, 
+            obs = pd.read_table(io.StringIO(text), sep="\s+", 
+                                skiprows=colnames_line+1, 
                                 names=["SS_name","Res_type","Atom_type","Shift"])
             obs = obs.loc[:, ["SS_name", "Atom_type", "Shift"]]
             obs["SS_name"] = obs["SS_name"].astype(str)
             obs.loc[obs["Atom_type"]=="HN", "Atom_type"] = "H"
-#        elif filetype == "nmrstar":
-#            tmp = nmrstarlib.read_files(filename)
-#            return(tmp)
+        elif filetype=="nmrstar":
+            obs = NMRStar_file(text=read_text(filename)).chem_shifts()
+            obs["SS_name"] = (obs["Res_N"].astype(str) + 
+                              obs["Res_type"].apply(seq1))
+            obs["SS_name"] = [s.rjust(5) for s in obs["SS_name"]]
+            obs = obs.loc[:, ["SS_name", "Atom_type", "Shift"]]
         else:
             print("import_obs_shifts: invalid filetype '%s'." % (filetype))
             return(None)
         
-        # Restrict to backbone atom types
-        obs = obs.loc[obs["Atom_type"].isin(["H","HA","N","C","CA","CB",
-                                             "Cm1","CAm1","CBm1"]),:]
-        
-        # Convert from long to wide
-        obs = obs.pivot(index="SS_name", columns="Atom_type", values="Shift")
-        obs.insert(0, "SS_name", obs.index.values)
-        
-        # Extract residue number from SS_name (if present), and get m1 shifts
+        # Convert from long to wide, restricting to backbone atom types. 
+        # If SS_num, extract residue number from SS_name and get m1 shifts.
+        atoms = ["H","HA","N","C","CA","CB","Cm1","CAm1","CBm1"]
+        obs = obs.loc[obs["Atom_type"].isin(atoms),:].copy()
         if SS_num:
-            obs["Res_N"] = obs["SS_name"].str.extract(r"(\d+)").astype(int)
-            
-            obs.index = obs["Res_N"]
-            obs_m1 = obs[list({"C","CA","CB"}.intersection(obs.columns))]
-            obs_m1.index = obs_m1.index+1
-            obs_m1.columns = obs_m1.columns + "m1"
-            obs = pd.merge(obs, obs_m1, how="left", 
-                           left_index=True, right_index=True)
+            obs["Res_N"] = obs["SS_name"].str.extract(r"(\d+)", 
+                                                      expand=False).astype(int)
+            obs = shifts_long_to_wide(obs, "SS_name", atoms, seq_col="Res_N")
             obs = obs.drop(columns="Res_N")
+        else:
+            obs = shifts_long_to_wide(obs, "SS_name", atoms)
         
         self.obs = obs
         return(self.obs)
@@ -392,9 +594,10 @@ class NAPS_importer:
             SS_name_2   T     ex   # to exclude T from the allowed aa types
         offset: either "i" or "i_minus_1". Whether the aa type restriction 
             applies to the i spin system or to the preceeding i-1 spin system.
-        """
-        AA_str = "ACDEFGHIKLMNPQRSTVWY"
         
+        The SS_class/SS_classm1 column of obs holds the allowed amino acids 
+        as an integer mask (see aa_str_to_mask).
+        """
         if offset=="i":
             col = "SS_class"
         elif offset=="i_minus_1":
@@ -409,82 +612,91 @@ class NAPS_importer:
         
         # For rows with Type=="in", the SS_class is the same as AA
         # For rows with Type=="ex", the SS_class is all aminos *except* AA
-        df[col] = df["AA"]
-        mask = (df["Type"]=="ex")
-        for i in df.index[mask]:
-            tmp = AA_str
-            for c in df.loc[i, "AA"]:
-                tmp = tmp.replace(c, "")
-            df.loc[i, col] = tmp
-        
-        df.index = df["SS_name"]
+        mask = aa_str_to_mask(df["AA"])
+        ex = (df["Type"]=="ex").values
+        mask[ex] = aa_mask_exclude(mask[ex])
         
         # Create SS_class column in obs DataFrame if it doesn't already exist.
-        if col not in self.obs.columns:
-            self.obs[col] = AA_str
+        # Nan's can be any amino acid
+        if col in self.obs.columns:
+            obs_mask = self.obs[col].fillna(AA_all).values.astype(np.int64)
+        else:
+            obs_mask = np.full(len(self.obs.index), AA_all, dtype=np.int64)
         
         # Write SS_class info into obs data frame. Overwrite any previous info 
         # for these spin systems, but keep SS_class info for any spin systems 
         # not in df
-        self.obs.loc[df.index, col] = df.loc[:, col]
-       
-        # Nan's can be any amino acid
-        self.obs[col] = self.obs[col].fillna(AA_str)
+        pos = self.obs.index.get_indexer(df["SS_name"])
+        obs_mask[pos[pos>=0]] = mask[pos>=0]
+        self.obs[col] = obs_mask
         
         return(self.obs)
     
     def import_testset_shifts(self, filename, remove_Pro=True, 
-                          short_aa_names=True):
+                          short_aa_names=True, filetype="table"):
         """ Import observed chemical shifts from testset data
         
         This function is intended for use with test data only, and is unlikely 
         to work well on 'real' data.
+        
+        filetype: either "table" (a simplified BMRB shift table) or "nmrstar" 
+            (a raw BMRB entry in NMR-STAR format). If an NMR-STAR file has 
+            more than one chain, the chain is kept and prefixed to SS_name.
         """
         #### Import the observed chemical shifts
-        obs_long = pd.read_table(filename)
-        obs_long = obs_long[["Residue_PDB_seq_code","Residue_label",
-                             "Atom_name","Chem_shift_value"]]
-        obs_long.columns = ["Res_N","Res_type","Atom_type","Shift"]
+        if filetype=="table":
+            obs_long = pd.read_table(filename)
+            obs_long = obs_long[["Residue_PDB_seq_code","Residue_label",
+                                 "Atom_name","Chem_shift_value"]]
+            obs_long.columns = ["Res_N","Res_type","Atom_type","Shift"]
+        elif filetype=="nmrstar":
+            obs_long = NMRStar_file(filename).chem_shifts()
+            # Keep the chain only if there's more than one
+            if ("Chain" in obs_long.columns and 
+                len(obs_long["Chain"].unique())>1):
+                obs_long = obs_long[["Chain","Res_N","Res_type","Atom_type",
+                                     "Shift"]]
+                obs_long["Chain"] = obs_long["Chain"].astype(str)
+            else:
+                obs_long = obs_long[["Res_N","Res_type","Atom_type","Shift"]]
+        else:
+            print("import_testset_shifts: invalid filetype '%s'." % (filetype))
+            return(None)
         # Convert residue type to single-letter code
+        chain_col = "Chain" if "Chain" in obs_long.columns else None
+        chain_prefix = obs_long["Chain"] if chain_col else ""
         if short_aa_names: 
             obs_long["Res_type"] = obs_long["Res_type"].apply(seq1)
-            obs_long["SS_name"] = (obs_long["Res_N"].astype(str) + 
+            obs_long["SS_name"] = (chain_prefix + obs_long["Res_N"].astype(str) + 
                     obs_long["Res_type"])
             obs_long["SS_name"] = [s.rjust(5," ") for s in obs_long["SS_name"]]
         else:
-            obs_long["SS_name"] = (obs_long["Res_N"].astype(str).rjust(4,"_") + 
+            obs_long["SS_name"] = (chain_prefix + 
+                    obs_long["Res_N"].astype(str).rjust(4,"_") + 
                     obs_long["Res_type"])
             obs_long["SS_name"] = [s.rjust(7) for s in obs_long["SS_name"]]
             obs_long["Res_type"] = obs_long["Res_type"].apply(seq1)
-        obs_long = obs_long.reindex(columns=["Res_N","Res_type","SS_name",
-                                             "Atom_type","Shift"])
-        
-        # Convert from long to wide
-        obs = obs_long.pivot(index="Res_N", columns="Atom_type", 
-                             values="Shift")
-        
-        # Add the other columns back in
-        tmp = obs_long[["Res_N","Res_type","SS_name"]]
-        tmp = tmp.drop_duplicates(subset="SS_name")
-        tmp.index = tmp["Res_N"]
-        obs = pd.concat([tmp, obs], axis=1)
+        id_cols = [chain_col] if chain_col else []
+        obs_long = obs_long.reindex(columns=id_cols+["Res_N","Res_type",
+                                                     "SS_name","Atom_type",
+                                                     "Shift"])
         
         # Add HADAMAC information
         hadamac_groups = ["VIA","G","S","T","DN","FHYWC","REKPQML"]
-        obs["SS_class"]=obs["Res_type"]
-        for g in hadamac_groups:
-            obs["SS_class"] = obs["SS_class"].str.replace("["+g+"]", g)
+        obs_long["SS_class"] = aa_groups_to_mask(obs_long["Res_type"], 
+                                                 hadamac_groups)
         
-        # Make columns for the i-1 observed shifts of C, CA and CB
-        obs_m1 = obs[list({"C","CA","CB","SS_class"}.intersection(obs.columns))]
-        obs_m1.index = obs_m1.index+1
-        obs_m1.columns = obs_m1.columns + "m1"
-        obs = pd.merge(obs, obs_m1, how="left", left_index=True, 
-                       right_index=True)
+        # Convert from long to wide, and make columns for the i-1 observed 
+        # shifts of C, CA and CB
+        obs = shifts_long_to_wide(obs_long, "SS_name", 
+                                  ["H","N","HA","C","CA","CB"], seq_col="Res_N",
+                                  meta_cols=["Res_type","SS_class"],
+                                  m1_cols=["C","CA","CB","SS_class"],
+                                  chain_col=chain_col)
         
         # Restrict to specific atom types
         atom_set = {"H","N","C","CA","CB","Cm1","CAm1","CBm1","HA","SS_classm1"}
-        obs = obs[["Res_N","Res_type","SS_name"]+
+        obs = obs[id_cols+["Res_N","Res_type","SS_name"]+
                   list(atom_set.intersection(obs.columns))]
         
         obs.index = obs["SS_name"]
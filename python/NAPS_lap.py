@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Linear assignment solver that can be cheaply re-solved after small changes.
+
+scipy's linear_sum_assignment has to start from scratch every time it is
+called. When the same assignment problem is solved many times with only one or
+two costs changed (eg. forbidding a single (SS,Res) pair, as when refining
+sequential consistency), it is much faster to keep the dual variables from the
+previous solution, unassign the affected row, and find a single shortest
+augmenting path from it. Each re-solve is then O(n^2) rather than O(n^3).
+
+@author: aph516
+"""
+
+import numpy as np
+
+class LAP_solver:
+    """ Minimum cost assignment for a square cost matrix, using shortest
+    augmenting paths (the Hungarian algorithm with dual potentials).
+
+    col_to_row: the row assigned to each column
+    u, v: row and column dual variables
+    """
+
+    def __init__(self, cost, fixed=None):
+        """Solve the assignment problem for a square cost matrix
+
+        fixed: optional list of (row, col) pairs that must be part of the
+            assignment (see fix()). They must not share a row or column.
+        """
+        self.cost = np.array(cost, dtype=float)
+        n = self.cost.shape[0]
+        if self.cost.shape != (n, n):
+            raise ValueError("LAP_solver: cost matrix must be square.")
+        self.n = n
+        # Penalty for forbidden pairs. Any assignment using one costs more than
+        # any assignment that doesn't.
+        self.big = (n+1) * (np.abs(self.cost).max()+1)
+        if fixed is not None:
+            for i, j in fixed:
+                cost_ij = self.cost[i,j]
+                self.cost[i,:] = self.big
+                self.cost[:,j] = self.big
+                self.cost[i,j] = cost_ij
+
+        self.u = np.zeros(n)
+        self.v = np.zeros(n+1)      # v[n] is for a virtual column
+        self.p = np.full(n+1, -1)   # Row assigned to each column
+        for i in range(n):
+            self._augment(i)
+
+    @property
+    def col_to_row(self):
+        return(self.p[:self.n])
+
+    @property
+    def row_to_col(self):
+        row_to_col = np.full(self.n, -1)
+        assigned = self.p[:self.n]>=0
+        row_to_col[self.p[:self.n][assigned]] = np.flatnonzero(assigned)
+        return(row_to_col)
+
+    def _augment(self, i):
+        """Assign free row i, by finding a shortest augmenting path to a free
+        column and updating the dual variables.
+        """
+        n = self.n
+        cost, u, v, p = self.cost, self.u, self.v, self.p
+        p[n] = i
+        j0 = n
+        minv = np.full(n, np.inf)
+        way = np.full(n, -1)
+        used = np.zeros(n+1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[:n]
+            cur = cost[i0] - u[i0] - v[:n]
+            better = free & (cur<minv)
+            minv[better] = cur[better]
+            way[better] = j0
+            j1 = np.argmin(np.where(free, minv, np.inf))
+            delta = minv[j1]
+            used_cols = np.flatnonzero(used)
+            u[p[used_cols]] += delta
+            v[used_cols] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if p[j0]<0:
+                break
+
+        # Flip the assignments along the augmenting path
+        while j0 != n:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+        p[n] = -1
+
+    def forbid(self, rows, cols):
+        """Forbid all pairs between rows and cols, and re-solve.
+
+        Only the rows that were assigned to one of cols need to be re-assigned,
+        each with a single augmenting path.
+        """
+        rows = np.atleast_1d(rows)
+        cols = np.atleast_1d(cols)
+        self.cost[np.ix_(rows, cols)] = self.big
+        # Raising costs keeps the duals feasible, so just unassign the
+        # affected rows and augment from them
+        broken = cols[np.isin(self.p[cols], rows)]
+        free_rows = self.p[broken].copy()
+        self.p[broken] = -1
+        for i in free_rows:
+            self._augment(i)
+
+    def trial_forbid(self, rows, cols):
+        """Return the col_to_row assignment that would result from
+        forbid(rows, cols), without changing the solver.
+        """
+        rows = np.atleast_1d(rows)
+        cols = np.atleast_1d(cols)
+        state = (self.u.copy(), self.v.copy(), self.p.copy(),
+                 self.cost[np.ix_(rows, cols)].copy())
+        self.forbid(rows, cols)
+        col_to_row = self.col_to_row.copy()
+        self.u, self.v, self.p = state[0], state[1], state[2]
+        self.cost[np.ix_(rows, cols)] = state[3]
+        return(col_to_row)
+
+    def fix(self, i, j):
+        """Fix row i to column j, by forbidding every other pair involving
+        either of them. Row i must already be assigned to column j.
+        """
+        if self.p[j] != i:
+            raise ValueError("LAP_solver: can only fix an existing pair.")
+        cost_ij = self.cost[i,j]
+        self.cost[i,:] = self.big
+        self.cost[:,j] = self.big
+        self.cost[i,j] = cost_ij
+
+    def total_cost(self):
+        """Total cost of the current assignment"""
+        return(self.cost[self.col_to_row, np.arange(self.n)].sum())
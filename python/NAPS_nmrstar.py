@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal reader for NMR-STAR (BMRB) files, supporting v2.1 and v3.x tag names.
+
+The file is tokenised once, and an index of the saveframes and loops is built
+from the tokens. Loops are only converted into DataFrames when they are
+requested, so reading a large BMRB entry only costs one pass over the text
+plus the work needed for the loops that are actually used (normally the
+chemical shift and sample condition loops).
+
+@author: aph516
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+# Token kinds
+_VALUE, _TAG, _LOOP, _STOP, _SAVE, _DATA, _GLOBAL = range(7)
+
+# Single regex used to tokenise the whole file. Alternatives are tried in
+# order, so semicolon-delimited text fields and quoted strings take priority
+# over bare words, and comments are only recognised at the start of a token.
+_token_re = re.compile(r"""
+      ^;(?P<semi>.*?)^;         # Multi-line text field
+    | \#[^\n]*                  # Comment
+    | '(?P<sq>[^\n]*?)'(?=\s|$) # Single-quoted value
+    | "(?P<dq>[^\n]*?)"(?=\s|$) # Double-quoted value
+    | (?P<bare>\S+)             # Everything else
+    """, re.MULTILINE | re.DOTALL | re.VERBOSE)
+
+# Tags for the chemical shift loop, as (v2.1, v3.x) pairs. Where there is more
+# than one option for a column, the first one present in the file is used, and
+# rows where it is missing (".") are filled in from the later ones.
+_shift_tags = {"Res_N":[("_Residue_PDB_seq_code", "_Atom_chem_shift.Auth_seq_ID"),
+                        ("_Residue_seq_code", "_Atom_chem_shift.Seq_ID")],
+               "Res_type":[("_Residue_label", "_Atom_chem_shift.Comp_ID")],
+               "Atom_type":[("_Atom_name", "_Atom_chem_shift.Atom_ID")],
+               "Shift":[("_Chem_shift_value", "_Atom_chem_shift.Val")],
+               "Chain":[(None, "_Atom_chem_shift.Auth_asym_ID"),
+                        (None, "_Atom_chem_shift.Entity_assembly_ID")]}
+
+_condition_tags = {"Type":("_Variable_type", "_Sample_condition_variable.Type"),
+                   "Value":("_Variable_value", "_Sample_condition_variable.Val")}
+
+class NMRStar_file:
+    """ An NMR-STAR file, indexed by saveframe and loop.
+
+    saveframes: dict of saveframe name -> {"category", "tags", "loops"}, where
+        tags is a dict of the free (non-loop) tags and loops is a list of
+        indexes into self.loops
+    loops: list of dicts with the saveframe name, the loop tags, and the range
+        of value tokens belonging to the loop
+    """
+
+    def __init__(self, filename=None, text=None):
+        """Read an NMR-STAR file.
+
+        filename: Path to an NMR-STAR file. Ignored if text is given.
+        text: The contents of an NMR-STAR file, as a string.
+        """
+        if text is None:
+            with open(filename, 'r') as f:
+                text = f.read()
+
+        self.data_name = None
+        self.saveframes = {}
+        self.loops = []
+        self._loop_cache = {}
+        self._tokenise(text)
+        self._build_index()
+
+    def _tokenise(self, text):
+        """Split the text into a list of tokens, and record the kind of each"""
+        tokens = []
+        kinds = []
+        for m in _token_re.finditer(text):
+            group = m.lastgroup
+            if group=="bare":
+                tok = m.group(group)
+                kind = _VALUE
+                # Only tokens starting with these characters can be keywords
+                if tok[0] in "_lsdgLSDG":
+                    low = tok.lower()
+                    if tok[0]=="_":
+                        kind = _TAG
+                    elif low=="loop_":
+                        kind = _LOOP
+                    elif low=="stop_":
+                        kind = _STOP
+                    elif low.startswith("save_"):
+                        kind = _SAVE
+                    elif low.startswith("data_"):
+                        kind = _DATA
+                    elif low=="global_":
+                        kind = _GLOBAL
+            elif group=="semi":
+                tok, kind = m.group(group).strip("\n"), _VALUE
+            elif group is not None:
+                tok, kind = m.group(group), _VALUE
+            else:
+                continue    # Comment
+            tokens.append(tok)
+            kinds.append(kind)
+
+        self._tokens = tokens
+        self._kinds = kinds
+
+    def _build_index(self):
+        """Walk the token list once to find the saveframes and loops"""
+        tokens = self._tokens
+        kinds = self._kinds
+        n = len(tokens)
+        sf_name = None
+        i = 0
+        while i < n:
+            kind = kinds[i]
+            if kind==_DATA:
+                self.data_name = tokens[i][5:]
+                i += 1
+            elif kind==_SAVE:
+                name = tokens[i][5:]
+                if name:    # Start of saveframe
+                    sf_name = name
+                    self.saveframes[sf_name] = {"category":None, "tags":{},
+                                                "loops":[]}
+                else:       # End of saveframe
+                    sf_name = None
+                i += 1
+            elif kind==_LOOP:
+                i += 1
+                tags = []
+                while i < n and kinds[i]==_TAG:
+                    tags.append(tokens[i])
+                    i += 1
+                start = i
+                while i < n and kinds[i]==_VALUE:
+                    i += 1
+                self.loops.append({"saveframe":sf_name, "tags":tags,
+                                   "start":start, "end":i})
+                if sf_name is not None:
+                    self.saveframes[sf_name]["loops"].append(len(self.loops)-1)
+                if i < n and kinds[i]==_STOP:
+                    i += 1
+            elif kind==_TAG:
+                tag = tokens[i]
+                if i+1 < n and kinds[i+1]==_VALUE:
+                    value = tokens[i+1]
+                    i += 2
+                else:
+                    value = None
+                    i += 1
+                if sf_name is not None:
+                    sf = self.saveframes[sf_name]
+                    sf["tags"][tag] = value
+                    if (tag=="_Saveframe_category" or
+                        tag.endswith(".Sf_category")):
+                        sf["category"] = value
+            else:
+                i += 1
+
+    def find_saveframes(self, category):
+        """Return the names of all saveframes with a given category"""
+        return([k for k, v in self.saveframes.items()
+                if v["category"]==category])
+
+    def find_loops(self, tag):
+        """Return the indexes of all loops that contain a given tag"""
+        return([i for i, l in enumerate(self.loops) if tag in l["tags"]])
+
+    def get_loop(self, i):
+        """Return loop i as a DataFrame, with the leading underscore removed
+        from the column names.
+
+        Missing values ("." or "?") are converted to NaN, and any column that
+        can be fully converted to numbers is made numeric. The result is
+        cached, so a loop is only converted once. Raises ValueError if the 
+        number of values doesn't fit the number of tags.
+        """
+        if i in self._loop_cache:
+            return(self._loop_cache[i])
+
+        loop = self.loops[i]
+        ncol = len(loop["tags"])
+        values = np.array(self._tokens[loop["start"]:loop["end"]], dtype=object)
+        if ncol==0 or len(values) % ncol != 0:
+            raise ValueError("get_loop: loop %d has %d values for %d tags." %
+                             (i, len(values), ncol))
+
+        df = pd.DataFrame(values.reshape([-1, ncol]),
+                          columns=[t.lstrip("_") for t in loop["tags"]])
+        df = df.replace({".":np.NaN, "?":np.NaN})
+        for c in df.columns:
+            try:
+                df[c] = pd.to_numeric(df[c])
+            except (ValueError, TypeError):
+                pass
+
+        self._loop_cache[i] = df
+        return(df)
+
+    def _first_loop(self, tags):
+        """Return (index, version) of the first loop containing any of tags,
+        where tags is a (v2.1, v3.x) pair."""
+        for v, tag in enumerate(tags):
+            if tag is None:
+                continue
+            found = self.find_loops(tag)
+            if found:
+                return(found[0], v)
+        return(None, None)
+
+    def chem_shifts(self, shift_list=0):
+        """Return the assigned chemical shifts as a long DataFrame.
+
+        The columns are Res_N, Res_type, Atom_type and Shift (plus Chain, if
+        the file contains chain information). Residue types are left as
+        three-letter codes. Author residue numbers (and chains) are used if
+        the loop has any, with rows that have no author number left out.
+        Only if none are given is the internal numbering (Seq_ID and
+        Entity_assembly_ID) used, so numbering is consistent within the loop.
+        shift_list: which chemical shift list to use, if there is more than one
+        
+        Raises ValueError if there is no such chemical shift list.
+        """
+        # Shift loops are the ones with both an atom name and a shift value
+        # (chemical shift referencing loops also have a shift value)
+        loops = []
+        for version in [0, 1]:
+            atom_tag = _shift_tags["Atom_type"][0][version]
+            shift_tag = _shift_tags["Shift"][0][version]
+            loops += [(i, version) for i in self.find_loops(shift_tag)
+                      if atom_tag in self.loops[i]["tags"]]
+        if len(loops) <= shift_list:
+            raise ValueError("chem_shifts: chemical shift list %d not found." %
+                             shift_list)
+        i, version = loops[shift_list]
+        tags = self.loops[i]["tags"]
+        df = self.get_loop(i)
+
+        # Each column comes from a single tag, so that residue numbers and 
+        # chains are consistent down the loop. Later options are only used 
+        # if the earlier ones are missing or empty for every row.
+        shifts = pd.DataFrame(index=df.index)
+        for col, options in _shift_tags.items():
+            for opt in options:
+                tag = opt[version]
+                if tag is None or tag not in tags:
+                    continue
+                if df[tag.lstrip("_")].notna().any():
+                    shifts[col] = df[tag.lstrip("_")]
+                    break
+
+        shifts = shifts.dropna(subset=["Res_N", "Shift"])
+        shifts["Res_N"] = shifts["Res_N"].astype(int)
+        return(shifts.reset_index(drop=True))
+
+    def sample_conditions(self):
+        """Return a dictionary of sample conditions (eg. pH, temperature).
+
+        Values are taken from the first sample conditions loop in the file.
+        Keys are lower case, and "pH*" is treated as "pH".
+        """
+        i, version = self._first_loop(_condition_tags["Type"])
+        if i is None:
+            return({})
+        df = self.get_loop(i)
+        type_col = _condition_tags["Type"][version].lstrip("_")
+        value_col = _condition_tags["Value"][version].lstrip("_")
+
+        conditions = {}
+        for var_type, value in zip(df[type_col], df[value_col]):
+            key = str(var_type).strip().rstrip("*")
+            key = "pH" if key.lower()=="ph" else key.lower()
+            if key not in conditions:
+                conditions[key] = value
+        return(conditions)
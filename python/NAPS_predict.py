@@ -0,0 +1,327 @@
+#!/anaconda3/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Generate predicted shifts with SHIFTX2 or SPARTA+ for a set of structures.
+
+Structures are run in parallel, each predictor run has a timeout, and failed
+runs are logged and retried. Outputs are written to a temporary file and only
+renamed once the predictor has finished, and a .key file next to each output
+records a hash of the structure file contents, the predictor and its
+arguments (eg. pH and temperature). Outputs with a matching key are skipped,
+so an interrupted run can simply be restarted.
+
+The structures can be the NAPS test set (with pH and temperature taken from
+the BMRB files), or a list of PDB files. Each model of an NMR ensemble can be
+predicted separately with --split_models.
+
+eg. "python NAPS_predict.py --testset .. -o ../data/testset/shiftx2_results"
+    "python NAPS_predict.py ensemble.pdb --split_models -o preds --pH 7"
+
+@author: aph516
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pandas as pd
+
+# Arguments passed to each predictor. {pdb} and {out} are the input and output
+# files, and {pH} and {temperature} the sample conditions.
+predictor_args = {
+        "shiftx2": ["-i","{pdb}","-o","{out}","-p","{pH}","-t","{temperature}"],
+        "sparta+": ["-in","{pdb}","-out","{out}"]}
+predictor_cmd = {"shiftx2": "shiftx2.py", "sparta+": "sparta+"}
+
+def testset_jobs(naps_path, out_dir):
+    """ Make a table of prediction jobs for the NAPS test set
+
+    pH and temperature are taken from the corrected BMRB files, with defaults
+    of 6 and 298 K if they are missing.
+
+    Returns a DataFrame with columns Name, PDB_file, Out_file, pH, Temperature
+    """
+    from NAPS_nmrstar import NMRStar_file
+
+    path = Path(naps_path)
+    testset_df = pd.read_table(path/"data/testset/testset.txt", header=None,
+                               names=["ID","PDB","BMRB","Resolution","Length"])
+
+    # Get pH and temperature from the BMRB files
+    conditions = {}
+    for f in sorted((path/"data/testset/CS-corrected-testset-addPDBresno").iterdir()):
+        star = NMRStar_file(f)
+        tmp = star.sample_conditions()
+        conditions[star.data_name] = (tmp.get("pH", 6),
+                                      tmp.get("temperature", 298))
+
+    names = testset_df["ID"]+"_"+testset_df["PDB"]
+    jobs = pd.DataFrame({
+            "Name": names,
+            "PDB_file": [str(path/"data/testset/PDB-testset-addHydrogens"/(n+".pdbH"))
+                         for n in names],
+            "Out_file": [str(Path(out_dir)/(n+".cs")) for n in names],
+            "pH": [conditions.get(str(b), (6, 298))[0]
+                   for b in testset_df["BMRB"]],
+            "Temperature": [conditions.get(str(b), (6, 298))[1]
+                            for b in testset_df["BMRB"]]})
+    return(jobs)
+
+def split_models(pdb_file, out_dir):
+    """ Split a multi-model PDB file (eg. an NMR ensemble) into one file per
+    model, named <name>_model<N>.pdb, in out_dir.
+
+    Returns a list of the model files, or [pdb_file] if there are no MODEL
+    records.
+    """
+    with open(pdb_file) as f:
+        lines = f.readlines()
+
+    models = []
+    model = None
+    for line in lines:
+        if line.startswith("MODEL"):
+            model = [line]
+        elif line.startswith("ENDMDL") and model is not None:
+            model.append(line)
+            models.append(model)
+            model = None
+        elif model is not None:
+            model.append(line)
+    if len(models)==0:
+        return([pdb_file])
+
+    os.makedirs(out_dir, exist_ok=True)
+    stem = Path(pdb_file).stem
+    model_files = []
+    for i, model in enumerate(models):
+        model_file = os.path.join(out_dir, "%s_model%d.pdb" % (stem, i+1))
+        with open(model_file, "w") as f:
+            f.writelines(model + ["END\n"])
+        model_files.append(model_file)
+    return(model_files)
+
+def file_stems(files):
+    """ File names without their directories or extensions, which must be
+    unique as outputs are named after them
+    """
+    stems = pd.Series([Path(f).stem for f in files])
+    duplicates = stems[stems.duplicated()].unique()
+    if len(duplicates)>0:
+        raise ValueError("More than one PDB file is named %s, so their "
+                         "outputs would overwrite each other." %
+                         ", ".join(duplicates))
+    return(list(stems))
+
+def pdb_jobs(pdb_files, out_dir, pH=6, temperature=298, split=False):
+    """ Make a table of prediction jobs for a list of PDB files
+
+    If split is True, each model in the PDB files is predicted separately.
+    Outputs are named after the PDB files, so a ValueError is raised if two
+    files have the same name (eg. a.pdb in different directories).
+
+    Returns a DataFrame with columns Name, PDB_file, Out_file, pH, Temperature
+    """
+    names = file_stems(pdb_files)
+    if split:
+        pdb_files = [m for f in pdb_files for m in
+                     split_models(f, os.path.join(out_dir, "models"))]
+        names = file_stems(pdb_files)
+    jobs = pd.DataFrame({
+            "Name": names,
+            "PDB_file": [str(f) for f in pdb_files],
+            "Out_file": [os.path.join(out_dir, n+".cs") for n in names],
+            "pH": pH,
+            "Temperature": temperature})
+    return(jobs)
+
+def prediction_key(pdb_file, predictor, args):
+    """ Hash of everything a prediction depends on: the contents of the
+    structure file, the predictor, and its arguments (with the file names
+    left out, so moving files doesn't invalidate outputs)
+    """
+    h = hashlib.sha256()
+    with open(pdb_file, "rb") as f:
+        h.update(f.read())
+    h.update(("\n".join([predictor] + args)).encode("utf-8"))
+    return(h.hexdigest())
+
+def kill_process_group(proc):
+    """ Kill a predictor and any processes it has started """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        proc.kill()
+    proc.communicate()
+
+def run_prediction(job, predictor="shiftx2", cmd=None, extra_args=[],
+                   timeout=600, retries=2, force=False):
+    """ Run the predictor for one job (a row of a jobs table)
+
+    cmd: list with the predictor executable and any arguments that come before
+        the predictor_args (eg. ["python", "shiftx2.py"])
+    extra_args: arguments added after the predictor_args (eg. ["-n"] to turn
+        off SHIFTY in SHIFTX2)
+    timeout: seconds before a run is killed
+    retries: number of times a failed run is repeated
+    force: run even if the output is already up to date
+
+    Returns a dict with the job Name, Status (done, skipped or failed), the
+    number of Attempts, the Time taken and the last Error.
+    """
+    if cmd is None:
+        cmd = [predictor_cmd[predictor]]
+    conditions = {"pH":job["pH"], "temperature":job["Temperature"]}
+    result = {"Name":job["Name"], "Status":"done", "Attempts":0, "Time":0.0,
+              "Error":None}
+    try:
+        key = prediction_key(job["PDB_file"], predictor,
+                             [a.format(pdb="", out="", **conditions) for a in
+                              predictor_args[predictor]] + extra_args)
+    except OSError as e:
+        # Don't abort the other jobs if one structure can't be read
+        result["Status"] = "failed"
+        result["Error"] = "could not read structure: %s" % e
+        logging.error("%s failed: %s", job["Name"], result["Error"])
+        return(result)
+    key_file = job["Out_file"] + ".key"
+
+    if not force and os.path.exists(job["Out_file"]) and os.path.exists(key_file):
+        with open(key_file) as f:
+            if f.read().strip()==key:
+                result["Status"] = "skipped"
+                return(result)
+
+    # The predictor writes to a temporary file, so that an interrupted run
+    # never leaves a complete-looking output
+    tmp_file = job["Out_file"] + ".part"
+    args = [a.format(pdb=job["PDB_file"], out=tmp_file, **conditions)
+            for a in predictor_args[predictor]]
+    start = time.time()
+    for attempt in range(1, retries+2):
+        result["Attempts"] = attempt
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        # Start a new session, so the predictor's own subprocesses can be
+        # killed on a timeout too
+        proc = subprocess.Popen(list(cmd) + args + list(extra_args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(proc)
+            result["Error"] = "timed out after %g s" % timeout
+        else:
+            if proc.returncode!=0:
+                result["Error"] = ("exit status %d: %s" %
+                    (proc.returncode, err.decode(errors="replace").strip()[-500:]))
+            elif not os.path.exists(tmp_file):
+                result["Error"] = "no output file was written"
+            else:
+                os.replace(tmp_file, job["Out_file"])
+                with open(key_file, "w") as f:
+                    f.write(key+"\n")
+                result["Error"] = None
+                break
+        if attempt <= retries:
+            logging.warning("%s failed (%s), retrying", job["Name"],
+                            result["Error"])
+    else:
+        result["Status"] = "failed"
+        logging.error("%s failed after %d attempts: %s", job["Name"],
+                      result["Attempts"], result["Error"])
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    result["Time"] = time.time() - start
+    return(result)
+
+def run_predictions(jobs, predictor="shiftx2", cmd=None, extra_args=[],
+                    workers=None, timeout=600, retries=2, force=False):
+    """ Run the predictor for each row of a jobs table, in parallel
+
+    Each job runs the predictor as a separate process, so the worker pool
+    only needs threads to start and wait for them. The other arguments are
+    passed to run_prediction().
+
+    Returns a DataFrame with one row per job (see run_prediction()).
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    for out_dir in set(os.path.dirname(f) for f in jobs["Out_file"]):
+        os.makedirs(out_dir or ".", exist_ok=True)
+
+    def run(job):
+        result = run_prediction(job, predictor, cmd, extra_args, timeout,
+                                retries, force)
+        logging.info("%s %s (%d attempts, %.1f s)", result["Name"],
+                     result["Status"], result["Attempts"], result["Time"])
+        return(result)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run, [row for _, row in jobs.iterrows()]))
+    return(pd.DataFrame(results, columns=["Name","Status","Attempts","Time","Error"]))
+
+#%%
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Generate predicted shifts with SHIFTX2 or SPARTA+ "+
+            "for a set of structures, in parallel.")
+    parser.add_argument("pdb_files", nargs="*",
+                        help="PDB files to make predictions for.")
+    parser.add_argument("--testset", default=None,
+                        help="Make predictions for the NAPS test set. The "+
+                        "value is the path to the top-level NAPS directory.")
+    parser.add_argument("-o", "--out_dir", required=True,
+                        help="Directory for the predicted shifts.")
+    parser.add_argument("--predictor", choices=["shiftx2", "sparta+"],
+                        default="shiftx2")
+    parser.add_argument("--cmd", default=None,
+                        help="Command to run the predictor, eg. "+
+                        "'python /opt/shiftx2/shiftx2.py'.")
+    parser.add_argument("--extra_args", default="",
+                        help="Extra arguments for the predictor, eg. '-n' to "+
+                        "run SHIFTX2 without SHIFTY.")
+    parser.add_argument("--pH", type=float, default=6)
+    parser.add_argument("--temperature", type=float, default=298)
+    parser.add_argument("--split_models", action="store_true",
+                        help="Predict each model in the PDB files separately.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of predictors to run at once. Defaults "+
+                        "to the number of CPUs.")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Seconds before a predictor run is killed.")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="Number of times to retry a failed run.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rerun predictions that are already up to date.")
+    parser.add_argument("-l", "--log_file", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(filename=args.log_file, level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.testset is not None:
+        jobs = testset_jobs(args.testset, args.out_dir)
+    else:
+        try:
+            jobs = pdb_jobs(args.pdb_files, args.out_dir, args.pH,
+                            args.temperature, args.split_models)
+        except ValueError as e:
+            parser.error(str(e))
+    cmd = shlex.split(args.cmd) if args.cmd is not None else None
+
+    results = run_predictions(jobs, args.predictor, cmd,
+                              shlex.split(args.extra_args), args.workers,
+                              args.timeout, args.retries, args.force)
+    print(results.to_string(index=False))
+    print(results["Status"].value_counts().to_string())
+    if (results["Status"]=="failed").any():
+        raise SystemExit(1)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timing and memory instrumentation for the stages of a NAPS run.
+
+Each stage is wrapped in a Profiler.stage() context manager, which records
+the wall time, and optionally the peak memory allocated (with tracemalloc) and
+a cProfile dump of the stage. A disabled Profiler does nothing, so the hooks
+can be left in place for normal runs.
+
+@author: aph516
+"""
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Profiler:
+    """ Records per-stage timings for a NAPS run.
+
+    stages: list of dicts, one per completed stage, with the stage name, wall
+        time in seconds and (if memory is True) peak traced memory in MB
+    """
+
+    def __init__(self, enabled=True, memory=False, cprofile_dir=None,
+                 callback=None):
+        """
+        enabled: if False, stage() does nothing
+        memory: if True, record the peak memory allocated during each stage
+        cprofile_dir: if given, a cProfile dump for each stage is written to
+            <cprofile_dir>/<stage>.prof
+        callback: optional function, called with the stage name whenever a
+            stage starts (even if the Profiler isn't enabled), eg. to report
+            progress
+        """
+        self.enabled = enabled
+        self.callback = callback
+        self.memory = memory
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+        self._profiling = False
+        if enabled and cprofile_dir is not None:
+            os.makedirs(cprofile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block, and record it as stage name"""
+        if self.callback is not None:
+            self.callback(name)
+        if not self.enabled:
+            yield
+            return
+
+        started_tracing = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+
+        # Only one cProfile profiler can be active, so nested stages are
+        # covered by the outer stage's dump
+        profile = None
+        if self.cprofile_dir is not None and not self._profiling:
+            profile = cProfile.Profile()
+            self._profiling = True
+            profile.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = {"stage":name, "time":elapsed}
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+                filename = os.path.join(self.cprofile_dir, name+".prof")
+                profile.dump_stats(filename)
+                record["cprofile"] = filename
+            if self.memory:
+                record["peak_memory_mb"] = tracemalloc.get_traced_memory()[1]/1e6
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+
+    def report(self):
+        """Return the timings as a dictionary"""
+        return({"total_time":sum(s["time"] for s in self.stages),
+                "stages":self.stages})
+
+    def write_json(self, filename):
+        """Write the timing report to a JSON file"""
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
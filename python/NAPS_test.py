@@ -26,6 +26,9 @@ parser.add_argument("--ID_start", default="A003", help="Start at this ID")
 parser.add_argument("--ID_end", default="A069", help="Finish at this ID")
 parser.add_argument("-t", "--test", nargs="+", default="all", 
                     help="Specify a particular test to run.")
+parser.add_argument("--nmrstar", action="store_true", 
+                    help="Read observed shifts directly from the raw BMRB "+
+                    "NMR-STAR files, rather than the simplified tables.")
 
 if True:
     args = parser.parse_args()
@@ -45,7 +48,12 @@ path = Path(args.NAPS_path)
 # Import metadata on the test datasets
 testset_df = pd.read_table(path/"data/testset/testset.txt", header=None, 
                            names=["ID","PDB","BMRB","Resolution","Length"])
-testset_df["obs_file"] = [path/x for x in "data/testset/simplified_BMRB/"+testset_df["BMRB"].astype(str)+".txt"]
+if args.nmrstar:
+    testset_df["obs_file"] = [path/x for x in "data/testset/CS-corrected-testset-addPDBresno/"+testset_df["ID"]+"_bmr"+testset_df["BMRB"].astype(str)+".str.corr.pdbresno"]
+    shift_type = "test_nmrstar"
+else:
+    testset_df["obs_file"] = [path/x for x in "data/testset/simplified_BMRB/"+testset_df["BMRB"].astype(str)+".txt"]
+    shift_type = "test"
 testset_df["preds_file"] = [path/x for x in "data/testset/shiftx2_results/"+testset_df["ID"]+"_"+testset_df["PDB"]+".cs"]
 testset_df["out_name"] = testset_df["ID"]+"_"+testset_df["BMRB"].astype(str)
 testset_df.index = testset_df["ID"]
@@ -183,7 +191,7 @@ if args.assign and ("basic" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(), 
                 testset_df.loc[i, "preds_file"].as_posix(),
                 (path/("output/testset/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(),
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2",
                 "-c", (path/"config/config_plot.txt").as_posix(),
                 "-l", (path/("output/testset/"+testset_df.loc[i, "out_name"]+".log")).as_posix(),
@@ -207,7 +215,7 @@ if args.assign and ("delta_correlation" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(),
                 testset_df.loc[i, "preds_file"].as_posix(), 
                 (path/("output/delta_correlation/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(),
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2",
                 "-c", (path/"config/config_delta_corr.txt").as_posix(),
                 "-l", (path/("output/delta_correlation/"+testset_df.loc[i, "out_name"]+".log")).as_posix()]
@@ -230,7 +238,7 @@ if args.assign and ("alt_assignments" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(), 
                 testset_df.loc[i, "preds_file"].as_posix(), 
                 (path/("output/alt_assign/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(), 
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2",
                 "-c", (path/"config/config_alt_assign.txt").as_posix(),
                 "-l", (path/("output/alt_assign/"+testset_df.loc[i, "out_name"]+".log")).as_posix()]
@@ -264,7 +272,7 @@ if args.assign and ("alt_hnco" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(), 
                 testset_df.loc[i, "preds_file"].as_posix(), 
                 (path/("output/alt_hnco/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(), 
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2", 
                 "-c", (path/"config/config_alt_hnco.txt").as_posix(),
                 "-l", (path/("output/alt_hnco/"+testset_df.loc[i, "out_name"]+".log")).as_posix()]
@@ -297,7 +305,7 @@ if args.assign and ("alt_hnco_hncacb" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(), 
                 testset_df.loc[i, "preds_file"].as_posix(), 
                 (path/("output/alt_hnco_hncacb/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(), 
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2", 
                 "-c", (path/"config/config_alt_hnco_hncacb.txt").as_posix(),
                 "-l", (path/("output/alt_hnco_hncacb/"+testset_df.loc[i, "out_name"]+".log")).as_posix()]
@@ -330,7 +338,7 @@ if args.assign and ("alt_ca_co" in args.test or "all" in args.test):
                 testset_df.loc[i, "obs_file"].as_posix(), 
                 testset_df.loc[i, "preds_file"].as_posix(), 
                 (path/("output/alt_ca_co/"+testset_df.loc[i, "out_name"]+".txt")).as_posix(), 
-                "--shift_type", "test",
+                "--shift_type", shift_type,
                 "--pred_type", "shiftx2", 
                 "-c", (path/"config/config_alt_ca_co.txt").as_posix(),
                 "-l", (path/("output/alt_ca_co/"+testset_df.loc[i, "out_name"]+".log")).as_posix()]
@@ -0,0 +1,63 @@
+#!/anaconda3/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for SHIFTX2, for testing NAPS_predict.py without the real predictor.
+
+It takes the same -i, -o, -p and -t arguments as shiftx2.py, and writes a
+SHIFTX2 format csv file with approximate random coil shifts for each residue
+in the PDB file, plus some variation that depends on the atom coordinates.
+--delay and --fail_rate can be used to test timeouts and retries.
+
+eg. "python NAPS_predict.py model.pdb -o preds --cmd 'python standin_predictor.py'"
+
+@author: aph516
+"""
+
+import argparse
+import random
+import sys
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from NAPS_benchmark import random_coil, structural_sd
+from NAPS_importer import seq1
+
+parser = argparse.ArgumentParser(description="Stand-in for SHIFTX2.")
+parser.add_argument("-i", "--infile", required=True)
+parser.add_argument("-o", "--outfile", required=True)
+parser.add_argument("-p", "--ph", type=float, default=6)
+parser.add_argument("-t", "--temperature", type=float, default=298)
+parser.add_argument("-n", "--noshifty", action="store_true")
+parser.add_argument("--delay", type=float, default=0,
+                    help="Seconds to wait before writing the output.")
+parser.add_argument("--fail_rate", type=float, default=0,
+                    help="Probability of exiting with an error.")
+args = parser.parse_args()
+
+time.sleep(args.delay)
+if random.random() < args.fail_rate:
+    sys.exit("standin_predictor: simulated failure")
+
+# Residue numbers, types and coordinates from the CA atoms
+residues = []
+with open(args.infile) as f:
+    for line in f:
+        if line.startswith(("ATOM", "HETATM")) and line[12:16].strip()=="CA":
+            residues.append((int(line[22:26]), seq1(line[17:20]), line[30:54]))
+
+rows = []
+for res_N, res_type, coords in residues:
+    if res_type not in random_coil.index:
+        continue
+    # The same structure always gives the same shifts
+    rng = np.random.default_rng(zlib.crc32((coords+str(args.ph)).encode()))
+    shifts = (random_coil.loc[res_type] +
+              rng.normal(0, 0.2, len(random_coil.columns)) *
+              structural_sd[random_coil.columns].values)
+    for atom in ["C","CA","CB","H","HA","N"]:
+        if not np.isnan(shifts[atom]):
+            rows.append((res_N, res_type, atom, round(shifts[atom], 4)))
+
+pd.DataFrame(rows, columns=["NUM","RES","ATOMNAME","SHIFT"]).to_csv(
+        args.outfile, index=False)
@@ -8,7 +8,7 @@ Created on Tue Jan 29 11:51:28 2019
 
 import numpy as np
 import pandas as pd
-from NAPS_importer import NAPS_importer
+from NAPS_importer import NAPS_importer, aa_mask_to_str
 from NAPS_assigner import NAPS_assigner
 from pathlib import Path
 from scipy.stats import norm
@@ -99,6 +99,7 @@ tmp = rank_dist.lookup(common_residues, common_residues)
 tmp = obs.loc[:,["SS_name", "SS_classm1"]]
 tmp["Type"] = "in"
 tmp = tmp.dropna()
+tmp["SS_classm1"] = aa_mask_to_str(tmp["SS_classm1"])
 tmp.to_csv(path/"data/SS_class_info.txt", sep="\t", header=False, index=False)
 #%%
 def calc_log_prob_matrix2(assigner, default_prob=0.01):
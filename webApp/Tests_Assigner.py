@@ -0,0 +1,262 @@
+import unittest, os, sys, io
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+from scipy.stats import norm
+from NAPS import runNAPS
+from NAPS_assigner import NAPS_assigner
+from NAPS_importer import NAPS_importer
+
+testsetPath = os.path.dirname(os.path.realpath(__file__)) + '/../data/testset/'
+obsFile = testsetPath + 'simplified_BMRB/4834.txt'
+predFile = testsetPath + 'shiftx2_results/A003_1LM4B.cs'
+configFile = os.path.dirname(os.path.realpath(__file__)) + '/../config/config.txt'
+
+def makeAssigner(preds=None, models=None, ensemble_method='mean'):
+    """An assigner for the testset protein, with the testset predictions, or
+    the given preds DataFrame or ensemble of models"""
+    a = NAPS_assigner()
+    a.read_config_file(configFile)
+    a.pars['ensemble_method'] = ensemble_method
+    a.obs = NAPS_importer().import_testset_shifts(obsFile)
+    if models is not None:
+        a.combine_pred_ensemble(models)
+    elif preds is not None:
+        a.preds = preds.copy()
+    else:
+        a.import_pred_shifts(predFile, 'shiftx2')
+    a.add_dummy_rows()
+    return a
+
+def importPreds():
+    return NAPS_assigner().import_pred_shifts(predFile, 'shiftx2')
+
+atomSDTable = """Atom_type,Res_type,Sec_struc,N,SD
+CA,A,,100,1.5
+CA,A,H,50,1.0
+CA,G,,100,
+C,G,,100,2.0
+"""
+
+def pdbText():
+    """A small PDB file, with chains A and B of 6 residues each. Residues 2-4 
+    of chain A are helix, and residues 3-5 of chain B are strand"""
+    lines = ["HELIX" + " "*14 + "A " + "%4d" % 2 + " "*8 + "%4d" % 4,
+             "SHEET" + " "*16 + "B" + "%4d" % 3 + " "*7 + "%4d" % 5]
+    for chain in "AB":
+        for res_N in range(1, 7):
+            lines.append("ATOM  %5d  CA  ALA %s%4d" % (res_N, chain, res_N))
+    return "\n".join(lines) + "\n"
+
+class Tests_Assigner(unittest.TestCase):
+    def test_calcLogProbMatrix2_overlappingNames_matchesDirectCalculation(self):
+        # In the testset, spin systems are named after their residues, so
+        # obs and preds labels overlap but are in a different order
+        a = makeAssigner()
+        log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+        atoms = a.pars['atom_set'].intersection(a.obs.columns)
+
+        obs = a.obs.loc[~a.obs['Dummy_SS']].iloc[:15]
+        preds = a.preds.loc[~a.preds['Dummy_res']].iloc[:15]
+        for ss in obs.index:
+            for res in preds.index:
+                expected = 0
+                for atom in atoms:
+                    delta = float(preds.loc[res, atom]) - float(obs.loc[ss, atom])
+                    if np.isnan(delta):
+                        expected += np.log10(0.01)
+                    else:
+                        expected += norm.logpdf(delta, scale=a.pars['atom_sd'][atom])
+                self.assertAlmostEqual(log_prob_matrix.loc[ss, res], expected)
+
+    def test_calcLogProbMatrix2_identicalEnsemble_matchesSingleModel(self):
+        preds = importPreds()
+        single = makeAssigner(preds).calc_log_prob_matrix2(sf=1)
+        for method in ['mean', 'mixture']:
+            a = makeAssigner(models=[preds]*3, ensemble_method=method)
+            log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+            np.testing.assert_allclose(log_prob_matrix.values,
+                                       single.loc[log_prob_matrix.index,
+                                                  log_prob_matrix.columns].values)
+
+    def test_calcLogProbMatrix2_meanEnsemble_inflatesSDByModelVariance(self):
+        preds = importPreds()
+        preds2 = preds.copy()
+        preds2['CA'] = preds2['CA'] + 0.6
+        a = makeAssigner(models=[preds, preds2], ensemble_method='mean')
+        log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+
+        # The mean prediction, scored with the variance of the two models
+        # (0.6**2/2) added to the CA sd
+        mean = preds.copy()
+        mean['CA'] = mean['CA'] + 0.3
+        b = makeAssigner(mean)
+        atom_sd = dict(b.pars['atom_sd'])
+        atom_sd['CA'] = np.sqrt(atom_sd['CA']**2 + 0.6**2/2)
+        expected = b.calc_log_prob_matrix2(atom_sd=atom_sd, sf=1)
+        np.testing.assert_allclose(log_prob_matrix.values,
+                                   expected.loc[log_prob_matrix.index,
+                                                log_prob_matrix.columns].values)
+
+    def test_calcLogProbMatrix2_mixtureEnsemble_matchesLogSumExpOfModels(self):
+        preds = importPreds()
+        preds2 = preds.copy()
+        preds2['CA'] = preds2['CA'] + 0.6
+        preds2['N'] = preds2['N'] - 1.0
+        a = makeAssigner(models=[preds, preds2], ensemble_method='mixture')
+        log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+
+        matrices = [makeAssigner(p).calc_log_prob_matrix2(sf=1).loc[
+                        log_prob_matrix.index, log_prob_matrix.columns].values
+                    for p in [preds, preds2]]
+        expected = logsumexp(np.stack(matrices), axis=0) - np.log(2)
+        np.testing.assert_allclose(log_prob_matrix.values, expected)
+
+    def test_calcLogProbMatrix2_residueMissingFromModel_usesOtherModels(self):
+        preds = importPreds()
+        missing = preds.index[10]
+        preds2 = preds.drop(index=missing)
+
+        # The mean is the prediction from the model that has the residue, with
+        # no variance added
+        single = makeAssigner(preds).calc_log_prob_matrix2(sf=1)
+        a = makeAssigner(models=[preds, preds2], ensemble_method='mean')
+        log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+        np.testing.assert_allclose(log_prob_matrix.values,
+                                   single.loc[log_prob_matrix.index,
+                                              log_prob_matrix.columns].values)
+
+        # In the mixture, the model without the residue scores it as if all its
+        # shifts were missing
+        a = makeAssigner(models=[preds, preds2], ensemble_method='mixture')
+        log_prob_matrix = a.calc_log_prob_matrix2(sf=1)
+        no_shifts = preds.copy()
+        atoms = list({'H','N','HA','C','CA','CB','Cm1','CAm1','CBm1'}
+                     .intersection(preds.columns))
+        no_shifts.loc[missing, atoms] = np.NaN
+        matrices = [makeAssigner(p).calc_log_prob_matrix2(sf=1).loc[
+                        log_prob_matrix.index, log_prob_matrix.columns].values
+                    for p in [preds, no_shifts]]
+        expected = logsumexp(np.stack(matrices), axis=0) - np.log(2)
+        np.testing.assert_allclose(log_prob_matrix.values, expected)
+        self.assertFalse(np.allclose(log_prob_matrix[missing], single[missing]))
+
+    def test_predAtomSD_atomSDTable_usesTypeAndSecStrucValues(self):
+        a = NAPS_assigner()
+        a.read_config_file(configFile)
+        a.read_atom_sd_table(io.StringIO(atomSDTable))
+        a.preds = pd.DataFrame({"Res_type":["A","G","A","L"],
+                                "Res_typem1":[np.NaN,"A","G","A"],
+                                "Sec_struc":["H","C","C","H"],
+                                "Sec_strucm1":[np.NaN,"H","C","C"]},
+                               index=["1A","2G","3A","4L"])
+        atom_sd = a.pars['atom_sd']
+
+        # Secondary structure value, then residue type value, then atom_sd if
+        # the table has no entry or an empty SD
+        np.testing.assert_allclose(a.pred_atom_sd('CA'),
+                                   [1.0, atom_sd['CA'], 1.5, atom_sd['CA']])
+        np.testing.assert_allclose(a.pred_atom_sd('C'),
+                                   [atom_sd['C'], 2.0, atom_sd['C'], atom_sd['C']])
+        np.testing.assert_allclose(a.pred_atom_sd('N'), [atom_sd['N']]*4)
+
+        # m1 atoms use the type and secondary structure of the i-1 residue
+        np.testing.assert_allclose(a.pred_atom_sd('CAm1'),
+                                   [atom_sd['CAm1'], 1.0, atom_sd['CAm1'], 1.5])
+        np.testing.assert_allclose(a.pred_atom_sd('Cm1'),
+                                   [atom_sd['Cm1'], atom_sd['Cm1'], 2.0, 
+                                    atom_sd['Cm1']])
+
+    def test_addPredSecStruc_predOffset_shiftsResidueNumbers(self):
+        a = NAPS_assigner()
+        a.pars['pred_offset'] = 10
+        a.preds = pd.DataFrame({"Res_N":range(11, 17)})
+        a.add_pred_sec_struc(io.StringIO(pdbText()))
+
+        # The first chain is used
+        self.assertEqual(list(a.preds["Sec_struc"]), list("CHHHCC"))
+        self.assertEqual(list(a.preds["Sec_strucm1"].fillna("")), 
+                         [""] + list("CHHHC"))
+
+    def test_addPredSecStruc_chainColumn_usesEachResiduesChain(self):
+        a = NAPS_assigner()
+        a.preds = pd.DataFrame({"Res_N":[2, 5, 3, 6], 
+                                "Chain":["A", "A", "B", "B"]})
+        a.add_pred_sec_struc(io.StringIO(pdbText()))
+        self.assertEqual(list(a.preds["Sec_struc"]), list("HCEC"))
+        self.assertEqual(list(a.preds["Sec_strucm1"]), list("CHCE"))
+
+    def test_findBestAssignments_componentCutoff_matchesFullSolution(self):
+        a = makeAssigner()
+        a.calc_log_prob_matrix2(sf=1)
+        full = a.find_best_assignments().sort_values('SS_name')
+        for cutoff in [-20, -80]:
+            a.pars['component_cutoff'] = cutoff
+            matching = a.find_best_assignments().sort_values('SS_name')
+            self.assertEqual(list(matching['Res_name']), list(full['Res_name']))
+
+    def test_refineConsistency_startingMatching_keepsConsistentResidues(self):
+        a = makeAssigner()
+        a.calc_log_prob_matrix2(sf=1)
+        start = a.find_fragment_assignments()
+        refined = a.refine_consistency(start)
+        a.make_assign_df(start, set_assign_df=True)
+        start_df = a.check_assignment_consistency(threshold=0.1)
+        a.make_assign_df(refined, set_assign_df=True)
+        refined_df = a.check_assignment_consistency(threshold=0.1)
+
+        n_atoms = len(a.prepare_consistency_arrays()['seq_atoms'])
+        def consistent(df):
+            return (df['Num_good_links_prev'] == n_atoms) & (df['Num_good_links_next'] == n_atoms)
+        kept = start_df.loc[consistent(start_df), ['SS_name', 'Res_name']]
+        merged = kept.merge(refined_df[['SS_name', 'Res_name']], how='left',
+                            on='Res_name', suffixes=['', '_refined'])
+        self.assertEqual(list(merged['SS_name']), list(merged['SS_name_refined']))
+        self.assertGreaterEqual(consistent(refined_df).sum(), consistent(start_df).sum())
+
+    def test_refineConsistency_unknownResidueInMatching_ignoresPair(self):
+        a = makeAssigner()
+        a.calc_log_prob_matrix2(sf=1)
+        start = a.find_fragment_assignments().reset_index(drop=True)
+        unknown = start.copy()
+        unknown.loc[0, 'Res_name'] = 'unknown'
+        refined = a.refine_consistency(unknown)
+        expected = a.refine_consistency(start.drop(index=0))
+        self.assertEqual(sorted(zip(refined['SS_name'], refined['Res_name'])),
+                         sorted(zip(expected['SS_name'], expected['Res_name'])))
+
+    def test_optimisePairwise_recalculatedLogProbMatrix_recalculatesLinkMatrix(self):
+        a = makeAssigner()
+        a.pars['seq_link_weight'] = 2
+        a.calc_log_prob_matrix2(sf=1)
+        first = a.calc_link_matrix()
+        self.assertIs(a.calc_link_matrix(), first)
+
+        a.calc_log_prob_matrix2(sf=1)
+        matching = a.optimise_pairwise(n_steps=1000, seed=0)
+        self.assertIsNot(a.link_matrix, first)
+        self.assertEqual((a.link_matrix != first).nnz, 0)
+        self.assertEqual(len(matching), len(a.log_prob_matrix.index))
+
+    def test_runNAPS_seqLinkWeight_givesSameResultEachRun(self):
+        results = [runNAPS([obsFile, predFile, '--shift_type', 'test',
+                            '-c', configFile], 
+                           pars={'plot_strips':False, 'seq_link_weight':2})
+                   for i in range(2)]
+        self.assertTrue(results[0]['assign_df'].equals(results[1]['assign_df']))
+
+    def test_runNAPS_testsetProtein_assignsMostResiduesCorrectly(self):
+        results = runNAPS([obsFile, predFile, '--shift_type', 'test',
+                           '-c', configFile], pars={'plot_strips':False})
+        assign_df = results['assign_df']
+        assign_df = assign_df.loc[~assign_df['Dummy_SS'] & ~assign_df['Dummy_res']]
+        correct = (assign_df['SS_name'] == assign_df['Res_name']).sum()
+
+        # 142 residues were correct when obs and preds were misaligned
+        self.assertGreaterEqual(correct, 155)
+
+if __name__ == '__main__':
+    unittest.main()
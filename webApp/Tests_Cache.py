@@ -0,0 +1,133 @@
+import unittest, os, sys, time, json, tempfile
+
+webAppPath = os.path.dirname(os.path.realpath(__file__))
+mainNAPSfilePath = webAppPath + '/../python'
+sys.path.append(webAppPath)
+sys.path.append(mainNAPSfilePath)
+from cache import ResultCache, inputKeys
+from jobs import JobQueue
+from args import Args
+
+dataPath = webAppPath + '/../data/P3a_L273R/'
+
+class Tests_Cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        # Args uses a config file path relative to the python directory
+        self.cwd = os.getcwd()
+        os.chdir(mainNAPSfilePath)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpDir.cleanup()
+
+    def makeArgs(self, shift_upload):
+        args = Args(webAppPath, {'shift_type':'naps', 'pred_type':'shiftx2'})
+        args.shift_upload = shift_upload
+        args.pred_file = dataPath + 'shiftx2.cs'
+        args.result_key, args.preds_key = inputKeys(args)
+        return args
+
+    def test_cache_putAndGet_returnsSameResult(self):
+        cache = ResultCache(self.tmpDir.name)
+        result = {'headers':['SS_name'], 'result':'[{"SS_name": "1A"}]', 'plot':''}
+        cache.putResult('key', result)
+        self.assertEqual(cache.getResult('key'), result)
+        self.assertIsNone(cache.getResult('missing'))
+
+    def test_cache_overMaxBytes_evictsLeastRecentlyUsed(self):
+        cache = ResultCache(self.tmpDir.name, max_bytes=2500)
+        result = {'result':'x'*1000}
+        cache.putResult('a', result)
+        time.sleep(0.01)
+        cache.putResult('b', result)
+        time.sleep(0.01)
+        cache.getResult('a')
+        time.sleep(0.01)
+        cache.putResult('c', result)
+        self.assertIsNotNone(cache.getResult('a'))
+        self.assertIsNone(cache.getResult('b'))
+        self.assertIsNotNone(cache.getResult('c'))
+
+    def test_cache_differentObservedShifts_sharePredsKey(self):
+        with open(dataPath + 'naps_shifts.txt') as shift_file:
+            shifts = shift_file.read()
+        args1 = self.makeArgs(shifts)
+        args2 = self.makeArgs(shifts + '\n')
+        args3 = self.makeArgs(shifts)
+        self.assertNotEqual(args1.result_key, args2.result_key)
+        self.assertEqual(args1.preds_key, args2.preds_key)
+        self.assertEqual(args1.result_key, args3.result_key)
+
+    def test_cache_jobs_storeResultsAndPreds(self):
+        with open(dataPath + 'naps_shifts.txt') as shift_file:
+            shifts = shift_file.read()
+        cache = ResultCache(self.tmpDir.name)
+        jobQueue = JobQueue(max_workers=1, cache=cache)
+        try:
+            args1 = self.makeArgs(shifts)
+            args2 = self.makeArgs(shifts + '\n')
+            result1 = jobQueue.result(jobQueue.submit(args1), timeout=120)
+            result2 = jobQueue.result(jobQueue.submit(args2), timeout=120)
+        finally:
+            jobQueue.shutdown()
+        self.assertEqual(cache.getResult(args1.result_key), result1)
+        self.assertEqual(result1['result'], result2['result'])
+        files = os.listdir(self.tmpDir.name)
+        self.assertEqual(len([f for f in files if f.startswith('preds_')]), 1)
+        self.assertEqual(len([f for f in files if f.startswith('result_')]), 2)
+
+    def test_cache_assignmentEvent_sendsHeadersAndTableKey(self):
+        with open(dataPath + 'naps_shifts.txt') as shift_file:
+            shifts = shift_file.read()
+        cache = ResultCache(self.tmpDir.name)
+        jobQueue = JobQueue(max_workers=1, cache=cache)
+        try:
+            args = self.makeArgs(shifts)
+            job_id = jobQueue.submit(args)
+            jobQueue.result(job_id, timeout=120)
+            events = jobQueue.get(job_id).events()
+        finally:
+            jobQueue.shutdown()
+        names = [event for event, data in events]
+        assignment = json.loads(events[names.index('assignment')][1])
+        self.assertNotIn('result', assignment)
+        table = cache.getTable(assignment['key'])
+        self.assertEqual(list(table.columns), assignment['headers'])
+        self.assertGreater(len(table.index), 0)
+
+    def test_cache_tiledPlotJob_storesTiles(self):
+        with open(dataPath + 'naps_shifts.txt') as shift_file:
+            shifts = shift_file.read()
+        with open('../config/config.txt') as config_file:
+            config = config_file.read()
+        config = config.replace('plot_strips     False', 'plot_strips     True')
+        config = config.replace('plot_tile_size  0', 'plot_tile_size  40')
+        config = config.replace('plot_method     plotnine', 'plot_method     matplotlib')
+        configPath = os.path.join(self.tmpDir.name, 'config.txt')
+        with open(configPath, 'w') as config_file:
+            config_file.write(config)
+
+        cache = ResultCache(os.path.join(self.tmpDir.name, 'cache'))
+        jobQueue = JobQueue(max_workers=1, cache=cache)
+        try:
+            args = Args(webAppPath, {'shift_type':'naps', 'pred_type':'shiftx2'})
+            args.shift_upload = shifts
+            args.pred_file = dataPath + 'shiftx2.cs'
+            args.config_file = configPath
+            args.result_key, args.preds_key = inputKeys(args)
+            result = jobQueue.result(jobQueue.submit(args), timeout=120)
+        finally:
+            jobQueue.shutdown()
+        self.assertEqual(result['plot'], '')
+        self.assertEqual(result['tiles']['key'], args.result_key)
+        tiles = result['tiles']['tiles']
+        self.assertGreater(len(tiles), 1)
+        self.assertEqual(sum(tile['n_res'] for tile in tiles),
+                         len(json.loads(result['result'])))
+        for tile in tiles:
+            self.assertTrue(cache.getTile(args.result_key, tile['tile'])
+                            .startswith(b'\x89PNG'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest, os, sys
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+import numpy as np
+import pandas as pd
+from NAPS_assigner import NAPS_assigner
+from NAPS_fit import ErrorStats, atoms, fit_testset, iter_testset
+
+napsPath = os.path.dirname(os.path.realpath(__file__)) + '/..'
+configPath = napsPath + '/config/'
+
+class Tests_Fit(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stats = fit_testset(napsPath)
+
+    def test_atomSDTable_testset_reproducesConfigTable(self):
+        a = NAPS_assigner()
+        a.read_config_file(configPath + 'config.txt')
+        table = self.stats.atom_sd_table(prior_n=1000, max_error=5,
+                                         atom_sd=a.pars['atom_sd'])
+        expected = pd.read_csv(configPath + 'atom_sd_table.csv',
+                               keep_default_na=False)
+
+        self.assertEqual(list(table['Atom_type']), list(expected['Atom_type']))
+        self.assertEqual(list(table['Res_type']), list(expected['Res_type']))
+        self.assertEqual(list(table['Sec_struc']), list(expected['Sec_struc']))
+        self.assertEqual(list(table['N']), list(expected['N']))
+        np.testing.assert_allclose(table['SD'], expected['SD'], atol=1e-4)
+
+    def test_atomSD_maxError_leavesOutOutliers(self):
+        sd_all = self.stats.atom_sd()
+        sd = self.stats.atom_sd(max_error=5)
+        self.assertTrue((sd < sd_all).all())
+        self.assertTrue((sd > 0.5*sd_all).all())
+
+    def test_dCov_fewProteins_matchesPandas(self):
+        ids = ['A002', 'A003']
+        stats = ErrorStats()
+        errors = []
+        for name, obs, pred, res, ss in iter_testset(napsPath, ids=ids):
+            stats.add(obs, pred, res, ss)
+            errors.append(pd.DataFrame(np.where(res >= 0, pred - obs, np.NaN),
+                                       columns=atoms))
+        errors = pd.concat(errors)
+        self.assertEqual(stats.n_proteins, 2)
+
+        expected = errors.cov().sort_index().sort_index(axis=1)
+        np.testing.assert_allclose(stats.d_cov().values, expected.values)
+        np.testing.assert_allclose(stats.d_mean().values,
+                                   errors.mean().sort_index().values)
+
+if __name__ == '__main__':
+    unittest.main()
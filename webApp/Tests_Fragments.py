@@ -0,0 +1,47 @@
+import unittest, os, sys, warnings
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+import numpy as np
+from NAPS_fragments import place_fragments
+
+# Residues 0-2 are a chain, and residue 3 is on its own, so a fragment of three
+# spin systems fits only the window starting at residue 0
+resNext = np.array([1, 2, -1, -1])
+
+class Tests_Fragments(unittest.TestCase):
+    def test_placeFragments_twoWindows_usesMarginOverSecondBest(self):
+        res_next = np.array([1, 2, 3, -1])
+        log_prob = np.full((2, 4), -10.0)
+        log_prob[0, 1], log_prob[1, 2] = -1, -1
+        placed = place_fragments([[0, 1]], log_prob, res_next, min_margin=10)
+        self.assertEqual(list(placed[0][1]), [1, 2])
+
+        # The window starting at residue 2 scores 9 less
+        self.assertEqual(place_fragments([[0, 1]], log_prob, res_next, 
+                                         min_margin=19), [])
+
+    def test_placeFragments_oneWindow_usesMarginOverUnplaced(self):
+        log_prob = np.full((3, 4), -50.0)
+        log_prob[[0, 1, 2], [0, 1, 2]] = -1
+        placed = place_fragments([[0, 1, 2]], log_prob, resNext, min_margin=20)
+        self.assertEqual(list(placed[0][1]), [0, 1, 2])
+
+        # The spin systems fit residue 3 as well as the window, so there's no 
+        # margin for placing the fragment
+        log_prob = np.full((3, 4), -10.0)
+        self.assertEqual(place_fragments([[0, 1, 2]], log_prob, resNext, 
+                                         min_margin=20), [])
+
+    def test_placeFragments_noWindowLeft_leavesFragmentWithoutWarnings(self):
+        log_prob = np.full((6, 4), -50.0)
+        log_prob[[0, 1, 2], [0, 1, 2]] = -1
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            placed = place_fragments([[0, 1, 2], [3, 4, 5]], log_prob, resNext,
+                                     min_margin=20)
+        self.assertEqual(len(placed), 1)
+        self.assertEqual(placed[0][0], [0, 1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
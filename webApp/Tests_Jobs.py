@@ -0,0 +1,71 @@
+import unittest, os, sys, json
+
+webAppPath = os.path.dirname(os.path.realpath(__file__))
+mainNAPSfilePath = webAppPath + '/../python'
+sys.path.append(webAppPath)
+sys.path.append(mainNAPSfilePath)
+from jobs import JobQueue
+from args import Args
+
+dataPath = webAppPath + '/../data/P3a_L273R/'
+
+class Tests_Jobs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Args uses a config file path relative to the python directory
+        cls.cwd = os.getcwd()
+        os.chdir(mainNAPSfilePath)
+        cls.jobQueue = JobQueue(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.jobQueue.shutdown()
+        os.chdir(cls.cwd)
+
+    def makeArgs(self, shift_file):
+        args = Args(webAppPath, {'shift_type':'naps', 'pred_type':'shiftx2'})
+        args.shift_file = shift_file
+        with open(dataPath + 'shiftx2.cs') as pred_file:
+            args.pred_upload = pred_file.read()
+        return args
+
+    def test_jobs_submitValidJob_finishesWithResults(self):
+        args = self.makeArgs(dataPath + 'naps_shifts.txt')
+        job_id = self.jobQueue.submit(args)
+        self.assertIn(self.jobQueue.status(job_id), ['queued', 'running', 'finished'])
+
+        result = self.jobQueue.result(job_id, timeout=120)
+        self.assertEqual(self.jobQueue.status(job_id), 'finished')
+        self.assertIn('SS_name', result['headers'])
+        rows = json.loads(result['result'])
+        self.assertGreater(len(rows), 0)
+        self.assertEqual(list(rows[0].keys()), result['headers'])
+        self.assertFalse(os.path.exists(args.directory))
+
+    def test_jobs_submitValidJob_reportsProgressEvents(self):
+        args = self.makeArgs(dataPath + 'naps_shifts.txt')
+        job_id = self.jobQueue.submit(args)
+        result = self.jobQueue.result(job_id, timeout=120)
+
+        events = self.jobQueue.get(job_id).events()
+        names = [event for event, data in events]
+        stages = [json.loads(data)['stage'] for event, data in events if event == 'stage']
+        self.assertIn('calc_log_prob_matrix', stages)
+        self.assertIn('find_best_assignments', stages)
+        self.assertLess(stages.index('calc_log_prob_matrix'), names.index('assignment'))
+        assignment = json.loads(events[names.index('assignment')][1])
+        self.assertEqual(assignment['headers'], result['headers'])
+        self.assertEqual(self.jobQueue.get(job_id).events(len(events)), [])
+
+    def test_jobs_submitMissingFile_fails(self):
+        args = self.makeArgs(dataPath + 'missing.txt')
+        job_id = self.jobQueue.submit(args)
+        with self.assertRaises(Exception):
+            self.jobQueue.result(job_id, timeout=120)
+        self.assertEqual(self.jobQueue.status(job_id), 'failed')
+
+    def test_jobs_unknownJob_statusUnknown(self):
+        self.assertEqual(self.jobQueue.status('not_a_job'), 'unknown')
+
+if __name__ == '__main__':
+    unittest.main()
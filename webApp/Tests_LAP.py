@@ -0,0 +1,101 @@
+import unittest, os, sys
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from NAPS_lap import LAP_solver
+
+def scipyCost(cost):
+    rows, cols = linear_sum_assignment(cost)
+    return cost[rows, cols].sum()
+
+def randomCost(seed, n=30):
+    # Costs are minus log probabilities, so are positive
+    return np.random.RandomState(seed).uniform(0, 50, size=(n, n))
+
+class Tests_LAP(unittest.TestCase):
+    def test_init_randomMatrices_matchesScipy(self):
+        for seed in range(5):
+            cost = randomCost(seed)
+            solver = LAP_solver(cost)
+            rows, cols = linear_sum_assignment(cost)
+
+            self.assertEqual(list(solver.row_to_col), list(cols))
+            self.assertEqual(sorted(solver.col_to_row), list(range(30)))
+            self.assertAlmostEqual(solver.total_cost(), cost[rows, cols].sum())
+
+    def test_forbid_repeatedly_matchesScipyFromScratch(self):
+        cost = randomCost(10)
+        solver = LAP_solver(cost)
+        expected_cost = cost.copy()
+        for k in range(10):
+            # Forbid the pair currently assigned to column k
+            i = solver.col_to_row[k]
+            solver.forbid(i, k)
+            expected_cost[i, k] = solver.big
+
+            self.assertNotEqual(solver.col_to_row[k], i)
+            self.assertAlmostEqual(solver.total_cost(), scipyCost(expected_cost))
+
+    def test_forbid_blockOfPairs_matchesScipy(self):
+        cost = randomCost(11)
+        solver = LAP_solver(cost)
+        rows, cols = np.array([0, 3, 5]), np.array([solver.row_to_col[0], 7, 8])
+        solver.forbid(rows, cols)
+        expected_cost = cost.copy()
+        expected_cost[np.ix_(rows, cols)] = solver.big
+
+        self.assertAlmostEqual(solver.total_cost(), scipyCost(expected_cost))
+        self.assertFalse(np.isin(solver.row_to_col[rows], cols).any())
+
+    def test_trialForbid_matchesForbidAndLeavesSolverUnchanged(self):
+        cost = randomCost(12)
+        solver = LAP_solver(cost)
+        before = solver.col_to_row.copy()
+        i = solver.col_to_row[4]
+
+        trial = solver.trial_forbid(i, 4)
+        self.assertEqual(list(solver.col_to_row), list(before))
+        self.assertAlmostEqual(solver.total_cost(), scipyCost(cost))
+
+        solver.forbid(i, 4)
+        self.assertEqual(list(trial), list(solver.col_to_row))
+
+    def test_fix_thenForbid_keepsFixedPair(self):
+        cost = randomCost(13)
+        solver = LAP_solver(cost)
+        i = solver.col_to_row[2]
+        solver.fix(i, 2)
+        expected_cost = solver.cost.copy()
+        for k in [0, 1, 3]:
+            j = solver.col_to_row[k]
+            solver.forbid(j, k)
+            expected_cost[j, k] = solver.big
+
+        self.assertEqual(solver.col_to_row[2], i)
+        self.assertAlmostEqual(solver.total_cost(), scipyCost(expected_cost))
+        with self.assertRaises(ValueError):
+            solver.fix(i, 5)
+
+    def test_init_fixedPairs_matchesScipyWithPairsFixed(self):
+        cost = randomCost(14)
+        fixed = [(0, 5), (6, 1), (9, 9)]
+        solver = LAP_solver(cost, fixed=fixed)
+
+        # Solve the remaining rows and columns from scratch
+        free_rows = np.setdiff1d(np.arange(30), [i for i, j in fixed])
+        free_cols = np.setdiff1d(np.arange(30), [j for i, j in fixed])
+        expected = (scipyCost(cost[np.ix_(free_rows, free_cols)]) +
+                    sum(cost[i, j] for i, j in fixed))
+
+        for i, j in fixed:
+            self.assertEqual(solver.col_to_row[j], i)
+        self.assertAlmostEqual(solver.total_cost(), expected)
+
+    def test_init_nonSquareMatrix_raisesValueError(self):
+        with self.assertRaises(ValueError):
+            LAP_solver(np.zeros((3, 4)))
+
+if __name__ == '__main__':
+    unittest.main()
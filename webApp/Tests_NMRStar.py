@@ -0,0 +1,175 @@
+import unittest, os, sys
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+import pandas as pd
+from NAPS_nmrstar import NMRStar_file
+
+testsetPath = os.path.dirname(os.path.realpath(__file__)) + '/../data/testset/'
+
+entryV21 = """data_4834
+
+save_entry_information
+   _Saveframe_category      entry_information
+   _Entry_title
+;
+Backbone assignments of a test protein;
+with a semicolon and 'quotes' in the title
+;
+save_
+
+save_sample_conditions
+   _Saveframe_category   sample_conditions
+   loop_
+      _Variable_type
+      _Variable_value
+      _Variable_value_units
+
+      'pH*'         6.5   .
+       temperature  298   K
+   stop_
+save_
+
+save_shifts
+   _Saveframe_category   assigned_chemical_shifts
+   loop_
+      _Atom_shift_assign_ID
+      _Residue_seq_code
+      _Residue_label
+      _Atom_name
+      _Atom_type
+      _Chem_shift_value
+      _Chem_shift_ambiguity_code
+
+      1   1   MET   H    H   8.31   1
+      2   1   MET   CA   C   55.2   1
+      3   2   SER   "N"  N   116.1  1
+      # A comment between rows
+      4   2   SER   CB   C   63.9   1
+   stop_
+save_
+"""
+
+entryV31 = """data_entry
+
+save_sample_conditions_1
+   _Sample_condition_list.Sf_category   sample_conditions
+   loop_
+      _Sample_condition_variable.Type
+      _Sample_condition_variable.Val
+      pH            7.0
+      temperature   303
+   stop_
+save_
+
+save_assigned_chem_shift_list_1
+   _Assigned_chem_shift_list.Sf_category   assigned_chemical_shifts
+   _Assigned_chem_shift_list.Details
+;
+Shifts were referenced to DSS
+;
+   loop_
+      _Atom_chem_shift.ID
+      _Atom_chem_shift.Seq_ID
+      _Atom_chem_shift.Auth_seq_ID
+      _Atom_chem_shift.Comp_ID
+      _Atom_chem_shift.Atom_ID
+      _Atom_chem_shift.Val
+      _Atom_chem_shift.Auth_asym_ID
+      _Atom_chem_shift.Entity_assembly_ID
+      1   1   10   GLY   H    8.50   A   1
+      2   1   10   GLY   N    109.3  A   1
+      3   2   .    'ALA'  CA  52.7   A   1
+      4   3   12   LYS   CA   56.1   A   1
+      5   4   13   LYS   CB   .      A   1
+   stop_
+save_
+"""
+
+# The same shifts, without author numbering
+entryV31NoAuth = """data_entry
+
+save_assigned_chem_shift_list_1
+   _Assigned_chem_shift_list.Sf_category   assigned_chemical_shifts
+   loop_
+      _Atom_chem_shift.ID
+      _Atom_chem_shift.Seq_ID
+      _Atom_chem_shift.Auth_seq_ID
+      _Atom_chem_shift.Comp_ID
+      _Atom_chem_shift.Atom_ID
+      _Atom_chem_shift.Val
+      _Atom_chem_shift.Auth_asym_ID
+      _Atom_chem_shift.Entity_assembly_ID
+      1   1   .   GLY   H    8.50   .   1
+      2   1   .   GLY   N    109.3  .   1
+      3   2   .   ALA   CA   52.7   .   1
+      4   3   .   LYS   CA   56.1   .   1
+   stop_
+save_
+"""
+
+class Tests_NMRStar(unittest.TestCase):
+    def test_chemShifts_v21_readsQuotedValuesAndSkipsComments(self):
+        star = NMRStar_file(text=entryV21)
+        shifts = star.chem_shifts()
+
+        self.assertEqual(star.data_name, '4834')
+        self.assertEqual(list(shifts['Res_N']), [1, 1, 2, 2])
+        self.assertEqual(list(shifts['Atom_type']), ['H', 'CA', 'N', 'CB'])
+        self.assertEqual(list(shifts['Res_type']), ['MET', 'MET', 'SER', 'SER'])
+        self.assertAlmostEqual(shifts['Shift'].iloc[2], 116.1)
+        self.assertNotIn('Chain', shifts.columns)
+
+    def test_saveframeTags_semicolonField_keepsWholeText(self):
+        star = NMRStar_file(text=entryV21)
+        title = star.saveframes['entry_information']['tags']['_Entry_title']
+
+        self.assertEqual(star.find_saveframes('assigned_chemical_shifts'), ['shifts'])
+        self.assertIn("Backbone assignments of a test protein;", title)
+        self.assertIn("'quotes'", title)
+
+    def test_sampleConditions_v21AndV31_returnsPHAndTemperature(self):
+        self.assertEqual(NMRStar_file(text=entryV21).sample_conditions(),
+                         {'pH':6.5, 'temperature':298})
+        self.assertEqual(NMRStar_file(text=entryV31).sample_conditions(),
+                         {'pH':7.0, 'temperature':303})
+
+    def test_chemShifts_v31_usesAuthorNumberingForWholeLoop(self):
+        shifts = NMRStar_file(text=entryV31).chem_shifts()
+
+        # The rows with no shift value or no author number are dropped, rather
+        # than mixing in the internal numbering
+        self.assertEqual(list(shifts['Res_N']), [10, 10, 12])
+        self.assertEqual(list(shifts['Res_type']), ['GLY', 'GLY', 'LYS'])
+        self.assertEqual(list(shifts['Chain']), ['A', 'A', 'A'])
+
+    def test_chemShifts_v31NoAuthorNumbers_usesSeqID(self):
+        shifts = NMRStar_file(text=entryV31NoAuth).chem_shifts()
+
+        self.assertEqual(list(shifts['Res_N']), [1, 1, 2, 3])
+        self.assertEqual(list(shifts['Res_type']), ['GLY', 'GLY', 'ALA', 'LYS'])
+        self.assertEqual(list(shifts['Chain'].astype(str)), ['1', '1', '1', '1'])
+
+    def test_chemShifts_noShiftList_raisesValueError(self):
+        star = NMRStar_file(text="data_empty\n")
+        with self.assertRaises(ValueError):
+            star.chem_shifts()
+
+    def test_getLoop_wrongNumberOfValues_raisesValueError(self):
+        star = NMRStar_file(text="data_bad\nloop_\n _a\n _b\n 1 2 3\nstop_\n")
+        with self.assertRaises(ValueError):
+            star.get_loop(0)
+
+    def test_chemShifts_testsetEntry_matchesSimplifiedTable(self):
+        star = NMRStar_file(testsetPath +
+                            'CS-corrected-testset-addPDBresno/A003_bmr4834.str.corr.pdbresno')
+        shifts = star.chem_shifts()
+        table = pd.read_table(testsetPath + 'simplified_BMRB/4834.txt')
+
+        self.assertEqual(star.data_name, '4834')
+        self.assertEqual(list(shifts['Res_N']), list(table['Residue_PDB_seq_code']))
+        self.assertEqual(list(shifts['Atom_type']), list(table['Atom_name']))
+        self.assertEqual(list(shifts['Shift']), list(table['Chem_shift_value']))
+
+if __name__ == '__main__':
+    unittest.main()
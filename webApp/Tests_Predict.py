@@ -0,0 +1,112 @@
+import unittest, os, sys, tempfile, time
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+from NAPS_assigner import NAPS_assigner
+from NAPS_predict import pdb_jobs, run_predictions
+
+# Stands in for shiftx2.py, see standin_predictor.py
+standinCmd = [sys.executable, mainNAPSfilePath + '/standin_predictor.py']
+
+def pdbLines(offset=0):
+    return ['ATOM  %5d  CA  %s A%4d    %8.3f%8.3f%8.3f\n' %
+            (i+1, res, i+1, 3.8*i + offset, 0, 0)
+            for i, res in enumerate(['MET', 'ALA', 'GLY', 'LYS'])]
+
+def processesWith(marker):
+    """Command lines of running processes with an argument containing marker"""
+    found = []
+    for pid in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                cmdline = f.read().decode(errors='replace').split('\0')
+        except (OSError, ValueError):
+            continue
+        if any(marker in arg for arg in cmdline):
+            found.append(cmdline)
+    return found
+
+class Tests_Predict(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.outDir = os.path.join(self.tmpDir.name, 'out')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def writePDB(self, path, lines=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.writelines((lines or pdbLines()) + ['END\n'])
+        return path
+
+    def test_runPredictions_missingPDB_failsOnlyThatJob(self):
+        pdb = self.writePDB(os.path.join(self.tmpDir.name, 'a.pdb'))
+        missing = os.path.join(self.tmpDir.name, 'missing.pdb')
+        jobs = pdb_jobs([pdb, missing], self.outDir)
+        results = run_predictions(jobs, cmd=standinCmd, workers=1, retries=0)
+
+        self.assertEqual(list(results['Status']), ['done', 'failed'])
+        self.assertIn('could not read structure', results['Error'][1])
+        preds = NAPS_assigner().import_pred_shifts(jobs['Out_file'][0], 'shiftx2')
+        self.assertEqual(len(preds.index), 4)
+
+        # Up to date outputs are skipped on a rerun
+        results = run_predictions(jobs.iloc[:1], cmd=standinCmd, workers=1)
+        self.assertEqual(list(results['Status']), ['skipped'])
+
+    def test_runPrediction_delay_timesOutAndKillsProcessGroup(self):
+        pdb = self.writePDB(os.path.join(self.tmpDir.name, 'a.pdb'))
+        jobs = pdb_jobs([pdb], self.outDir)
+        # The predictor runs in a child of the shell, so it's only killed if
+        # the whole process group is
+        cmd = ['/bin/sh', '-c', '"$@"; exit $?', 'sh'] + standinCmd
+        results = run_predictions(jobs, cmd=cmd, workers=1, retries=0,
+                                  timeout=2, extra_args=['--delay', '60'])
+
+        self.assertEqual(list(results['Status']), ['failed'])
+        self.assertIn('timed out', results['Error'][0])
+        self.assertLess(results['Time'][0], 30)
+        self.assertFalse(os.path.exists(jobs['Out_file'][0]))
+        self.assertFalse(os.path.exists(jobs['Out_file'][0] + '.part'))
+        # The predictor's command line has the output file, in tmpDir
+        for i in range(20):
+            if not processesWith(self.tmpDir.name):
+                break
+            time.sleep(0.1)
+        self.assertEqual(processesWith(self.tmpDir.name), [])
+
+    def test_runPrediction_failRate_retriesAndCountsAttempts(self):
+        pdb = self.writePDB(os.path.join(self.tmpDir.name, 'a.pdb'))
+        jobs = pdb_jobs([pdb], self.outDir)
+        results = run_predictions(jobs, cmd=standinCmd, workers=1, retries=2,
+                                  extra_args=['--fail_rate', '1'])
+
+        self.assertEqual(list(results['Status']), ['failed'])
+        self.assertEqual(list(results['Attempts']), [3])
+        self.assertIn('simulated failure', results['Error'][0])
+        self.assertFalse(os.path.exists(jobs['Out_file'][0]))
+
+    def test_runPredictions_splitModels_predictsEachModel(self):
+        lines = (['MODEL        1\n'] + pdbLines() + ['ENDMDL\n'] +
+                 ['MODEL        2\n'] + pdbLines(offset=1) + ['ENDMDL\n'])
+        pdb = self.writePDB(os.path.join(self.tmpDir.name, 'ens.pdb'), lines)
+        jobs = pdb_jobs([pdb], self.outDir, split=True)
+        self.assertEqual(list(jobs['Name']), ['ens_model1', 'ens_model2'])
+        results = run_predictions(jobs, cmd=standinCmd, workers=2)
+        self.assertEqual(list(results['Status']), ['done', 'done'])
+
+        # The models have different coordinates, so different shifts
+        a = NAPS_assigner()
+        preds = a.import_pred_shifts(list(jobs['Out_file']), 'shiftx2')
+        self.assertEqual(len(preds.index), 4)
+        self.assertGreater(a.ensemble_shifts('CA').std(axis=1).min(), 0)
+
+    def test_pdbJobs_duplicateFileNames_raisesValueError(self):
+        pdb1 = self.writePDB(os.path.join(self.tmpDir.name, 'x', 'a.pdb'))
+        pdb2 = self.writePDB(os.path.join(self.tmpDir.name, 'y', 'a.pdb'))
+        with self.assertRaises(ValueError):
+            pdb_jobs([pdb1, pdb2], self.tmpDir.name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest, os, sys, tempfile, logging
+
+mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
+sys.path.append(mainNAPSfilePath)
+from NAPS import runNAPS
+
+dataPath = os.path.dirname(os.path.realpath(__file__)) + '/../data/P3a_L273R/'
+configFile = os.path.dirname(os.path.realpath(__file__)) + '/../config/config.txt'
+
+class Tests_RunNAPS(unittest.TestCase):
+    def test_runNAPS_argsList_returnsAndWritesResults(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, 'output.txt')
+            argv = sys.argv.copy()
+            results = runNAPS([dataPath + 'naps_shifts.txt',
+                               dataPath + 'shiftx2.cs', output_file,
+                               '--shift_type', 'naps', '--pred_type', 'shiftx2',
+                               '-c', configFile])
+
+            self.assertEqual(sys.argv, argv)
+            self.assertTrue(os.path.exists(output_file))
+            self.assertIsNone(results['alt_assign_df'])
+            self.assertIs(results['results'], results['assign_df'])
+            self.assertIn('SS_name', results['assign_df'].columns)
+            self.assertIn('Res_name', results['assign_df'].columns)
+
+    def test_runNAPS_noOutputFile_returnsResults(self):
+        results = runNAPS([dataPath + 'naps_shifts.txt',
+                           dataPath + 'shiftx2.cs', '-c', configFile],
+                          pars={'plot_strips':False})
+        self.assertGreater(len(results['assign_df'].index), 0)
+
+    def test_runNAPS_logFile_writesLogAndRemovesHandler(self):
+        handlers = list(logging.getLogger().handlers)
+        with tempfile.TemporaryDirectory() as directory:
+            log_file = os.path.join(directory, 'log.txt')
+            runNAPS([dataPath + 'naps_shifts.txt', dataPath + 'shiftx2.cs',
+                     '-c', configFile, '-l', log_file],
+                    pars={'plot_strips':False})
+            with open(log_file) as f:
+                log = f.read()
+        self.assertIn('Read in configuration', log)
+        self.assertIn('Calculated best assignment', log)
+        self.assertEqual(logging.getLogger().handlers, handlers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import json
+import numpy as np
+import pandas as pd
+from .table import queryTable, TableQueryError
+
+class Tests_Table(unittest.TestCase):
+    def setUp(self):
+        self.table = pd.DataFrame({
+            'SS_name':['   1A', '   1A', '   2G', '   3K'],
+            'Res_name':['  10A', '  12A', '  11G', '  12K'],
+            'Rank':[1, 2, 1, 1],
+            'Log_prob':[-1.23456, -5.0, np.NaN, -2.0]})
+
+    def query(self, **params):
+        return json.loads(queryTable(self.table, params))
+
+    def test_table_noParams_returnsAllColumnsTyped(self):
+        result = self.query()
+        self.assertEqual(result['total'], 4)
+        self.assertEqual(result['columns'], ['SS_name', 'Res_name', 'Rank', 'Log_prob'])
+        self.assertEqual(result['data']['Rank'], [1, 2, 1, 1])
+        self.assertEqual(result['data']['Log_prob'], [-1.235, -5.0, None, -2.0])
+
+    def test_table_offsetAndLimit_returnsPage(self):
+        result = self.query(offset='1', limit='2')
+        self.assertEqual(result['total'], 4)
+        self.assertEqual(result['offset'], 1)
+        self.assertEqual(result['data']['Res_name'], ['  12A', '  11G'])
+
+    def test_table_filterBySSNameAndRank_returnsMatchingRows(self):
+        result = self.query(SS_name='1A')
+        self.assertEqual(result['total'], 2)
+        result = self.query(SS_name='1A', Rank='2')
+        self.assertEqual(result['data']['Res_name'], ['  12A'])
+
+    def test_table_sortDescending_sortsWithMissingLast(self):
+        result = self.query(sort='Log_prob', order='desc')
+        self.assertEqual(result['data']['Log_prob'], [-1.235, -2.0, -5.0, None])
+
+    def test_table_invalidParams_raiseError(self):
+        with self.assertRaises(TableQueryError):
+            self.query(sort='Not_a_column')
+        with self.assertRaises(TableQueryError):
+            self.query(limit='ten')
+        with self.assertRaises(TableQueryError):
+            self.query(Rank='first')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,13 @@ class Args:
         self.plot_file = os.path.join(self.directory, 'plot.png')
         self.shift_type = form['shift_type'].strip().lower()
         self.pred_type = form['pred_type'].strip().lower()
+        self.config_file = '../config/config.txt'
+        # Contents of uploaded files, if they are read into memory
+        self.shift_upload = None
+        self.pred_upload = None
+        # Keys for the result cache, if it is used
+        self.result_key = None
+        self.preds_key = None
 
     def argsToList(self):
         return [
@@ -21,6 +28,6 @@ class Args:
             '--shift_type', self.shift_type,
             '--pred_type', self.pred_type,
             '--plot_file', self.plot_file,
-            '-c', '../config/config.txt',
+            '-c', self.config_file,
             #'-l', '../output/test.log'
         ]
\ No newline at end of file
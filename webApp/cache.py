@@ -0,0 +1,114 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+def fileDigest(upload, path):
+    """sha256 of an uploaded file's contents, or of the file at path"""
+    h = hashlib.sha256()
+    if upload is not None:
+        h.update(upload.encode('utf-8'))
+    else:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def inputKeys(args):
+    """Cache keys for a submission.
+
+    The result key covers both input files, their types and the config file.
+    The preds key only covers what the parsed predictions depend on, so it is
+    shared by submissions that differ only in their observed shifts.
+    """
+    shiftDigest = fileDigest(args.shift_upload, args.shift_file)
+    predDigest = fileDigest(args.pred_upload, args.pred_file)
+    configDigest = fileDigest(None, args.config_file)
+    predsKey = hashlib.sha256(
+        '\n'.join([predDigest, args.pred_type, configDigest]).encode('utf-8')
+        ).hexdigest()
+    resultKey = hashlib.sha256(
+        '\n'.join([shiftDigest, args.shift_type, predsKey]).encode('utf-8')
+        ).hexdigest()
+    return resultKey, predsKey
+
+class ResultCache:
+    """caches NAPS results, result tables, strip plot tiles and parsed
+    predictions on local disk
+
+    Each entry is a file in directory. Reading an entry updates its
+    modification time, and when the directory grows beyond max_bytes the
+    least recently used entries are deleted. Entries are written atomically,
+    so the cache can be shared between worker processes.
+    """
+
+    def __init__(self, directory, max_bytes=500*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def getResult(self, key):
+        data = self.read('result_' + key + '.json')
+        return json.loads(data) if data is not None else None
+
+    def putResult(self, key, result):
+        self.write('result_' + key + '.json', json.dumps(result).encode('utf-8'))
+
+    def getPreds(self, key):
+        data = self.read('preds_' + key + '.pkl')
+        return pickle.loads(data) if data is not None else None
+
+    def putPreds(self, key, preds):
+        self.write('preds_' + key + '.pkl', pickle.dumps(preds))
+
+    def getTable(self, key):
+        data = self.read('table_' + key + '.pkl')
+        return pickle.loads(data) if data is not None else None
+
+    def putTable(self, key, table):
+        self.write('table_' + key + '.pkl', pickle.dumps(table))
+
+    def getTile(self, key, tile):
+        return self.read('tile_%s_%d.png' % (key, tile))
+
+    def putTile(self, key, tile, data):
+        self.write('tile_%s_%d.png' % (key, tile), data)
+
+    def read(self, filename):
+        path = os.path.join(self.directory, filename)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Missing, or evicted by another process
+            return None
+        return data
+
+    def write(self, filename, data):
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, os.path.join(self.directory, filename))
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until under max_bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
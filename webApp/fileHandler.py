@@ -15,6 +15,23 @@ def saveFiles(request, args):
     else:
         request.files['predictedShiftsFile'].save(args.pred_file)
 
+def readFiles(request, args):
+    """Read uploaded files into memory, rather than saving them to disk"""
+    #For now, default files are used if files are not provided
+    if 'observedShiftsFile' in request.form:
+        args.shift_file = '../data/P3a_L273R/naps_shifts.txt'
+    else:
+        args.shift_upload = readUpload(request.files['observedShiftsFile'])
+
+    if 'predictedShiftsFile' in request.form:
+        args.pred_file = '../data/P3a_L273R/shiftx2.cs'
+    else:
+        args.pred_upload = readUpload(request.files['predictedShiftsFile'])
+
+def readUpload(upload):
+    text = upload.stream.read()
+    return text.decode('utf-8') if isinstance(text, bytes) else text
+
 def deleteFiles(args):
     if os.path.exists(args.directory) and os.path.isdir(args.directory):
         shutil.rmtree(args.directory)
@@ -0,0 +1,176 @@
+import io
+import json
+import time
+import uuid
+import queue
+import base64
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def loadNAPS():
+    """Import NAPS when a worker process starts, rather than for each job"""
+    import NAPS
+
+def runJob(args, cache=None, events=None):
+    """Run NAPS for one job. This runs in a worker process.
+
+    Uploaded files are passed to NAPS from memory, and the results are
+    serialised straight from the DataFrame. If a ResultCache is given, parsed
+    predictions are reused from it, and the results are stored in it, along
+    with the strip plot tiles if the config file asks for them. If an
+    events queue is given, progress events are put on it as (event, data)
+    pairs, with data as JSON text.
+    """
+    def report(event, data):
+        if events is None:
+            return
+        if event == 'stage':
+            events.put((event, json.dumps({'stage':data})))
+        elif event == 'tiles':
+            events.put((event, json.dumps(data)))
+        elif event == 'plot':
+            events.put((event, json.dumps({'plot':base64.b64encode(
+                data.getvalue()).decode('utf-8')})))
+        elif cache is not None:
+            # Only the headers are sent, and the rows are fetched a page at a
+            # time from /table/<key>
+            key = '%s_%s' % (args.result_key, event)
+            cache.putTable(key, data)
+            events.put((event, json.dumps({'headers':list(data.columns),
+                                           'key':key})))
+        else:
+            table = resultsToDict(data)
+            events.put((event, '{"headers": %s, "result": %s}' % (
+                json.dumps(table['headers']), table['result'])))
+
+    from NAPS import build_parser, runNAPS
+    from NAPS_assigner import NAPS_assigner
+    napsArgs = build_parser().parse_args(args.argsToList())
+    napsArgs.output_file = None
+    napsArgs.plot_file = io.BytesIO()
+    if args.shift_upload is not None:
+        napsArgs.shift_file = io.StringIO(args.shift_upload)
+    if args.pred_upload is not None:
+        napsArgs.pred_file = io.StringIO(args.pred_upload)
+
+    a = NAPS_assigner()
+    a.read_config_file(napsArgs.config_file)
+    pars = a.pars
+
+    preds = None
+    if cache is not None:
+        preds = cache.getPreds(args.preds_key)
+        if preds is None:
+            report('stage', 'import_pred_shifts')
+            preds = a.import_pred_shifts(napsArgs.pred_file, napsArgs.pred_type)
+            cache.putPreds(args.preds_key, preds)
+
+    # Tiled strip plots are stored in the cache and fetched a tile at a time,
+    # instead of being sent as one large image
+    tiled = (cache is not None and pars['plot_strips'] and
+             pars['plot_method'] == 'matplotlib' and pars['plot_tile_size'] > 0)
+    results = runNAPS(napsArgs, pars={'plot_strips':False} if tiled else None,
+                      preds=preds, callback=report)
+    result = resultsToDict(results['results'], napsArgs.plot_file.getvalue())
+    if tiled:
+        report('stage', 'plot_strips')
+        index, tiles = results['assigner'].plot_strip_tiles(
+            pars['plot_tile_size'], 'png', pars['plot_workers'])
+        for tile in index:
+            cache.putTile(args.result_key, tile['tile'], tiles[tile['tile']])
+        result['tiles'] = {'key':args.result_key, 'tiles':index}
+        report('tiles', result['tiles'])
+    if cache is not None:
+        # The table is kept as a DataFrame too, so it can be queried by page
+        cache.putTable(args.result_key, results['results'])
+        result['key'] = args.result_key
+        cache.putResult(args.result_key, result)
+    return result
+
+def resultsToDict(results, plot=b''):
+    """Convert a results DataFrame and png plot into the parts of the JSON
+    response. The table is left as JSON text."""
+    return dict(headers=list(results.columns),
+                result=results.to_json(orient='records', double_precision=3),
+                plot=base64.b64encode(plot).decode('utf-8'))
+
+class Job:
+    """a NAPS run submitted to the job queue"""
+
+    def __init__(self, future, eventQueue=None):
+        self.id = uuid.uuid4().hex
+        self.future = future
+        self.submitted = time.time()
+        self.eventQueue = eventQueue
+        self.eventLog = []
+        self.eventLock = threading.Lock()
+
+    def events(self, start=0):
+        """Return the progress events from position start onwards.
+
+        All events are kept, so a client that reconnects can replay them."""
+        with self.eventLock:
+            while self.eventQueue is not None:
+                try:
+                    self.eventLog.append(self.eventQueue.get_nowait())
+                except queue.Empty:
+                    break
+            return self.eventLog[start:]
+
+    @property
+    def status(self):
+        if self.future.done():
+            return 'failed' if self.future.exception() else 'finished'
+        return 'running' if self.future.running() else 'queued'
+
+class JobQueue:
+    """runs NAPS jobs in a pool of worker processes
+
+    Finished jobs are kept for max_age seconds, so the results can still be
+    collected if the client reconnects. If a ResultCache is given, jobs use it
+    for their predictions and results. Progress events from the workers are
+    passed back through queues from a multiprocessing Manager.
+    """
+
+    def __init__(self, max_workers=None, max_age=3600, cache=None):
+        self.cache = cache
+        self.manager = multiprocessing.Manager()
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            initializer=loadNAPS)
+        self.max_age = max_age
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, args):
+        eventQueue = self.manager.Queue()
+        job = Job(self.executor.submit(runJob, args, self.cache, eventQueue),
+                  eventQueue)
+        with self.lock:
+            self.removeExpired()
+            self.jobs[job.id] = job
+        return job.id
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        return job.status if job else 'unknown'
+
+    def result(self, job_id, timeout=None):
+        """Return the results of a job, waiting up to timeout seconds.
+        Raises any exception raised by the job."""
+        return self.get(job_id).future.result(timeout)
+
+    def removeExpired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.future.done() and now - job.submitted > self.max_age]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.manager.shutdown()
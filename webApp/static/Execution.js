@@ -1,4 +1,7 @@
 $(function () {
+    $(".tableFilter").change(function () {
+        $('#table').bootstrapTable('selectPage', 1);
+    });
     $("#run").click(function () {
         $("#resultsSection").append("<div id=runLoading class=\"spinner-border\" role=\"status\"><span class=\"sr-only\">Loading...</span></div>");
         $("#tableData").empty();
@@ -17,7 +20,10 @@ $(function () {
             processData: false,
             contentType: false,
             success: function (data) {
-                success(data);
+                if (data.status == 'queued')
+                    listen(data.job_id);
+                else
+                    success(data);
             },
             error: function (err) {
                 console.log(err);
@@ -27,21 +33,150 @@ $(function () {
     });
 });
 
+function listen(job_id) {
+    if (!window.EventSource) {
+        poll(job_id);
+        return;
+    }
+    $("#resultsSection").append("<span id=runProgress></span>");
+    var headers = null;
+    var source = new EventSource($SCRIPT_ROOT + '/events/' + job_id);
+    source.addEventListener('stage', function (event) {
+        $("#runProgress").text(" " + JSON.parse(event.data).stage.replace(/_/g, " "));
+    });
+    source.addEventListener('assignment', function (event) {
+        var data = JSON.parse(event.data);
+        headers = data.headers;
+        showEventTable(data);
+    });
+    source.addEventListener('alt_assignments', function (event) {
+        var data = JSON.parse(event.data);
+        headers = data.headers;
+        showEventTable(data);
+    });
+    source.addEventListener('plot', function (event) {
+        showPlot(JSON.parse(event.data).plot);
+    });
+    source.addEventListener('tiles', function (event) {
+        showTiles(JSON.parse(event.data));
+    });
+    source.addEventListener('done', function (event) {
+        source.close();
+        var data = JSON.parse(event.data);
+        if (data.key && headers)
+            showPagedTable(data.key, headers);
+        $("#runLoading").remove();
+        $("#runProgress").remove();
+    });
+    source.addEventListener('failed', function (event) {
+        source.close();
+        $("#runProgress").remove();
+        success(JSON.parse(event.data));
+    });
+}
+
+function poll(job_id) {
+    $.getJSON($SCRIPT_ROOT + '/status/' + job_id, function (data) {
+        if (data.status == 'queued' || data.status == 'running')
+            setTimeout(function () { poll(job_id); }, 1000);
+        else
+            $.getJSON($SCRIPT_ROOT + '/result/' + job_id, success);
+    }).fail(function (err) {
+        console.log(err);
+    });
+}
+
 function success(data) {
     $("#runLoading").remove();
     if (data.status == 'ok') {
-        $.each(data.headers, function (index, header) {
-            $("#tableData").append("<th data-field=" + header + ">" + header + "</th>");
-        });
-        $('#table').bootstrapTable({
-            data: data.result
-        });
-        if (data.plot)
-            $('#plot').append("<img alt=\"Embedded Image\" src=\"data:image / png;base64, " + data.plot + "\" />");
+        if (data.key)
+            showPagedTable(data.key, data.headers);
+        else
+            showTable(data);
+        if (data.tiles)
+            showTiles(data.tiles);
+        else
+            showPlot(data.plot);
+    }
+    else if (data.status == 'application_failed' || data.status == 'unknown') {
+        $("#errors").append("<p>NAPS failed to run.</p>");
     }
     else if (data.status == 'validation_failed') {
         $.each(data.errors, function (index, error) {
             $("#errors").append("<p>" + error + "</p>");
         });
     }
-}
\ No newline at end of file
+}
+// With a results cache, events only include the headers and the key of a
+// cached table
+function showEventTable(data) {
+    if (data.key)
+        showPagedTable(data.key, data.headers);
+    else
+        showTable(data);
+}
+
+function showTable(data) {
+    $('#table').bootstrapTable('destroy');
+    $("#tableData").empty();
+    $.each(data.headers, function (index, header) {
+        $("#tableData").append("<th data-field=" + header + ">" + header + "</th>");
+    });
+    $('#table').bootstrapTable({
+        data: data.result
+    });
+}
+
+// Fetch the table from the server a page at a time, as columnar JSON
+function showPagedTable(key, headers) {
+    $('#table').bootstrapTable('destroy');
+    $("#tableData").empty();
+    $.each(headers, function (index, header) {
+        $("#tableData").append("<th data-field=" + header + " data-sortable=true>" + header + "</th>");
+    });
+    $('#table').bootstrapTable({
+        url: $SCRIPT_ROOT + '/table/' + key,
+        sidePagination: 'server',
+        pagination: true,
+        pageSize: 100,
+        queryParams: function (params) {
+            var query = { offset: params.offset, limit: params.limit,
+                          sort: params.sort, order: params.order };
+            $.each(['SS_name', 'Res_name', 'Rank'], function (index, column) {
+                var value = $.trim($('#filter' + column).val() || '');
+                if (value)
+                    query[column] = value;
+            });
+            return query;
+        },
+        responseHandler: function (res) {
+            var rows = [];
+            var n = res.columns.length ? res.data[res.columns[0]].length : 0;
+            for (var i = 0; i < n; i++) {
+                var row = {};
+                $.each(res.columns, function (index, column) {
+                    row[column] = res.data[column][i];
+                });
+                rows.push(row);
+            }
+            return { total: res.total, rows: rows };
+        }
+    });
+}
+
+function showPlot(plot) {
+    $('#plot').empty();
+    if (plot)
+        $('#plot').append("<img alt=\"Embedded Image\" src=\"data:image / png;base64, " + plot + "\" />");
+}
+
+// Tiled strip plots are fetched from the server one tile at a time, as they
+// are scrolled into view
+function showTiles(tiles) {
+    $('#plot').empty();
+    $.each(tiles.tiles, function (index, tile) {
+        $('#plot').append("<img loading=\"lazy\" style=\"width: 100%; aspect-ratio: 297 / 210;\"" +
+            " alt=\"Residues " + tile.first + " to " + tile.last + "\"" +
+            " src=\"" + $SCRIPT_ROOT + "/tiles/" + tiles.key + "/" + tile.tile + "\" />");
+    });
+}
@@ -0,0 +1,59 @@
+import json
+
+# Columns that results can be filtered on
+filterColumns = ['SS_name', 'Res_name', 'Rank']
+
+class TableQueryError(Exception):
+    pass
+
+def queryTable(table, params, maxLimit=1000):
+    """Filter, sort and paginate a results DataFrame.
+
+    params: dict of query parameters
+        offset, limit: the rows to return, after filtering and sorting
+        sort, order: column to sort by, and 'asc' or 'desc'
+        SS_name, Res_name, Rank: only return rows with this value (names are
+            compared without their padding)
+
+    Returns the page as compact columnar JSON text, with one array per column:
+    {"total": <rows after filtering>, "offset": ..., "columns": [...],
+     "data": {"<column>": [...], ...}}
+    """
+    try:
+        offset = max(int(params.get('offset', 0)), 0)
+        limit = min(max(int(params.get('limit', 100)), 0), maxLimit)
+    except ValueError:
+        raise TableQueryError('offset and limit must be integers.')
+
+    mask = None
+    for column in filterColumns:
+        value = params.get(column)
+        if value is None or value == '' or column not in table.columns:
+            continue
+        if column == 'Rank':
+            try:
+                match = table[column] == int(value)
+            except ValueError:
+                raise TableQueryError('Rank must be an integer.')
+        else:
+            match = table[column].astype(str).str.strip() == value.strip()
+        mask = match if mask is None else mask & match
+    if mask is not None:
+        table = table.loc[mask]
+
+    sort = params.get('sort')
+    if sort:
+        if sort not in table.columns:
+            raise TableQueryError('Unknown sort column: ' + sort)
+        order = params.get('order', 'asc')
+        if order not in ['asc', 'desc']:
+            raise TableQueryError("order must be 'asc' or 'desc'.")
+        table = table.sort_values(sort, ascending=(order == 'asc'),
+                                  kind='mergesort', na_position='last')
+
+    page = table.iloc[offset:offset+limit]
+    data = ', '.join('%s: %s' % (json.dumps(column), page[column].to_json(
+                         orient='values', double_precision=3))
+                     for column in page.columns)
+    return '{"total": %d, "offset": %d, "columns": %s, "data": {%s}}' % (
+        len(table.index), offset, json.dumps(list(page.columns)), data)
@@ -1,60 +1,141 @@
 import sys
 import os
-import re
-import base64
+import json
+import time
+from functools import lru_cache
 
 from flask import Flask, render_template, jsonify, request
 from os import environ
 from validation import Validate
 from args import Args
-from fileHandler import saveFiles, deleteFiles
+from fileHandler import readFiles
+from jobs import JobQueue
+from cache import ResultCache, inputKeys
+from table import queryTable, TableQueryError
 
 mainNAPSfilePath = os.path.dirname(os.path.realpath(__file__)) + '/../python'
 sys.path.append(mainNAPSfilePath)
 os.chdir(mainNAPSfilePath)
 
-from NAPS import runNAPS
 app = Flask(__name__)
 
+try:
+    WORKERS = int(environ.get('NAPS_WORKERS', '0')) or None
+except ValueError:
+    WORKERS = None
+try:
+    CACHE_MB = float(environ.get('NAPS_CACHE_MB', '500'))
+except ValueError:
+    CACHE_MB = 500
+resultCache = ResultCache(environ.get('NAPS_CACHE_DIR',
+                                      os.path.join(app.instance_path, 'cache')),
+                          max_bytes=CACHE_MB*1024*1024)
+jobQueue = JobQueue(max_workers=WORKERS, cache=resultCache)
+
 @app.route('/run', methods = ['POST'])
 def run():
     args = Args(app.instance_path, request.form)
-    saveFiles(request, args)
     validationResult = Validate(args)
-    response = run(args) if validationResult.isValid else validationResult.response
-    deleteFiles(args)
-    return response
+    if not validationResult.isValid:
+        return validationResult.response
+    readFiles(request, args)
+    args.result_key, args.preds_key = inputKeys(args)
+    cached = resultCache.getResult(args.result_key)
+    if cached is not None:
+        return createJSONForTable(cached)
+    job_id = jobQueue.submit(args)
+    return jsonify(status='queued', job_id=job_id)
+
+@app.route('/status/<job_id>')
+def status(job_id):
+    return jsonify(status=jobQueue.status(job_id), job_id=job_id)
+
+@app.route('/events/<job_id>')
+def events(job_id):
+    """Stream a job's progress as server-sent events"""
+    job = jobQueue.get(job_id)
+
+    def stream():
+        if job is None:
+            yield 'event: failed\ndata: {"status": "unknown"}\n\n'
+            return
+        position = 0
+        while True:
+            done = job.future.done()
+            for event, data in job.events(position):
+                yield 'event: %s\ndata: %s\n\n' % (event, data)
+                position += 1
+            if done:
+                break
+            time.sleep(0.2)
+        if job.status == 'failed':
+            yield 'event: failed\ndata: {"status": "application_failed"}\n\n'
+        else:
+            key = job.future.result().get('key')
+            yield 'event: done\ndata: %s\n\n' % json.dumps({'status':'ok', 'key':key})
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
 
-def run(args):
+@app.route('/result/<job_id>')
+def result(job_id):
+    jobStatus = jobQueue.status(job_id)
+    if jobStatus != 'finished' and jobStatus != 'failed':
+        return jsonify(status=jobStatus, job_id=job_id)
     try:
-        runNAPS(args.argsToList())
-        return createJSONForTable(args)
+        return createJSONForTable(jobQueue.result(job_id))
     except Exception as e:
         #log errors
         print("Unexpected error:" + str(e))
         return jsonify(status='application_failed')
 
-def createJSONForTable(args):
-    with open(args.output_file) as output_file:
-        result = []
-        line = output_file.readline()
-        headers = re.split(r'\t', line.rstrip('\n'))
-        line = output_file.readline()
-        while line:
-            row = {}
-            values = re.split(r'\t', line.rstrip('\n'))
-            for i, header in enumerate(headers):
-                row[header] = values[i]
-            result.append(row)
-            line = output_file.readline()
-
-    if os.path.exists(args.plot_file):
-        with open(args.plot_file, "rb") as image:
-            plot = base64.b64encode(image.read()).decode('utf-8')
-    else:
-        plot = ''
-
-    return jsonify(status='ok', headers=headers, result=result, plot=plot)
+@lru_cache(maxsize=16)
+def loadTable(key):
+    table = resultCache.getTable(key)
+    if table is None:
+        raise KeyError(key)
+    return table
+
+@app.route('/table/<key>')
+def resultsTable(key):
+    """One page of a cached results table, as columnar JSON"""
+    try:
+        table = loadTable(key)
+    except KeyError:
+        return jsonify(status='unknown'), 404
+    try:
+        body = queryTable(table, request.args)
+    except TableQueryError as e:
+        return jsonify(status='invalid_query', errors=[str(e)]), 400
+    return app.response_class(body, mimetype='application/json')
+
+@app.route('/tiles/<key>/<int:tile>')
+def stripTile(key, tile):
+    """One tile of a cached strip plot, as a png"""
+    data = resultCache.getTile(key, tile)
+    if data is None:
+        return jsonify(status='unknown'), 404
+    # Keys are content hashes, so a tile never changes
+    return app.response_class(data, mimetype='image/png',
+                              headers={'Cache-Control': 'max-age=86400'})
+
+def createJSONForTable(results):
+    # Cached tables are fetched a page at a time from /table/<key>, unless
+    # the table has been evicted from the cache
+    if results.get('key'):
+        try:
+            loadTable(results['key'])
+            return jsonify(status='ok', headers=results['headers'],
+                           key=results['key'], plot=results['plot'],
+                           tiles=results.get('tiles'))
+        except KeyError:
+            pass
+    # The table is already JSON, so the response is assembled as text
+    body = ('{"status": "ok", "headers": %s, "result": %s, "plot": %s, '
+            '"tiles": %s}') % (
+        json.dumps(results['headers']), results['result'],
+        json.dumps(results['plot']), json.dumps(results.get('tiles')))
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/')
 def index():